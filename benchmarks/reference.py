@@ -0,0 +1,171 @@
+# File: benchmarks/reference.py
+"""
+Bản tham chiếu (giữ nguyên văn) của các hàm Westgard trước khi được vector hóa,
+lấy từ lịch sử main.py. Chỉ dùng để đo độ khớp của bản hiện tại; chạy chậm (vòng lặp Python).
+"""
+import pandas as pd
+
+
+def get_westgard_violations(df, mean_map, sd_map):
+    if df is None or df.empty:
+        return df
+
+    df = df.copy()
+    if 'id' not in df.columns: df['id'] = range(len(df))
+    df['date'] = pd.to_datetime(df['date'], format='mixed', dayfirst=True, errors='coerce')
+    df_calc = df.dropna(subset=['date']).sort_values(by=['date', 'level']).copy()
+    
+    def calc_z(row):
+        try:
+            lvl = row['level']
+            val = float(row['value'])
+            
+            # Lấy Mean/SD từ dict hoặc từ giá trị đơn lẻ một cách an toàn
+            m = mean_map.get(lvl, 0) if isinstance(mean_map, dict) else mean_map
+            s = sd_map.get(lvl, 0) if isinstance(sd_map, dict) else sd_map
+            
+            return (val - m) / s if s > 0 else 0
+        except Exception:
+            return 0
+
+    # Tính toán Z-score an toàn, không còn lỗi dict > int
+    df_calc['z_score'] = df_calc.apply(calc_z, axis=1)
+    
+    violation_map = {row_id: set() for row_id in df_calc['id']}
+
+# --- 1. KIỂM TRA ACROSS-LEVEL (Cập nhật cho 3 mức) ---
+    groups = [group for _, group in df_calc.groupby('date')]
+    for i in range(len(groups)):
+        df_day = groups[i]
+        # Lấy dữ liệu 3 mức của ngày đó
+        l1 = df_day[df_day['level'] == 1].head(1)
+        l2 = df_day[df_day['level'] == 2].head(1)
+        l3 = df_day[df_day['level'] == 3].head(1)
+        
+        levels_present = [l for l in [l1, l2, l3] if not l.empty]
+        
+        # Kiểm tra R-4s giữa bất kỳ cặp mức nào (1-2, 2-3, 1-3)
+        if len(levels_present) >= 2:
+            for a in range(len(levels_present)):
+                for b in range(a + 1, len(levels_present)):
+                    z_a = levels_present[a]['z_score'].iloc[0]
+                    z_b = levels_present[b]['z_score'].iloc[0]
+                    if (z_a >= 2 and z_b <= -2) or (z_a <= -2 and z_b >= 2):
+                        violation_map[levels_present[a]['id'].iloc[0]].add("R-4s")
+                        violation_map[levels_present[b]['id'].iloc[0]].add("R-4s")
+        
+        # 2-2s (Across): Cả 3 mức (hoặc 2/3 mức) cùng vi phạm > 2SD về 1 phía
+        z_scores = [l['z_score'].iloc[0] for l in levels_present]
+        if len(z_scores) >= 2:
+            if all(z > 2 for z in z_scores) or all(z < -2 for z in z_scores):
+                 for l in levels_present: violation_map[l['id'].iloc[0]].add("2-2s")
+
+    # --- 1. KIỂM TRA ACROSS-LEVEL (So sánh giữa các mức) ---
+    groups = [group for _, group in df_calc.groupby('date')]
+    for i in range(len(groups)):
+        df_day = groups[i]
+        l1_curr = df_day[df_day['level'] == 1].head(1)
+        l2_curr = df_day[df_day['level'] == 2].head(1)
+        
+        if not l1_curr.empty and not l2_curr.empty:
+            z1, z2 = l1_curr['z_score'].iloc[0], l2_curr['z_score'].iloc[0]
+            id1, id2 = l1_curr['id'].iloc[0], l2_curr['id'].iloc[0]
+
+            # R-4s: 1 cái > +2SD và 1 cái < -2SD
+            if (z1 >= 2 and z2 <= -2) or (z1 <= -2 and z2 >= 2):
+                violation_map[id1].add("R-4s"); violation_map[id2].add("R-4s")
+
+            # 2-2s (Across): Cả 2 mức cùng nằm 1 bên và rơi vào khoảng ±2SD đến ±3SD
+            if (2 < z1 < 3 and 2 < z2 < 3) or (-3 < z1 < -2 and -3 < z2 < -2):
+                violation_map[id1].add("2-2s") ; violation_map[id2].add("2-2s")
+
+            # 4-1s (Across): 2 phiên liên tiếp của 2 mức cùng phía > 1SD
+            if i >= 1:
+                prev_g = groups[i-1]
+                l1p, l2p = prev_g[prev_g['level']==1], prev_g[prev_g['level']==2]
+                if not l1p.empty and not l2p.empty:
+                    zs = [z1, z2, l1p['z_score'].iloc[0], l2p['z_score'].iloc[0]]
+                    ids = [id1, id2, l1p['id'].iloc[0], l2p['id'].iloc[0]]
+                    if all(v > 1 for v in zs) or all(v < -1 for v in zs):
+                        for tid in ids: violation_map[tid].add("4-1s")
+
+            # 10x (Across): 5 phiên liên tiếp của 2 mức cùng phía Mean
+            if i >= 4:
+                combined_z = []
+                combined_ids = []
+                for k in range(i-4, i+1):
+                    combined_z.extend(groups[k]['z_score'].tolist())
+                    combined_ids.extend(groups[k]['id'].tolist())
+                if len(combined_z) >= 10 and (all(v > 0 for v in combined_z) or all(v < 0 for v in combined_z)):
+                    for tid in combined_ids: violation_map[tid].add("10x")
+
+    # --- 2. KIỂM TRA WITHIN-LEVEL (Chuỗi thời gian từng mức) ---
+    for level, df_level in df_calc.groupby('level'):
+        df_level = df_level.sort_values(by='date').reset_index(drop=True)
+        z, ids = df_level['z_score'].tolist(), df_level['id'].tolist()
+        for i in range(len(z)):
+            cid = ids[i]
+            if abs(z[i]) > 3: violation_map[cid].add("1-3s")
+            if i >= 1 and ((2 < z[i] < 3 and 2 < z[i-1] < 3) or (-3 < z[i] < -2 and -3 < z[i-1] < -2)):
+                violation_map[cid].add("2-2s")
+            if i >= 3:
+                sub4 = z[i-3:i+1]
+                if all(v > 1 for v in sub4) or all(v < -1 for v in sub4): violation_map[cid].add("4-1s")
+            if i >= 5:
+                sub6 = z[i-5:i+1]
+                if all(v > 1 for v in sub6) or all(v < -1 for v in sub6): violation_map[cid].add("Shift")
+                if all(sub6[k] < sub6[k+1] for k in range(5)): violation_map[cid].add("Trend (+)")
+                elif all(sub6[k] > sub6[k+1] for k in range(5)): violation_map[cid].add("Trend (-)")
+            if i >= 9:
+                sub10 = z[i-9:i+1]
+                if all(v > 0 for v in sub10) or all(v < 0 for v in sub10): violation_map[cid].add("10x")
+            if not violation_map[cid] and 2 < abs(z[i]) <= 3: violation_map[cid].add("1-2s")
+
+    final_res = {k: ", ".join(sorted(list(v))) for k, v in violation_map.items()}
+    df['Violation'] = df['id'].map(final_res).replace("", "ĐẠT").fillna("ĐẠT")
+    return df
+
+
+def check_westgard_multi_level(df):
+    """
+    Kiểm tra lỗi 6x, 9x, 12x cho 3 mức nồng độ cùng 1 bên so với đường trung tâm.
+    Quy tắc: n kết quả liên tiếp (gộp cả 3 levels) nằm cùng phía so với Mean.
+    """
+    # Sắp xếp toàn bộ dữ liệu theo thời gian
+    df_sorted = df.sort_values('date').copy()
+    if len(df_sorted) < 6:
+        return []
+
+    # Tính Z-score cho từng dòng để biết nằm bên nào của đường Mean (0)
+    df_sorted['side'] = df_sorted.apply(
+        lambda r: 1 if (r['value'] - r['target_mean']) > 0 else -1 if (r['value'] - r['target_mean']) < 0 else 0,
+        axis=1
+    )
+    
+    violation_logs = []
+    sides = df_sorted['side'].tolist()
+    dates = df_sorted['date'].tolist()
+    levels = df_sorted['level'].tolist()
+
+    for i in range(len(sides)):
+        # Kiểm tra 12x (4 lượt chạy x 3 mức = 12 điểm liên tiếp)
+        if i >= 11:
+            window = sides[i-11:i+1]
+            if all(x == 1 for x in window) or all(x == -1 for x in window):
+                violation_logs.append(f"❌ Lỗi 12x: 4 lượt chạy (12 điểm) cùng bên tại {dates[i].strftime('%d/%m %H:%M')}")
+                continue # Đã dính lỗi nặng nhất thì bỏ qua các lỗi nhỏ hơn tại điểm đó
+
+        # Kiểm tra 9x (3 lượt chạy x 3 mức = 9 điểm liên tiếp)
+        if i >= 8:
+            window = sides[i-8:i+1]
+            if all(x == 1 for x in window) or all(x == -1 for x in window):
+                violation_logs.append(f"⚠️ Lỗi 9x: 3 lượt chạy (9 điểm) cùng bên tại {dates[i].strftime('%d/%m %H:%M')}")
+                continue
+
+        # Kiểm tra 6x (2 lượt chạy x 3 mức = 6 điểm liên tiếp)
+        if i >= 5:
+            window = sides[i-5:i+1]
+            if all(x == 1 for x in window) or all(x == -1 for x in window):
+                violation_logs.append(f"ℹ️ Lỗi 6x: 2 lượt chạy (6 điểm) cùng bên tại {dates[i].strftime('%d/%m %H:%M')}")
+
+    return violation_logs
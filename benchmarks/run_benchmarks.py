@@ -0,0 +1,254 @@
+# File: benchmarks/run_benchmarks.py
+"""
+Benchmark các hàm phân tích QC trên dữ liệu IQC tổng hợp (benchmarks/synthetic.py, seed cố định).
+
+    python benchmarks/run_benchmarks.py                                  # 1e3, 1e4, 1e5 điểm
+    python benchmarks/run_benchmarks.py --sizes 1000 1000000 --out kq.json
+    python benchmarks/run_benchmarks.py --baseline kq_phien_ban_truoc.json
+
+Mỗi ca (hàm x cỡ dữ liệu) ghi: thời gian tốt nhất trong --repeat lần, số điểm/giây, bộ nhớ đỉnh
+(tracemalloc), dấu vân tay kết quả (sha1, đổi nghĩa là kết quả đổi), độ khớp với bản tham chiếu
+(benchmarks/reference.py, chỉ khi cỡ <= --reference-max vì bản này rất chậm) và với Westgard
+là tỉ lệ phát hiện các lỗi chèn vào / tỉ lệ loại bỏ nhầm.
+Kết quả ghi ra JSON; --baseline so sánh với 1 file kết quả trước đó (tốc độ và dấu vân tay).
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from streamlit import config as streamlit_config, logger as streamlit_logger
+
+from benchmarks import reference
+from benchmarks.synthetic import EVENT_KINDS, make_iqc_series
+from charts import plot_levey_jennings, prepare_levey_jennings
+from verification import calculate_clsi_ep15_a3_final
+from westgard import check_westgard_multi_level, get_westgard_violations, verdict_severity
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+# Cỡ tối đa mặc định của từng benchmark (matplotlib với 1e6 điểm mất nhiều phút); --no-caps để bỏ giới hạn
+CAPS = {"plot_levey_jennings": 100_000}
+
+
+def score_by_lot(df, fn):
+    """Chấm Westgard từng lot (mọi mức của cùng đợt lot, mean/SD theo mức) như app; trả về nhãn theo id."""
+    parts = []
+    for _, g in df.groupby("lot_set", sort=False):
+        first = g.drop_duplicates("level")
+        mean_map = dict(zip(first["level"], first["target_mean"]))
+        sd_map = dict(zip(first["level"], first["target_sd"]))
+        res = fn(g[["id", "date", "level", "value"]], mean_map, sd_map)
+        parts.append(res.set_index("id")["Violation"])
+    return pd.concat(parts).reindex(df["id"])
+
+
+def fingerprint(obj):
+    if isinstance(obj, pd.Series):
+        payload = "\n".join(obj.astype(str))
+    elif hasattr(obj, "_asdict"):
+        payload = json.dumps({k: (v.round(9) if v.dtype.kind == "f" else v).tolist() if isinstance(v, np.ndarray) else v
+                              for k, v in obj._asdict().items()}, default=str)
+    elif isinstance(obj, dict):
+        payload = json.dumps({k: np.round(v, 9).tolist() if isinstance(v, (float, tuple, np.floating)) else str(v)
+                              for k, v in sorted(obj.items())}, sort_keys=True)
+    else:
+        payload = json.dumps(obj, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def detection_stats(df, labels):
+    """Tỉ lệ sự kiện chèn vào có ít nhất 1 điểm bị loại (reject), và tỉ lệ điểm sạch bị loại nhầm."""
+    severity = labels.map({v: verdict_severity(v) for v in labels.unique()}).to_numpy()
+    rejected = severity == "reject"
+    out = {}
+    for kind in EVENT_KINDS:
+        rows = (df["event"] == kind).to_numpy()
+        events = df.loc[rows, "event_id"].to_numpy()
+        n_events = len(np.unique(events))
+        detected = len(np.unique(events[rejected[rows]]))
+        out[f"{kind}_events"] = n_events
+        out[f"{kind}_detection_rate"] = round(detected / n_events, 4) if n_events else None
+    clean = (df["event"] == "").to_numpy()
+    out["false_rejection_rate"] = round(float(rejected[clean].mean()), 5) if clean.any() else None
+    out["rule_counts"] = labels.value_counts().head(15).to_dict()
+    return out
+
+
+def render_lj(df):
+    fig = plot_levey_jennings(df, "Benchmark LJ")
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=100)
+    plt.close(fig)
+    return buf.getbuffer().nbytes
+
+
+def ep15_matrix(df):
+    """Ma trận EP15 (ngày x 5 lần lặp) từ mức 1 của chuỗi tổng hợp."""
+    values = df.loc[df["level"] == df["level"].min(), "value"].to_numpy()
+    days = max(len(values) // 5, 2)
+    values = np.resize(values, days * 5)
+    return values.reshape(days, 5).tolist()
+
+
+def benchmarks_for(df, args):
+    """(tên, hàm chạy, hàm tham chiếu hoặc None, hàm so khớp hoặc None, hàm phát hiện hoặc None)."""
+    n = len(df)
+    ref_ok = n <= args.reference_max
+    lj_df = df[["date", "level", "value", "target_mean", "target_sd", "lot_number"]]
+    matrix = ep15_matrix(df)
+    target = float(df.loc[df["level"] == df["level"].min(), "target_mean"].iloc[0])
+    return [
+        ("get_westgard_violations",
+         lambda: score_by_lot(df, get_westgard_violations),
+         (lambda: score_by_lot(df, reference.get_westgard_violations)) if ref_ok else None,
+         lambda cur, ref: {"rows_equal": round(float((cur.to_numpy() == ref.to_numpy()).mean()), 6),
+                           "rows_different": int((cur.to_numpy() != ref.to_numpy()).sum())},
+         lambda cur: detection_stats(df, cur)),
+        ("check_westgard_multi_level",
+         lambda: check_westgard_multi_level(lj_df),
+         (lambda: reference.check_westgard_multi_level(lj_df)) if ref_ok else None,
+         lambda cur, ref: {"identical": cur == ref, "messages": len(cur), "reference_messages": len(ref)},
+         None),
+        ("plot_levey_jennings", lambda: render_lj(lj_df), None, None, None),
+        ("prepare_levey_jennings", lambda: prepare_levey_jennings(lj_df), None, None, None),
+        ("calculate_clsi_ep15_a3_final",
+         lambda: calculate_clsi_ep15_a3_final(matrix, 1.0, 1.0, target), None, None, None),
+    ]
+
+
+def measure(fn, repeat):
+    """(thời gian tốt nhất, kết quả lần chạy cuối, bộ nhớ đỉnh MB của 1 lần chạy riêng dưới tracemalloc)."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        plt.close("all")
+    return best, result, peak / 2 ** 20
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare_baseline(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        old = {(r["benchmark"], r["n_points"]): r for r in json.load(f)["results"] if "seconds" in r}
+    rows = []
+    for r in results:
+        prev = old.get((r["benchmark"], r["n_points"]))
+        if prev is None or "seconds" not in r:
+            continue
+        rows.append({"benchmark": r["benchmark"], "n_points": r["n_points"],
+                     "speedup": round(prev["seconds"] / r["seconds"], 3) if r["seconds"] else None,
+                     "peak_memory_ratio": round(r["peak_memory_mb"] / prev["peak_memory_mb"], 3)
+                     if prev["peak_memory_mb"] else None,
+                     "same_output": prev["fingerprint"] == r["fingerprint"]})
+    return {"file": os.path.abspath(baseline_path), "cases": rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark các hàm phân tích QC (Westgard, LJ, EP15).")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="số điểm IQC mỗi ca")
+    parser.add_argument("--levels", type=int, default=3, choices=(1, 2, 3))
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--repeat", type=int, default=3, help="số lần đo, lấy thời gian tốt nhất")
+    parser.add_argument("--reference-max", type=int, default=5_000,
+                        help="chỉ chạy bản tham chiếu (chậm) khi cỡ dữ liệu <= giá trị này")
+    parser.add_argument("--only", nargs="+", help="chỉ chạy các benchmark có tên này")
+    parser.add_argument("--no-caps", action="store_true", help="bỏ giới hạn cỡ dữ liệu của từng benchmark")
+    parser.add_argument("--baseline", help="file JSON kết quả trước đó để so sánh")
+    parser.add_argument("--out", help="file JSON kết quả (mặc định benchmarks/results/bench_<thời gian>.json)")
+    args = parser.parse_args(argv)
+
+    # plot_levey_jennings gọi st.expander; chạy ngoài Streamlit chỉ sinh cảnh báo vô hại.
+    # Đọc config trước (lần đọc đầu đặt lại mức log) rồi mới hạ mức log.
+    streamlit_config.set_option("global.showWarningOnDirectExecution", False)
+    streamlit_logger.set_log_level(logging.ERROR)
+
+    results = []
+    for n in args.sizes:
+        df = make_iqc_series(n, n_levels=args.levels, seed=args.seed)
+        for name, fn, ref_fn, agree_fn, detect_fn in benchmarks_for(df, args):
+            if args.only and name not in args.only:
+                continue
+            record = {"benchmark": name, "n_points": n}
+            if not args.no_caps and n > CAPS.get(name, float("inf")):
+                record["skipped"] = f"n > {CAPS[name]} (dùng --no-caps để chạy)"
+                results.append(record)
+                print(f"{name:32s} n={n:>9,d}  bỏ qua")
+                continue
+            seconds, result, peak_mb = measure(fn, args.repeat if n <= 100_000 else 1)
+            record.update({"seconds": round(seconds, 6), "points_per_second": round(n / seconds, 1),
+                           "peak_memory_mb": round(peak_mb, 3), "fingerprint": fingerprint(result)})
+            if ref_fn is not None:
+                t0 = time.perf_counter()
+                ref_result = ref_fn()
+                record["reference_seconds"] = round(time.perf_counter() - t0, 6)
+                record["agreement"] = agree_fn(result, ref_result)
+            if detect_fn is not None:
+                record["detection"] = detect_fn(result)
+            results.append(record)
+            extra = f"  khớp tham chiếu: {record['agreement']}" if "agreement" in record else ""
+            print(f"{name:32s} n={n:>9,d}  {seconds:9.4f}s  {n / seconds:14,.0f} điểm/s  "
+                  f"{peak_mb:9.1f} MB{extra}")
+
+    output = {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "matplotlib": matplotlib.__version__,
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "levels": args.levels,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.baseline:
+        output["baseline"] = compare_baseline(results, args.baseline)
+        for row in output["baseline"]["cases"]:
+            print(f"so với baseline: {row['benchmark']:32s} n={row['n_points']:>9,d}  x{row['speedup']}  "
+                  f"{'cùng kết quả' if row['same_output'] else 'KẾT QUẢ KHÁC'}")
+
+    out = args.out or os.path.join(ROOT, "benchmarks", "results",
+                                   f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(output, f, ensure_ascii=False, indent=2, default=str)
+    print(f"Đã ghi {out}")
+    return output
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# File: benchmarks/synthetic.py
+"""
+Sinh chuỗi IQC tổng hợp có seed (chạy lại cho đúng cùng dữ liệu) để đo hiệu năng
+và khả năng phát hiện lỗi của các quy tắc Westgard.
+"""
+import numpy as np
+import pandas as pd
+
+EVENT_KINDS = ("shift", "trend", "spike")
+
+# Nồng độ gốc của từng mức QC (mức thấp / bình thường / cao)
+BASE_MEANS = {1: 80.0, 2: 150.0, 3: 300.0}
+
+
+def make_iqc_series(n_points, n_levels=3, seed=0, runs_per_day=2, lot_runs=400,
+                    shift_rate=0.004, trend_rate=0.003, spike_rate=0.003):
+    """
+    DataFrame IQC khoảng n_points dòng, sắp theo (date, level), gồm các cột
+    id, date, level, lot_id, lot_set, lot_number, value, target_mean, target_sd, event, event_id.
+
+    - Mỗi lượt chạy có đủ n_levels mức (1-3); runs_per_day lượt mỗi ngày.
+    - Cứ lot_runs lượt chạy thì đổi lot cho mọi mức (lot_set tăng 1, mean/SD mới).
+    - Lỗi chèn vào với xác suất *_rate cho mỗi lượt chạy, không chồng lên nhau:
+        shift: lệch ±1.5-2.5 SD trên mọi mức trong 8-25 lượt
+        trend: trôi tuyến tính tới ±3 SD trên mọi mức trong 8-15 lượt
+        spike: 1 điểm của 1 mức lệch ±3.5-5 SD
+      event = loại lỗi của dòng ('' nếu không có), event_id = số thứ tự sự kiện (-1 nếu không có).
+    """
+    rng = np.random.default_rng(seed)
+    levels = np.arange(1, n_levels + 1)
+    n_runs = -(-int(n_points) // n_levels)
+
+    # Thông số lot: mean lệch ±10% quanh nồng độ gốc, CV 2-5%
+    lot_set = np.arange(n_runs) // lot_runs
+    n_lots = lot_set[-1] + 1
+    lot_means = np.array([BASE_MEANS[l] for l in levels]) * rng.uniform(0.9, 1.1, (n_lots, n_levels))
+    lot_sds = lot_means * rng.uniform(0.02, 0.05, (n_lots, n_levels))
+
+    z = rng.standard_normal((n_runs, n_levels))
+    event = np.full((n_runs, n_levels), "", dtype=object)
+    event_id = np.full((n_runs, n_levels), -1)
+
+    # Chọn điểm bắt đầu sự kiện rồi bỏ các sự kiện chồng lên sự kiện trước
+    rates = np.array([shift_rate, trend_rate, spike_rate])
+    draw = rng.random(n_runs)
+    kinds = np.searchsorted(np.cumsum(rates), draw, side="right")
+    starts = np.flatnonzero(kinds < len(EVENT_KINDS))
+    next_free, eid = 0, 0
+    for start in starts:
+        if start < next_free:
+            continue
+        kind = EVENT_KINDS[kinds[start]]
+        sign = rng.choice([-1.0, 1.0])
+        if kind == "shift":
+            length = int(rng.integers(8, 26))
+            rows = slice(start, min(start + length, n_runs))
+            z[rows] += sign * rng.uniform(1.5, 2.5)
+            cols = slice(None)
+        elif kind == "trend":
+            length = int(rng.integers(8, 16))
+            rows = slice(start, min(start + length, n_runs))
+            span = rows.stop - rows.start
+            z[rows] += (sign * np.linspace(3.0 / span, 3.0, span))[:, None]
+            cols = slice(None)
+        else:
+            length = 1
+            rows = slice(start, start + 1)
+            cols = int(rng.integers(0, n_levels))
+            z[rows, cols] += sign * rng.uniform(3.5, 5.0)
+        event[rows, cols] = kind
+        event_id[rows, cols] = eid
+        eid += 1
+        next_free = start + length
+
+    run = np.arange(n_runs)
+    day = run // runs_per_day
+    hour = 8 + (run % runs_per_day) * max(1, 12 // runs_per_day)
+    run_dates = pd.Timestamp("2020-01-01") + pd.to_timedelta(day, unit="D") + pd.to_timedelta(hour, unit="h")
+
+    means = lot_means[lot_set]
+    sds = lot_sds[lot_set]
+    df = pd.DataFrame({
+        "date": np.repeat(run_dates.values, n_levels),
+        "level": np.tile(levels, n_runs),
+        "lot_set": np.repeat(lot_set, n_levels),
+        "value": (means + sds * z).ravel(),
+        "target_mean": means.ravel(),
+        "target_sd": sds.ravel(),
+        "event": event.ravel(),
+        "event_id": event_id.ravel(),
+    }).iloc[:int(n_points)]
+    df.insert(0, "id", np.arange(1, len(df) + 1))
+    df.insert(3, "lot_id", df["lot_set"] * n_levels + df["level"])
+    df.insert(5, "lot_number", "L" + df["lot_set"].astype(str).str.zfill(4) + "-" + df["level"].astype(str))
+    return df
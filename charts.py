@@ -0,0 +1,286 @@
+# File: charts.py
+# Các hàm vẽ biểu đồ dùng chung cho giao diện, báo cáo và benchmarks (không chạy giao diện khi import).
+from collections import namedtuple
+
+import matplotlib.dates as mdates
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+import pandas as pd
+import streamlit as st
+
+from render_cache import cached_render
+from westgard import check_westgard_multi_level, westgard_bitmask
+
+# Các cột plot_levey_jennings dùng: khóa bộ nhớ đệm ảnh chỉ tính các cột này
+LJ_COLUMNS = ["date", "level", "value", "target_mean", "target_sd", "lot_number", "ewma", "drift"]
+LJ_FIGSIZE = (11, 6)
+LJ_LEVEL_COLORS = {1: 'blue', 2: 'orange', 3: 'red'}
+# Mỗi cột pixel của trục X giữ tối đa 4 điểm / mức (đầu, cuối, thấp nhất, cao nhất)
+POINTS_PER_PIXEL = 4
+
+
+def plot_levey_jennings(df, title, show_legend=True, rules=None, decimate=True):
+    """
+    Vẽ biểu đồ Levey-Jennings dựa trên Z-Score.
+    Đã xử lý lỗi thiếu cột và định dạng ngày tháng hiển thị sai.
+    rules: bộ quy tắc Westgard của test (điểm vi phạm luôn được giữ khi giảm điểm, xem decimate_lj).
+    """
+    width_px = int(LJ_FIGSIZE[0] * plt.rcParams['figure.dpi']) if decimate else None
+    fig, violations = _draw_levey_jennings(df, title, show_legend, rules, width_px)
+    show_multi_level_warnings(violations)
+    return fig
+
+
+def render_levey_jennings(df, title, show_legend=True, fmt="png", dpi=200, rules=None, decimate=True):
+    """
+    Như plot_levey_jennings nhưng trả về ảnh (bytes PNG/SVG) qua render_cache: dữ liệu, tiêu đề và tùy chọn
+    không đổi thì không vẽ lại. Cảnh báo 6x/9x/12x được lưu kèm ảnh và vẫn hiển thị mỗi lần gọi.
+    Số điểm vẽ được giới hạn theo chiều rộng ảnh (LJ_FIGSIZE x dpi pixel).
+    """
+    if df.empty:
+        return None
+    used = df[[c for c in LJ_COLUMNS if c in df.columns]]
+    width_px = int(LJ_FIGSIZE[0] * dpi) if decimate else None
+    rules_key = rules if rules is None or isinstance(rules, str) else tuple(rules)
+    image, violations = cached_render("levey_jennings", (used, title, show_legend, rules_key, width_px),
+                                      lambda: _draw_levey_jennings(used, title, show_legend, rules, width_px),
+                                      fmt=fmt, dpi=dpi)
+    show_multi_level_warnings(violations or [])
+    return image
+
+
+def lj_frame(df):
+    """Bản sao df với cột date dạng datetime (dayfirst), bỏ dòng không có ngày, sắp xếp theo ngày."""
+    df = df.copy()
+    # Sử dụng dayfirst=True để tránh lỗi đảo ngược ngày/tháng
+    df['date'] = pd.to_datetime(df['date'], dayfirst=True, errors='coerce')
+    df = df.dropna(subset=['date'])
+    # Sắp xếp toàn bộ dataframe theo ngày để tránh đường nối bị nhảy ngược
+    return df.sort_values('date')
+
+
+# Dữ liệu đã sẵn sàng để vẽ của biểu đồ LJ (prepare_levey_jennings); các mảng điểm xếp theo (mức, ngày)
+LJPlotData = namedtuple("LJPlotData", [
+    "x",            # ngày dạng số của matplotlib (mdates.date2num)
+    "z",            # z-score, NaN nếu giá trị lỗi (điểm không được vẽ)
+    "level",        # mức của từng điểm
+    "ewma",         # EWMA đơn vị z hoặc None nếu không có cột ewma
+    "drift",        # mảng bool: điểm có nhãn báo trôi EWMA/CUSUM
+    "lot_x",        # ngày đổi lot (đã bỏ trùng)
+    "lot_labels",   # nhãn lot tương ứng
+    "x_max",        # ngày cuối cùng của dữ liệu vẽ (đặt nhãn ±SD)
+    "violations",   # cảnh báo 6x/9x/12x trên toàn bộ dữ liệu
+])
+
+
+def _raw_z_scores(df):
+    if 'target_mean' not in df.columns or 'target_sd' not in df.columns:
+        return np.zeros(len(df))
+    values = pd.to_numeric(df['value'], errors='coerce').to_numpy(dtype=float)
+    mean = pd.to_numeric(df['target_mean'], errors='coerce').to_numpy(dtype=float)
+    sd = pd.to_numeric(df['target_sd'], errors='coerce').to_numpy(dtype=float)
+    # Tránh chia cho 0 nếu SD chưa được thiết lập
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(sd > 0, (values - mean) / sd, 0.0)
+
+
+def lj_z_scores(df):
+    """z = (value - target_mean) / target_sd của từng dòng; 0 khi thiếu cột, sd <= 0 hoặc giá trị lỗi."""
+    z = _raw_z_scores(df)
+    return np.where(np.isfinite(z), z, 0.0)
+
+
+def lot_changes(df):
+    """
+    Mảng bool các dòng bắt đầu 1 lot mới trong mức của nó (df đã sắp theo ngày): lot khác dòng trước
+    cùng mức, kể cả dòng đầu của mức; bỏ dòng không có lot.
+    """
+    if 'lot_number' not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+    lots = df['lot_number'].astype(object)
+    has_lot = lots.notna()
+    # NaN != NaN: so sánh trên chuỗi để các dòng không có lot không bị tính là đổi lot
+    key = lots.where(has_lot, '').astype(str)
+    previous = key.groupby(df['level'].to_numpy()).shift()
+    return (has_lot & key.ne(previous)).to_numpy()
+
+
+def prepare_levey_jennings(df, rules=None, width_px=None):
+    """
+    Chuẩn bị dữ liệu vẽ LJ hoàn toàn vector hóa: lj_frame, giảm điểm theo width_px (decimate_lj),
+    z-score 1 biểu thức mảng, ngày đổi lot bằng so sánh với dòng trước. Chỉ lấy mức 1-3.
+    Trả về LJPlotData, hoặc None nếu không có dòng nào có ngày hợp lệ.
+    """
+    full = lj_frame(df)
+    if full.empty:
+        return None
+    violations = check_westgard_multi_level(full)
+    shown = decimate_lj(full, width_px, rules)
+    shown = shown[shown['level'].isin(list(LJ_LEVEL_COLORS))]
+    x_max = mdates.date2num(shown['date'].max()) if len(shown) else mdates.date2num(full['date'].max())
+
+    # Đổi lot: trên dữ liệu theo ngày, bỏ các mốc trùng ngày đầu tiên và trùng (ngày, lot) giữa các mức
+    lot_x, lot_labels = np.array([]), []
+    if 'lot_number' in shown.columns:
+        changes = shown[lot_changes(shown) & (shown['date'] != shown['date'].min()).to_numpy()]
+        changes = changes.drop_duplicates(subset=['date', 'lot_number'])
+        lot_x, lot_labels = mdates.date2num(changes['date']), changes['lot_number'].astype(str).tolist()
+
+    # Các điểm xếp theo mức (ổn định nên vẫn theo ngày trong từng mức)
+    shown = shown.iloc[np.argsort(shown['level'].to_numpy(), kind='stable')]
+    ewma = None
+    if 'ewma' in shown.columns and shown['ewma'].notna().any():
+        ewma = pd.to_numeric(shown['ewma'], errors='coerce').to_numpy(dtype=float)
+    drift = (shown['drift'].fillna('').astype(str) != '').to_numpy() if 'drift' in shown.columns \
+        else np.zeros(len(shown), dtype=bool)
+    return LJPlotData(
+        x=mdates.date2num(shown['date']),
+        z=_raw_z_scores(shown),
+        level=shown['level'].to_numpy(),
+        ewma=ewma,
+        drift=drift,
+        lot_x=lot_x,
+        lot_labels=lot_labels,
+        x_max=x_max,
+        violations=violations,
+    )
+
+
+def decimate_lj(df, width_px, rules=None):
+    """
+    Giảm số điểm của biểu đồ LJ (df đã sắp theo date, cột date dạng datetime) theo chiều rộng width_px:
+    mỗi mức chia trục thời gian thành width_px cột pixel, mỗi cột giữ điểm đầu, cuối, z thấp nhất và cao nhất
+    (đường nối vẽ ra giống hệt ở độ phân giải đó). Luôn giữ điểm vi phạm Westgard (theo `rules`),
+    điểm báo trôi (cột drift) và 2 điểm hai bên mỗi lần đổi lot. Mức có ít điểm hơn ngân sách giữ nguyên.
+    Trả về df con (giữ index và thứ tự).
+    """
+    n = len(df)
+    levels = df['level'].to_numpy()
+    if not width_px or n == 0 or np.unique(levels, return_counts=True)[1].max() <= POINTS_PER_PIXEL * width_px:
+        return df
+    z = lj_z_scores(df)
+    t = df['date'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    span = max(int(t.max() - t.min()), 1)
+    bucket = np.minimum(((t - t.min()) / span * width_px).astype(np.int64), width_px - 1)
+    level_code = pd.factorize(levels)[0]
+    key = level_code * width_px + bucket
+    pos = np.arange(n)
+
+    keep = np.zeros(n, dtype=bool)
+    # Đầu/cuối theo thời gian và z thấp/cao nhất của mỗi (mức, cột pixel)
+    for order in (np.lexsort((pos, key)), np.lexsort((z, key))):
+        sorted_key = key[order]
+        first = np.ones(n, dtype=bool)
+        first[1:] = sorted_key[1:] != sorted_key[:-1]
+        last = np.ones(n, dtype=bool)
+        last[:-1] = first[1:]
+        keep[order[first | last]] = True
+
+    # Điểm vi phạm Westgard / báo trôi
+    keep |= westgard_bitmask(df, None, None, rules, z=z).to_numpy() != 0
+    if 'drift' in df.columns:
+        keep |= df['drift'].fillna('').astype(str).to_numpy() != ''
+
+    # Hai điểm hai bên mỗi lần đổi lot trong từng mức
+    if 'lot_number' in df.columns:
+        lots = df['lot_number'].astype(object)
+        previous = lots.groupby(level_code).shift()
+        change = (lots.ne(previous) & previous.notna()).to_numpy()
+        before = pd.Series(pos).groupby(level_code).shift().to_numpy()
+        keep |= change
+        keep[before[change].astype(np.int64)] = True
+    return df[keep]
+
+
+def show_multi_level_warnings(violations):
+    # Hiển thị kết quả kiểm tra Westgard trực tiếp dưới biểu đồ bằng Streamlit
+    if violations:
+        with st.expander("🚨 CẢNH BÁO QUY TẮC WESTGARD (6x, 9x, 12x)", expanded=True):
+            for v in violations[-5:]: # Hiển thị 5 lỗi gần nhất
+                st.write(v)
+
+
+def _draw_levey_jennings(df, title, show_legend=True, rules=None, width_px=None):
+    """
+    (Figure, danh sách cảnh báo 6x/9x/12x) của biểu đồ LJ, không gọi Streamlit; df rỗng -> (None, []).
+    width_px: giảm số điểm vẽ theo chiều rộng (decimate_lj); cảnh báo luôn tính trên toàn bộ dữ liệu.
+    Dữ liệu lấy từ prepare_levey_jennings; mỗi lớp (đường nối, điểm, EWMA, đổi lot) vẽ bằng 1 lệnh.
+    """
+    if df.empty:
+        return None, []
+    data = prepare_levey_jennings(df, rules, width_px)
+    if data is None:
+        return None, []
+
+    fig, ax = plt.subplots(figsize=LJ_FIGSIZE)
+
+    # 1. Vẽ các vùng giới hạn SD (Duy trì các đường nằm ngang cố định tại Z = 0, 1, 2, 3)
+    ax.axhline(0, color='green', lw=2, label='Mean (Target)')
+    sd_config = {
+        1: {'color': 'gold', 'label': '±1SD'},
+        2: {'color': 'red', 'label': '±2SD (Warning)'},
+        3: {'color': 'black', 'label': '±3SD (Reject)'}
+    }
+    for sd, config in sd_config.items():
+        ax.axhline(sd, color=config['color'], ls='--', alpha=0.6, lw=1)
+        ax.axhline(-sd, color=config['color'], ls='--', alpha=0.6, lw=1)
+        # Ghi chú nhãn ở mép phải biểu đồ (sử dụng ngày cuối cùng trong dữ liệu)
+        ax.text(data.x_max, sd, f" +{sd}SD", va='center', fontsize=8, color=config['color'])
+        ax.text(data.x_max, -sd, f" -{sd}SD", va='center', fontsize=8, color=config['color'])
+
+    # 2. Dữ liệu từng Level: đường nối (LineCollection), điểm (1 scatter), EWMA, báo trôi
+    levels = [lvl for lvl in LJ_LEVEL_COLORS if (data.level == lvl).any()]
+    bounds = {lvl: np.flatnonzero(data.level == lvl)[[0, -1]] for lvl in levels}
+    xz = np.column_stack([data.x, data.z])
+    colors = [LJ_LEVEL_COLORS[lvl] for lvl in levels]
+    ax.add_collection(LineCollection([xz[a:b + 1] for a, b in bounds.values()], colors=colors,
+                                     alpha=0.4, lw=1.5, zorder=2))
+    point_colors = pd.Series(data.level).map(LJ_LEVEL_COLORS).to_numpy()
+    ax.scatter(data.x, data.z, c=point_colors, s=40, edgecolors='white', zorder=4)
+    handles = [Line2D([], [], ls='', marker='o', markersize=7, color=c, markeredgecolor='white', label=f"Level {lvl}")
+               for lvl, c in zip(levels, colors)]
+
+    # EWMA (đơn vị z) và các điểm báo trôi EWMA/CUSUM nếu có (db_module.get_iqc_verdicts_by_lot + drift.py)
+    if data.ewma is not None:
+        xe = np.column_stack([data.x, data.ewma])
+        ax.add_collection(LineCollection([xe[a:b + 1] for a, b in bounds.values()], colors=colors,
+                                         linestyles='--', lw=1.2, alpha=0.8, zorder=3))
+        handles += [Line2D([], [], ls='--', lw=1.2, color=c, label=f"EWMA Level {lvl}")
+                    for lvl, c in zip(levels, colors) if np.isfinite(data.ewma[data.level == lvl]).any()]
+    if data.drift.any():
+        ax.scatter(data.x[data.drift], data.z[data.drift], marker='D', s=110, facecolors='none',
+                   edgecolors='purple', linewidths=1.5, label='Báo trôi EWMA/CUSUM', zorder=5)
+
+    # 3. Đánh dấu thay đổi Lot (nhãn chỉ vẽ 1 lần cho mỗi ngày đổi lot)
+    if len(data.lot_x):
+        ax.vlines(data.lot_x, 0, 1, transform=ax.get_xaxis_transform(), color='gray', ls=':', alpha=0.4, zorder=1)
+        for lx, label in zip(data.lot_x, data.lot_labels):
+            ax.text(lx, 3.8, f" Lot: {label}", rotation=90, fontsize=7, color='gray', va='top')
+    ax.autoscale_view()
+
+    # 4. CẤU HÌNH ĐỊNH DẠNG NGÀY THÁNG (SỬA LỖI HIỂN THỊ)
+    # Định dạng trục X hiển thị: Ngày/Tháng Giờ:Phút
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%d/%m'))
+
+    # Thiết lập khoảng cách chia (tự động điều chỉnh để không quá dày)
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+
+    ax.set_ylim(-4.5, 4.5)
+    ax.set_ylabel("Z-Score (Độ lệch chuẩn)")
+    ax.set_xlabel("Thời gian thực hiện")
+    ax.set_title(title, fontweight='bold', pad=15)
+
+    # Tự động xoay ngày tháng trên trục X và căn chỉnh
+    fig.autofmt_xdate(rotation=30, ha='right')
+
+    if show_legend:
+        ax_handles, ax_labels = ax.get_legend_handles_labels()
+        # Thứ tự: Mean, các Level, EWMA, Báo trôi
+        by_label = dict(zip(ax_labels[:1] + [h.get_label() for h in handles] + ax_labels[1:],
+                            ax_handles[:1] + handles + ax_handles[1:]))
+        ax.legend(by_label.values(), by_label.keys(), loc='upper left', bbox_to_anchor=(1, 1))
+
+    plt.tight_layout()
+    return fig, data.violations
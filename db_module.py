@@ -1,24 +1,311 @@
 # File: db_module.py
 import streamlit as st
-from supabase import create_client
+from supabase import create_client, ClientOptions
 import pandas as pd
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import numpy as np
+import threading
+import time
+from collections import OrderedDict
+import importlib.util
+import httpx
+
+from westgard import LevelStream, PASS_LABEL, RULE_SETS, DEFAULT_RULE_SET, get_westgard_violations
+from drift import DriftStream, add_drift_columns, dump_drift_params, parse_drift_params
+
+# --- BỘ NHỚ ĐỆM DỮ LIỆU THAM CHIẾU (tests, lots, mapping, settings) ---
+# Dùng chung cho cả tiến trình: mỗi lần Streamlit rerun tạo DBManager mới
+# nhưng vẫn dùng lại được kết quả đã lấy, tránh gọi lại HTTP giống hệt nhau.
+# Mỗi mục: key -> (thời điểm hết hạn, tập bảng phụ thuộc, danh sách dòng)
+_READ_CACHE = {}
+_READ_CACHE_LOCK = threading.Lock()
+
+# --- BỘ NHỚ ĐỆM KẾT QUẢ WESTGARD THEO LOT ---
+# key: (DB, lot_id, data_version, mean, sd, bộ quy tắc, thông số EWMA/CUSUM) -> DataFrame của get_iqc_verdicts_by_lot.
+# lots.data_version do trigger tăng khi iqc_results của lot bị thêm/sửa/xóa (kể cả từ tiến trình khác),
+# nên mục cũ không bao giờ được dùng lại sau khi dữ liệu đổi; chỉ cần giới hạn số mục.
+_VERDICT_CACHE = OrderedDict()
+_VERDICT_CACHE_LOCK = threading.Lock()
+VERDICT_CACHE_SIZE = 256
+
+# --- SUPABASE CLIENT DÙNG CHUNG CHO CẢ TIẾN TRÌNH ---
+# Mỗi lần rerun Streamlit (và import_tool) chỉ lấy lại client đã tạo, giữ kết nối keep-alive
+# nên không phải bắt tay TCP/TLS lại sau mỗi thao tác trên giao diện.
+# Mỗi mục: (url, key) -> {"client": Client, "transport": _PooledTransport}
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+class _PooledTransport(httpx.HTTPTransport):
+    """
+    HTTPTransport có pool kết nối keep-alive, thử lại có giới hạn (backoff lũy thừa)
+    cho các request đọc GET/HEAD khi lỗi mạng hoặc 502/503/504, và đếm thống kê.
+    Request ghi (POST/PATCH/DELETE) không bao giờ tự gửi lại.
+    """
+    RETRY_STATUS = (502, 503, 504)
+
+    def __init__(self, read_retries=2, backoff=0.5, **kwargs):
+        # retries=1 của httpx chỉ áp dụng khi chưa kết nối được (an toàn cho mọi method)
+        super().__init__(retries=1, **kwargs)
+        self.read_retries = read_retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "errors": 0, "connections_opened": 0, "tls_handshakes": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _trace(self, event_name, info):
+        # Sự kiện của httpcore: mỗi kết nối mới / mỗi lần bắt tay TLS
+        if event_name == "connection.connect_tcp.complete":
+            self._count("connections_opened")
+        elif event_name == "connection.start_tls.complete":
+            self._count("tls_handshakes")
+
+    def handle_request(self, request):
+        self._count("requests")
+        request.extensions["trace"] = self._trace
+        attempts = 1 + (self.read_retries if request.method in ("GET", "HEAD") else 0)
+        for attempt in range(attempts):
+            if attempt:
+                self._count("retries")
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = super().handle_request(request)
+            except httpx.TransportError:
+                self._count("errors")
+                if attempt == attempts - 1:
+                    raise
+                continue
+            if response.status_code in self.RETRY_STATUS and attempt < attempts - 1:
+                # Đọc hết body để kết nối được trả về pool thay vì bị đóng
+                response.read()
+                response.close()
+                continue
+            return response
+
+    def pool_state(self):
+        conns = list(self._pool.connections)
+        return {"open_connections": len(conns), "idle_connections": sum(1 for c in conns if c.is_idle())}
+
+def get_supabase_client(url, key, settings=None):
+    """
+    Trả về Supabase client dùng chung cho cả tiến trình theo (url, key), tạo lần đầu khi cần.
+    App chỉ dùng API key (không đăng nhập theo người dùng) nên chia sẻ client giữa các session là an toàn.
+    settings: bảng [supabase] trong secrets, các khóa tùy chọn:
+        connect_timeout (5s), read_timeout (30s), max_connections (20),
+        max_keepalive (10), keepalive_expiry (60s), read_retries (2), retry_backoff (0.5s)
+    """
+    cfg = dict(settings or {})
+    with _CLIENTS_LOCK:
+        entry = _CLIENTS.get((url, key))
+        if entry is None:
+            transport = _PooledTransport(
+                read_retries=int(cfg.get("read_retries", 2)),
+                backoff=float(cfg.get("retry_backoff", 0.5)),
+                http2=importlib.util.find_spec("h2") is not None,
+                limits=httpx.Limits(max_connections=int(cfg.get("max_connections", 20)),
+                                    max_keepalive_connections=int(cfg.get("max_keepalive", 10)),
+                                    keepalive_expiry=float(cfg.get("keepalive_expiry", 60))))
+            http_client = httpx.Client(
+                transport=transport, follow_redirects=True,
+                timeout=httpx.Timeout(float(cfg.get("read_timeout", 30)),
+                                      connect=float(cfg.get("connect_timeout", 5))))
+            client = create_client(url, key, options=ClientOptions(
+                httpx_client=http_client, auto_refresh_token=False, persist_session=False))
+            entry = _CLIENTS[(url, key)] = {"client": client, "transport": transport}
+        return entry["client"]
+
+def get_pool_stats():
+    """Thống kê của các client dùng chung: số request, số lần thử lại, kết nối/TLS mới, kết nối đang mở."""
+    with _CLIENTS_LOCK:
+        entries = list(_CLIENTS.items())
+    result = {}
+    for (url, _), entry in entries:
+        transport = entry["transport"]
+        with transport._lock:
+            stats = dict(transport.stats)
+        stats.update(transport.pool_state())
+        result[url] = stats
+    return result
+
+def _parse_dates(values):
+    """
+    Chuyển cột ngày sang datetime64 một lần cho cả cột.
+    Thử định dạng ISO trước (nhanh), các giá trị còn lại mới parse từng kiểu (mixed).
+    """
+    values = pd.Series(values)
+    parsed = pd.to_datetime(values, format='ISO8601', errors='coerce')
+    if getattr(parsed.dt, 'tz', None) is not None:
+        parsed = parsed.dt.tz_localize(None)
+    retry = parsed.isna() & values.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(values[retry].astype(str), format='mixed', dayfirst=True, errors='coerce')
+    return parsed
+
+
+def _scored_fields_changed(before, dt, level, value):
+    """
+    Sửa 1 dòng IQC có làm đổi dữ liệu dùng để chấm Westgard không (ngày tới giây, mức, giá trị).
+    before: dòng cũ (dict có date, level, value). Chỉ sửa ghi chú thì không cần chấm lại lot.
+    """
+    old_date, new_date = _parse_dates([before.get('date'), dt]).dt.floor('s')
+    old_value, new_value = pd.to_numeric(pd.Series([before.get('value'), value]), errors='coerce')
+    same_date = old_date == new_date or (pd.isna(old_date) and pd.isna(new_date))
+    same_value = old_value == new_value or (pd.isna(old_value) and pd.isna(new_value))
+    return not (same_date and same_value and str(before.get('level')) == str(level))
+
+# --- KIỂU DỮ LIỆU CỦA CÁC DATAFRAME TRẢ VỀ ---
+# Ép kiểu 1 lần ngay tại DBManager để phía giao diện không phải parse lại ngày / ép số nhiều lần.
+# "datetime": datetime64[ns] (parse ISO trước), "category": chuỗi lặp lại nhiều (số lot, mã chương trình).
+# Số nguyên có giá trị rỗng dùng kiểu nullable tương ứng (Int8/Int64).
+FRAME_SCHEMAS = {
+    "iqc_results": {"id": "int64", "lot_id": "int64", "date": "datetime", "level": "int8", "value": "float64",
+                    "lot_number": "category", "test_name": "category"},
+    "lots": {"id": "int64", "test_id": "int64", "level": "int8", "mean": "float64", "sd": "float64",
+             "lot_number": "category", "data_version": "int64"},
+    "eqa_results": {"id": "int64", "test_id": "int64", "date": "datetime", "lab_value": "float64",
+                    "ref_value": "float64", "sd_group": "float64", "sdi": "float64", "program_name": "category"},
+    "qc_status": {"test_id": "int64", "level": "int8", "lot_id": "int64", "last_run": "datetime",
+                  "last_value": "float64", "open_rejections": "int64", "updated_at": "datetime"},
+}
+
+def coerce_frame(df, table):
+    """Ép các cột của df theo FRAME_SCHEMAS[table] (bỏ qua cột không có). Gọi lại nhiều lần vẫn an toàn."""
+    if df is None or df.empty:
+        return df
+    for col, kind in FRAME_SCHEMAS.get(table, {}).items():
+        if col not in df.columns:
+            continue
+        s = df[col]
+        if kind == "datetime":
+            if not pd.api.types.is_datetime64_any_dtype(s):
+                s = _parse_dates(s.values)
+            df[col] = s.astype("datetime64[ns]").values
+        elif kind == "category":
+            if not isinstance(s.dtype, pd.CategoricalDtype):
+                df[col] = s.astype("category")
+        elif kind == "float64":
+            df[col] = pd.to_numeric(s, errors="coerce").astype("float64")
+        else:
+            num = pd.to_numeric(s, errors="coerce")
+            df[col] = num.astype(kind if num.notna().all() else kind.capitalize())
+    return df
+
+def _date_window(d_start=None, d_end=None):
+    """Chuyển khoảng ngày [d_start, d_end] thành cặp chuỗi (từ ngày, trước ngày) để so sánh với cột date."""
+    date_from = d_start.strftime('%Y-%m-%d') if d_start else None
+    date_before = (d_end + timedelta(days=1)).strftime('%Y-%m-%d') if d_end else None
+    return date_from, date_before
+
+def _aggregate_iqc_frame(df, by_lot=False):
+    """
+    Tính tổng hợp theo level (và lot) từ các dòng IQC đã đọc về:
+    n, sum, sumsq, min/max giá trị và bản đã lọc 3SD (n_clean, sum_clean, sumsq_clean).
+    Cùng cấu trúc với kết quả RPC iqc_level_stats trên Postgres.
+    """
+    cols = ['level', 'lot_id', 'lot_number', 'n', 'sum', 'sumsq', 'min_value', 'max_value',
+            'n_clean', 'sum_clean', 'sumsq_clean', 'first_date', 'last_date']
+    if df is None or df.empty:
+        return pd.DataFrame(columns=cols)
+    df = df.assign(v=pd.to_numeric(df['value'], errors='coerce')).dropna(subset=['v', 'date'])
+    if df.empty:
+        return pd.DataFrame(columns=cols)
+    keys = ['level', 'lot_id'] if by_lot else ['level']
+    grp = df.groupby(keys)['v']
+    mean, sd = grp.transform('mean'), grp.transform('std')
+    df['v_clean'] = df['v'].where((df['v'] >= mean - 3*sd) & (df['v'] <= mean + 3*sd))
+    df['v2'], df['v2_clean'] = df['v'] ** 2, df['v_clean'] ** 2
+    out = df.groupby(keys).agg(
+        lot_number=('lot_number', 'first'), n=('v', 'count'), sum=('v', 'sum'), sumsq=('v2', 'sum'),
+        min_value=('v', 'min'), max_value=('v', 'max'),
+        n_clean=('v_clean', 'count'), sum_clean=('v_clean', 'sum'), sumsq_clean=('v2_clean', 'sum'),
+        first_date=('date', 'min'), last_date=('date', 'max')).reset_index()
+    if not by_lot:
+        out['lot_id'], out['lot_number'] = None, None
+    return out[cols]
+
+def _mean_sd(n, total, sumsq):
+    mean = total / n
+    return mean, np.sqrt(max(sumsq - total * mean, 0.0) / (n - 1))
+
+def stats_from_sums(row):
+    """
+    Dựng lại kết quả giống get_clean_stats_3sigma (n, mean, sd, cv, outliers)
+    từ 1 dòng tổng hợp n/sum/sumsq. Trả về None nếu không đủ 2 giá trị.
+    """
+    n = int(row['n'])
+    if n < 2:
+        return None
+    mean, sd = _mean_sd(n, row['sum'], row['sumsq'])
+    if row['min_value'] == row['max_value']:
+        return {'n': n, 'mean': mean, 'sd': 0, 'cv': 0.0001, 'outliers': 0}
+    n_clean = int(row['n_clean'])
+    if n_clean < 2:
+        return {'n': n, 'mean': mean, 'sd': sd, 'cv': (sd / mean) * 100 if mean != 0 else 0, 'outliers': 0}
+    mean_c, sd_c = _mean_sd(n_clean, row['sum_clean'], row['sumsq_clean'])
+    return {'n': n_clean, 'mean': mean_c, 'sd': sd_c,
+            'cv': (sd_c / mean_c) * 100 if mean_c != 0 else 0, 'outliers': n - n_clean}
 
 class DBManager:
+    # Thời gian sống (giây) của một mục trong bộ nhớ đệm đọc
+    CACHE_TTL = 60
+    # Số dòng tối đa cho mỗi lần insert nhiều dòng
+    IMPORT_CHUNK_SIZE = 500
+    # Số dòng mỗi trang khi đọc lịch sử IQC (không vượt giới hạn max-rows 1000 của PostgREST)
+    STREAM_PAGE_SIZE = 1000
+    # Các cột iqc_results mà màn hình biểu đồ/thống kê thực sự dùng
+    IQC_COLUMNS = ("id", "lot_id", "date", "level", "value", "note", "action")
+
     def __init__(self):
-        # Kết nối qua HTTP API (Lấy từ Streamlit Secrets)
+        # Kết nối qua HTTP API (Lấy từ Streamlit Secrets), client dùng chung cho cả tiến trình
         try:
-            self.url = st.secrets["supabase"]["url"]
-            self.key = st.secrets["supabase"]["key"]
-            self.supabase = create_client(self.url, self.key)
+            cfg = st.secrets["supabase"]
+            self.url = cfg["url"]
+            self.key = cfg["key"]
+            self.supabase = get_supabase_client(self.url, self.key, cfg)
         except Exception as e:
             st.error(f"Lỗi cấu hình Secrets: {e}")
+
+    # --- BỘ NHỚ ĐỆM ĐỌC ---
+    def _cached_rows(self, tables, key, fetch):
+        """
+        Trả về danh sách dòng từ bộ nhớ đệm nếu còn hạn, ngược lại gọi fetch().
+        tables: các bảng mà kết quả phụ thuộc (dùng để xóa khi có thao tác ghi).
+        Lỗi từ fetch() được đẩy ra ngoài và không được lưu vào bộ nhớ đệm.
+        """
+        full_key = (getattr(self, 'url', None), key)
+        now = time.monotonic()
+        with _READ_CACHE_LOCK:
+            hit = _READ_CACHE.get(full_key)
+            if hit is not None and hit[0] > now:
+                return [dict(r) for r in hit[2]]
+        rows = fetch()
+        with _READ_CACHE_LOCK:
+            _READ_CACHE[full_key] = (now + self.CACHE_TTL, frozenset(tables), [dict(r) for r in rows])
+        return rows
+
+    def _invalidate(self, *tables):
+        """Xóa các mục bộ nhớ đệm phụ thuộc vào bất kỳ bảng nào được ghi."""
+        changed = set(tables)
+        with _READ_CACHE_LOCK:
+            for k in [k for k, v in _READ_CACHE.items() if v[1] & changed]:
+                del _READ_CACHE[k]
+
+    def clear_cache(self):
+        with _READ_CACHE_LOCK:
+            _READ_CACHE.clear()
+        with _VERDICT_CACHE_LOCK:
+            _VERDICT_CACHE.clear()
+
     def get_setting(self, key, default=None):
         try:
-            response = self.supabase.table("settings").select("value").eq("key", key).execute()
-            if response.data:
-                return response.data[0]['value']
+            rows = self._cached_rows(
+                ["settings"], ("settings", key),
+                lambda: self.supabase.table("settings").select("value").eq("key", key).execute().data
+            )
+            if rows:
+                return rows[0]['value']
             return default
         except:
             return default
@@ -48,41 +335,61 @@ class DBManager:
                 "cvg": cvg
             }
             self.supabase.table("tests").update(data).eq("id", test_id).execute()
+            self._invalidate("tests")
             return True
         except Exception as e:
             print(f"Lỗi cập nhật Database: {e}")
             return False
 
     def delete_test(self, test_id):
-        """Xóa Test VÀ TẤT CẢ dữ liệu liên quan."""
+        """
+        Xóa Test VÀ TẤT CẢ dữ liệu liên quan (lots -> iqc_results, eqa_results, test_mapping)
+        bằng 1 lời gọi RPC delete_test_cascade, chạy trong 1 transaction phía Postgres.
+        Trả về dict số dòng đã xóa theo từng bảng, hoặc None nếu lỗi (không xóa dòng nào).
+        """
         try:
-            # Lấy danh sách lot_id liên quan
-            lots_res = self.supabase.table("lots").select("id").eq("test_id", test_id).execute()
-            lot_ids = [row['id'] for row in lots_res.data]
-            
-            if lot_ids:
-                self.supabase.table("iqc_results").delete().in_("lot_id", lot_ids).execute()
-                # Xóa iqc_data nếu bảng này tồn tại riêng biệt trong logic cũ
-                try: self.supabase.table("iqc_data").delete().in_("lot_id", lot_ids).execute()
-                except: pass
-            
-            self.supabase.table("lots").delete().eq("test_id", test_id).execute()
-            self.supabase.table("eqa_results").delete().eq("test_id", test_id).execute()
-            # Xóa eqa_data nếu bảng này tồn tại riêng biệt trong logic cũ
-            try: self.supabase.table("eqa_data").delete().eq("test_id", test_id).execute()
-            except: pass
-            
-            self.supabase.table("tests").delete().eq("id", test_id).execute()
-            return True
+            return self._delete_rpc("delete_test_cascade", {"p_test_id": int(test_id)},
+                                    lambda: self._delete_test_sequential(int(test_id)))
         except Exception as e:
             print(f"LỖI DB: Không thể xóa Test ID {test_id}: {e}")
-            return False
+            return None
+        finally:
+            self._invalidate("tests", "lots", "test_mapping")
+
+    def _delete_rpc(self, name, params, fallback):
+        """Gọi hàm xóa dây chuyền phía server; chỉ khi hàm chưa được cài (PGRST202) mới xóa tuần tự từng bảng."""
+        try:
+            res = self.supabase.rpc(name, params).execute()
+            return {k: int(v or 0) for k, v in dict(res.data).items()}
+        except Exception as e:
+            if getattr(e, 'code', None) != 'PGRST202':
+                raise
+            print(f"Chưa cài hàm {name} (supabase_functions.sql), xóa tuần tự không có transaction.")
+            return fallback()
+
+    def _delete_lots_sequential(self, lot_ids):
+        counts = {"lots": 0, "iqc_results": 0}
+        if lot_ids:
+            counts["iqc_results"] = len(self.supabase.table("iqc_results").delete().in_("lot_id", lot_ids).execute().data)
+            counts["lots"] = len(self.supabase.table("lots").delete().in_("id", lot_ids).execute().data)
+        return counts
+
+    def _delete_test_sequential(self, test_id):
+        lot_ids = [r['id'] for r in self.supabase.table("lots").select("id").eq("test_id", test_id).execute().data]
+        counts = self._delete_lots_sequential(lot_ids)
+        for table in ("eqa_results", "test_mapping"):
+            counts[table] = len(self.supabase.table(table).delete().eq("test_id", test_id).execute().data)
+        counts["tests"] = len(self.supabase.table("tests").delete().eq("id", test_id).execute().data)
+        return counts
 
     # --- QUẢN LÝ THIẾT BỊ & TESTS ---
     def get_all_devices(self):
         try:
-            res = self.supabase.table("tests").select("device").not_.is_("device", "null").execute()
-            devices = list(set([row['device'] for row in res.data if row['device'] != '']))
+            rows = self._cached_rows(
+                ["tests"], ("tests", "devices"),
+                lambda: self.supabase.table("tests").select("device").not_.is_("device", "null").execute().data
+            )
+            devices = list(set([row['device'] for row in rows if row['device'] != '']))
             devices.sort()
             return devices
         except: return []
@@ -91,14 +398,18 @@ class DBManager:
         try:
             data = {"name": name, "unit": unit, "tea": tea, "device": device, "cvi": cvi, "cvg": cvg}
             self.supabase.table("tests").insert(data).execute()
+            self._invalidate("tests")
             return True
         except: return False
 
     def get_all_tests(self):
         try:
             # Lấy tất cả các cột để đảm bảo có 'unit', 'device', 'method'...
-            res = self.supabase.table("tests").select("*").execute() 
-            return pd.DataFrame(res.data)
+            rows = self._cached_rows(
+                ["tests"], ("tests", "all"),
+                lambda: self.supabase.table("tests").select("*").execute().data
+            )
+            return pd.DataFrame(rows)
         except Exception as e:
             st.error(f"Lỗi truy vấn danh sách xét nghiệm: {e}")
             return pd.DataFrame()
@@ -107,6 +418,7 @@ class DBManager:
         try:
             data = {"name": name, "unit": unit, "tea": tea, "device": device, "cvi": cvi, "cvg": cvg}
             self.supabase.table("tests").update(data).eq("id", test_id).execute()
+            self._invalidate("tests")
             return True
         except: return False
 
@@ -119,69 +431,160 @@ class DBManager:
                 "method": method, "expiry_date": exp_str, "mean": mean, "sd": sd
             }
             self.supabase.table("lots").insert(data).execute()
+            self._invalidate("lots")
             return True
         except: return False
 
     def get_lots_for_test(self, test_id):
-        # Lấy danh sách xét nghiệm
-        df_tests = db.get_all_tests()
-        # Tạo selectbox hiển thị tên nhưng lưu giá trị là ID
-        selected_test_name = st.selectbox("Chọn xét nghiệm", df_tests['name'].unique())
-        selected_test_id = df_tests[df_tests['name'] == selected_test_name]['id'].values[0]
-        
-        # Dùng ID này để lấy Lot
-        df_lots = db.get_lots_for_test(selected_test_id)
-        
-        if not df_lots.empty:
-            selected_lot = st.selectbox("Chọn Lot", df_lots['lot_number'].unique())
-        else:
-            st.warning("Xét nghiệm này chưa có dữ liệu Lot!")
-        
-        # Dòng debug này giúp bạn kiểm tra xem Supabase có trả về dữ liệu hay không
-        print(f"DEBUG: Đang tìm Lot cho Test ID: {test_id}, Kết quả: {res.data}")
-        
-        return pd.DataFrame(res.data)
+        try:
+            test_id = int(test_id)
+            rows = self._cached_rows(
+                ["lots"], ("lots", "test", test_id),
+                lambda: self.supabase.table("lots").select("*").eq("test_id", test_id).order("id").execute().data
+            )
+            return coerce_frame(pd.DataFrame(rows), "lots")
+        except Exception as e:
+            print(f"Lỗi truy vấn Lot của Test ID {test_id}: {e}")
+            return pd.DataFrame()
 
     def update_lot_params(self, lot_id, lot_number, method, expiry_date, mean, sd):
         try:
             exp_str = expiry_date.strftime('%Y-%m-%d') if isinstance(expiry_date, (datetime, pd.Timestamp, date)) else str(expiry_date)
             data = {"lot_number": lot_number, "method": method, "expiry_date": exp_str, "mean": mean, "sd": sd}
             self.supabase.table("lots").update(data).eq("id", lot_id).execute()
+            self._invalidate("lots")
+            self.refresh_lot_verdicts(lot_id)
             return True
         except: return False
             
     def delete_lot(self, lot_id):
+        """Xóa 1 Lot cùng các kết quả IQC của nó (1 transaction). Trả về dict số dòng đã xóa hoặc None."""
         try:
-            self.supabase.table("lots").delete().eq("id", lot_id).execute()
-            return True
+            return self._delete_rpc("delete_lots_cascade", {"p_lot_id": int(lot_id)},
+                                    lambda: self._delete_lots_sequential([int(lot_id)]))
         except Exception as e:
             print(f"Lỗi khi xóa Lot: {e}")
-            return False
+            return None
+        finally:
+            self._invalidate("lots")
+
+    def delete_lots_for_test(self, test_id):
+        """Xóa mọi Lot của 1 Test cùng kết quả IQC (giữ lại Test, EQA, mapping). Trả về dict số dòng đã xóa hoặc None."""
+        try:
+            return self._delete_rpc(
+                "delete_lots_cascade", {"p_test_id": int(test_id)},
+                lambda: self._delete_lots_sequential(
+                    [r['id'] for r in self.supabase.table("lots").select("id").eq("test_id", int(test_id)).execute().data]))
+        except Exception as e:
+            print(f"Lỗi khi xóa Lot của Test ID {test_id}: {e}")
+            return None
+        finally:
+            self._invalidate("lots")
 
     def update_lot(self, lot_id, lot_number, mean, sd, expiration_date):
         try:
             data = {"lot_number": lot_number, "mean": mean, "sd": sd, "expiry_date": expiration_date}
             self.supabase.table("lots").update(data).eq("id", lot_id).execute()
+            self._invalidate("lots")
+            self.refresh_lot_verdicts(lot_id)
             return True
         except Exception as e:
             print(f"Lỗi khi cập nhật Lot: {e}")
             return False
 
+    def import_lots_from_dataframe(self, df, method="Imported"):
+        """
+        Import/cập nhật hàng loạt Lot & Target (file NSX hoặc import_tool).
+        Khóa tự nhiên: (test_id, lot_number, level) -> chạy lại cùng 1 file không tạo Lot trùng.
+        Cột bắt buộc: test_name, lot_number, level, mean, sd, expiry_date; 'method' (tùy chọn).
+        Trả về (success_count, errors); số dòng thêm mới/cập nhật lưu ở self.last_lot_import_counts.
+        """
+        errors = []
+        df = df.reset_index(drop=True)
+        # 1. Tra tên -> ID một lần trên danh sách tests (đã có bộ nhớ đệm)
+        df_tests = self.get_all_tests()
+        name_to_id = dict(zip(df_tests['name'].astype(str).str.strip(), df_tests['id'])) if not df_tests.empty else {}
+
+        work = pd.DataFrame({
+            'line': np.arange(len(df)) + 2,
+            'test_name': df['test_name'].astype(str).str.strip(),
+            'lot_number': df['lot_number'].astype(str).str.strip(),
+            'level': pd.to_numeric(df['level'], errors='coerce'),
+            'mean': pd.to_numeric(df['mean'], errors='coerce'),
+            'sd': pd.to_numeric(df['sd'], errors='coerce'),
+        })
+        exp_parsed = _parse_dates(df['expiry_date'])
+        work['expiry_date'] = exp_parsed.dt.strftime('%Y-%m-%d').where(exp_parsed.notna(), df['expiry_date'].astype(str))
+        work['method'] = df['method'].fillna(method).astype(str) if 'method' in df.columns else method
+        work['test_id'] = work['test_name'].map(name_to_id)
+
+        missing = work['test_id'].isna()
+        for line, name in work.loc[missing, ['line', 'test_name']].itertuples(index=False):
+            errors.append(f"Dòng {line}: Không tìm thấy xét nghiệm '{name}'")
+        bad = ~missing & work[['level', 'mean', 'sd']].isna().any(axis=1)
+        for line in work.loc[bad, 'line']:
+            errors.append(f"Dòng {line}: Thiếu hoặc sai định dạng level/mean/sd")
+        work = work[~missing & ~bad].copy()
+        work['test_id'] = work['test_id'].astype(int)
+        work['level'] = work['level'].astype(int)
+        # Trong cùng 1 file, dòng sau ghi đè dòng trước có cùng khóa
+        work = work.drop_duplicates(['test_id', 'lot_number', 'level'], keep='last')
+
+        # 2. Lấy các Lot đã có của những test liên quan (1 truy vấn) để tách thêm mới / cập nhật
+        existing = self._fetch_lots_for_tests(work['test_id'].unique().tolist()) if not work.empty else pd.DataFrame()
+        if not existing.empty:
+            existing = existing.assign(lot_number=existing['lot_number'].astype(str), level=existing['level'].astype(int))
+            existing = existing.drop_duplicates(['test_id', 'lot_number', 'level'])[['id', 'test_id', 'lot_number', 'level']]
+            work = work.merge(existing, on=['test_id', 'lot_number', 'level'], how='left')
+        else:
+            work['id'] = np.nan
+
+        fields = ['test_id', 'lot_number', 'level', 'method', 'expiry_date', 'mean', 'sd']
+        records = work[fields].astype(object).to_dict('records')
+        to_update = [dict(r, id=int(i)) for r, i in zip(records, work['id']) if pd.notna(i)]
+        to_insert = [r for r, i in zip(records, work['id']) if pd.isna(i)]
+
+        # 3. Ghi theo khối
+        counts = {"inserted": 0, "updated": 0}
+        for kind, rows, write in (("inserted", to_insert, lambda c: self._insert_rows("lots", c)),
+                                  ("updated", to_update, lambda c: self._update_rows_by_id("lots", c))):
+            for i in range(0, len(rows), self.IMPORT_CHUNK_SIZE):
+                chunk = rows[i:i + self.IMPORT_CHUNK_SIZE]
+                try:
+                    write(chunk)
+                    counts[kind] += len(chunk)
+                except Exception as e:
+                    errors.append(f"Lỗi ghi Lot ({kind}) khối {i + 1}-{i + len(chunk)}: {str(e)}")
+        self._invalidate("lots")
+        # Mean/SD có thể đã đổi: xóa kết quả Westgard đã lưu, sẽ được chấm lại khi đọc
+        self._reset_verdicts([r['id'] for r in to_update])
+        self.last_lot_import_counts = counts
+        return counts["inserted"] + counts["updated"], errors
+
     def get_test_by_name(self, name):
-        res = self.supabase.table("tests").select("id").eq("name", name).execute()
-        return {'id': res.data[0]['id']} if res.data else None
+        # Tra cứu trên danh sách tests đã có trong bộ nhớ đệm thay vì gọi thêm 1 request
+        df_tests = self.get_all_tests()
+        if df_tests.empty:
+            return None
+        match = df_tests[df_tests['name'] == name]
+        return {'id': int(match['id'].iloc[0])} if not match.empty else None
 
     # --- QUẢN LÝ IQC DATA ---
     def add_iqc_data(self, lot_id, dt, level, value, note):
         try:
             if isinstance(dt, str):
-                dt_obj = pd.to_datetime(dt, dayfirst=True)
+                # Parse ISO trước: dayfirst=True đọc nhầm '2024-03-05' thành ngày 3/5
+                dt_obj = _parse_dates([dt]).iloc[0]
                 d_str = dt_obj.strftime('%Y-%m-%d %H:%M:%S')
             else:
                 d_str = dt.strftime('%Y-%m-%d %H:%M:%S')
 
-            data = {"lot_id": lot_id, "date": d_str, "value": value, "level": level, "note": note}
-            self.supabase.table("iqc_results").insert(data).execute()
+            data = {"lot_id": int(lot_id), "date": d_str, "value": value, "level": int(level), "note": note}
+            # Chấm Westgard cho điểm mới từ 10 điểm gần nhất của lot/level và lưu cùng dòng
+            stale = self._score_new_rows([data])
+            self._insert_rows("iqc_results", [data])
+            for stale_lot in stale:
+                self.refresh_lot_verdicts(stale_lot)
             return True
         except Exception as e:
             print(f"Lỗi chuẩn hóa ngày: {e}")
@@ -191,37 +594,151 @@ class DBManager:
         self.supabase.table("iqc_results").update({"action": action_text}).eq("id", result_id).execute()
 
     def get_iqc_data_continuous(self, test_id, max_months=None):
-        # Supabase thực hiện join qua cú pháp select
-        query = self.supabase.table("iqc_results").select("*, lots!inner(lot_number, test_id)")
-        query = query.eq("lots.test_id", test_id)
-        
+        """
+        Kết quả IQC của 1 xét nghiệm qua mọi lot, mỗi dòng kèm target_mean/target_sd của chính lot của nó
+        (để z-score, Westgard và biểu đồ LJ qua nhiều lot dùng đúng Mean/SD của từng lot).
+        """
+        date_from = None
         if max_months:
-            cutoff = (datetime.now() - timedelta(days=max_months*30)).strftime('%Y-%m-%d')
-            query = query.gte("date", cutoff)
-            
-        res = query.order("date", desc=False).execute()
-        # Flatten dữ liệu join
-        flat_data = []
-        for r in res.data:
-            r['lot_number'] = r['lots']['lot_number']
-            flat_data.append(r)
-        return pd.DataFrame(flat_data)
+            date_from = (datetime.now() - timedelta(days=max_months*30)).strftime('%Y-%m-%d')
+        return self._attach_lot_targets(self.read_iqc_stream(test_id, date_from=date_from), test_id)
+
+    def _attach_lot_targets(self, df, test_id):
+        """Thêm cột target_mean, target_sd theo lot_id (bảng lot của test lấy qua bộ nhớ đệm); lot thiếu -> NaN."""
+        if df.empty or 'lot_id' not in df.columns:
+            return df
+        lots = self.get_lots_for_test(test_id)
+        df = df.copy()
+        if lots.empty:
+            df['target_mean'] = np.nan
+            df['target_sd'] = np.nan
+            return df
+        targets = lots.set_index('id')
+        df['target_mean'] = df['lot_id'].map(targets['mean']).astype(float)
+        df['target_sd'] = df['lot_id'].map(targets['sd']).astype(float)
+        return df
+
+    # --- ĐỌC LỊCH SỬ IQC THEO TRANG (KEYSET) ---
+    def iter_iqc_stream(self, test_id=None, date_from=None, columns=None, page_size=None, date_before=None):
+        """
+        Generator trả về từng DataFrame (mỗi trang tối đa page_size dòng), sắp xếp tăng dần theo (date, id).
+        Trang sau bắt đầu ngay sau khóa (date, id) cuối của trang trước nên không bị
+        giới hạn 1000 dòng của PostgREST cắt cụt và không phải giữ toàn bộ dữ liệu trong bộ nhớ.
+        test_id=None: đọc mọi xét nghiệm (left join, có thêm cột test_name).
+        date_from/date_before: lọc date >= date_from và date < date_before.
+        Dòng không có ngày được trả về sau cùng (chỉ khi không lọc theo ngày).
+        """
+        columns = list(columns or self.IQC_COLUMNS)
+        page_size = page_size or self.STREAM_PAGE_SIZE
+        # Khóa phân trang luôn phải có trong kết quả
+        select_cols = columns + [c for c in ("id", "date") if c not in columns]
+        if test_id is None:
+            select = f"{', '.join(select_cols)}, lots(lot_number, tests(name))"
+        else:
+            select = f"{', '.join(select_cols)}, lots!inner(lot_number, test_id)"
+
+        def base_query():
+            q = self.supabase.table("iqc_results").select(select)
+            if test_id is not None:
+                q = q.eq("lots.test_id", test_id)
+            return q
+
+        last = None
+        while True:
+            q = base_query().not_.is_("date", "null")
+            if date_from:
+                q = q.gte("date", date_from)
+            if date_before:
+                q = q.lt("date", date_before)
+            if last is not None:
+                d = str(last[0]).replace('"', '')
+                q = q.or_(f'date.gt."{d}",and(date.eq."{d}",id.gt.{last[1]})')
+            data = q.order("date").order("id").limit(page_size).execute().data
+            if data:
+                yield self._flatten_iqc_page(data, columns, test_id is None)
+                last = (data[-1]['date'], data[-1]['id'])
+            if len(data) < page_size:
+                break
+
+        if date_from or date_before:
+            return
+        last_id = None
+        while True:
+            q = base_query().is_("date", "null")
+            if last_id is not None:
+                q = q.gt("id", last_id)
+            data = q.order("id").limit(page_size).execute().data
+            if data:
+                yield self._flatten_iqc_page(data, columns, test_id is None)
+                last_id = data[-1]['id']
+            if len(data) < page_size:
+                break
+
+    def read_iqc_stream(self, test_id=None, date_from=None, columns=None, page_size=None, date_before=None):
+        """Gom toàn bộ các trang của iter_iqc_stream thành 1 DataFrame (dùng cho code cũ)."""
+        chunks = list(self.iter_iqc_stream(test_id, date_from=date_from, columns=columns,
+                                           page_size=page_size, date_before=date_before))
+        if not chunks:
+            return pd.DataFrame()
+        # Mỗi trang có bộ category riêng nên sau khi nối cần ép kiểu lại
+        return coerce_frame(pd.concat(chunks, ignore_index=True), "iqc_results")
+
+    @staticmethod
+    def _flatten_iqc_page(data, columns, with_test_name):
+        """Làm phẳng dữ liệu join lồng nhau của 1 trang (lots.lot_number, lots.tests.name) và ép kiểu."""
+        df = pd.json_normalize(data)
+        out = df[[c for c in columns if c in df.columns]].copy()
+        out['lot_number'] = df['lots.lot_number'] if 'lots.lot_number' in df.columns else None
+        if with_test_name:
+            out['test_name'] = df['lots.tests.name'] if 'lots.tests.name' in df.columns else None
+        return coerce_frame(out, "iqc_results")
 
     def get_iqc_data_filtered(self, test_id, d_start, d_end):
-        s_date = d_start.strftime('%Y-%m-%d')
-        e_date = d_end.strftime('%Y-%m-%d')
-        res = self.supabase.table("iqc_results").select("*, lots!inner(test_id)")\
-            .eq("lots.test_id", test_id)\
-            .gte("date", s_date)\
-            .lte("date", e_date)\
-            .order("date", desc=False).execute()
-        return pd.DataFrame(res.data)
+        date_from, date_before = _date_window(d_start, d_end)
+        return self.read_iqc_stream(test_id, date_from=date_from, date_before=date_before)
+
+    # --- THỐNG KÊ TỔNG HỢP THEO LEVEL (TÍNH PHÍA SERVER) ---
+    def get_iqc_level_stats(self, test_id, d_start=None, d_end=None, by_lot=False):
+        """
+        Trả về DataFrame mỗi dòng 1 level (hoặc 1 cặp level/lot nếu by_lot=True):
+        n, sum, sumsq, min_value, max_value, n_clean, sum_clean, sumsq_clean (đã lọc 3SD),
+        first_date, last_date. Chỉ vài dòng thay vì toàn bộ lịch sử IQC.
+        Dùng RPC iqc_level_stats (supabase_functions.sql); nếu chưa cài hàm thì tự tính từ dữ liệu đọc theo trang.
+        """
+        date_from, date_before = _date_window(d_start, d_end)
+        try:
+            params = {"p_test_id": int(test_id), "p_by_lot": bool(by_lot)}
+            # Tham số NULL thì bỏ qua để hàm dùng giá trị mặc định
+            if date_from:
+                params["p_from"] = date_from
+            if date_before:
+                params["p_before"] = date_before
+            # get=True: gọi hàm chỉ đọc bằng GET nên được thử lại khi lỗi mạng
+            res = self.supabase.rpc("iqc_level_stats", params, get=True).execute()
+            return pd.DataFrame(res.data, columns=_aggregate_iqc_frame(None).columns)
+        except Exception as e:
+            print(f"RPC iqc_level_stats lỗi, tính phía client: {e}")
+        df = self.read_iqc_stream(test_id, date_from=date_from, date_before=date_before,
+                                  columns=("id", "lot_id", "date", "level", "value"))
+        return _aggregate_iqc_frame(df, by_lot)
 
-    def get_iqc_data_by_lot(self, lot_id):
+    def get_clean_stats_by_level(self, test_id, d_start=None, d_end=None):
+        """{level: thống kê đã lọc 3SD} cho khoảng ngày, cùng dạng với get_clean_stats_3sigma."""
+        df = self.get_iqc_level_stats(test_id, d_start, d_end)
+        result = {}
+        for row in df.to_dict('records'):
+            stats = stats_from_sums(row)
+            if stats:
+                result[int(row['level'])] = stats
+        return result
+
+    def get_iqc_data_by_lot(self, lot_id, with_verdicts=False):
         try:
-            res = self.supabase.table("iqc_results").select("id, date, value, level, note")\
+            cols = "id, date, value, level, note" + (", violation" if with_verdicts and self._verdicts_supported() else "") \
+                + (", drift" if with_verdicts and self._drift_supported() else "")
+            res = self.supabase.table("iqc_results").select(cols)\
                 .eq("lot_id", lot_id).order("date", desc=True).execute()
-            return pd.DataFrame(res.data)
+            return coerce_frame(pd.DataFrame(res.data), "iqc_results")
         except Exception as e:
             print(f"Lỗi truy vấn: {e}")
             return pd.DataFrame()
@@ -229,126 +746,605 @@ class DBManager:
     def get_iqc_data_by_lot_full(self, lot_id):
         res = self.supabase.table("iqc_results").select("id, date, value, note")\
             .eq("lot_id", lot_id).order("date", desc=True).execute()
-        return pd.DataFrame(res.data)
+        return coerce_frame(pd.DataFrame(res.data), "iqc_results")
         
-    def update_iqc_data(self, iqc_id, note, dt, level, value):
+    def update_iqc_data(self, iqc_id, note, dt, level, value, refresh=True):
+        """
+        Sửa 1 kết quả IQC. Lot chỉ được chấm lại khi ngày/mức/giá trị thay đổi (sửa ghi chú thì không);
+        refresh=False để người gọi tự gọi refresh_lot_verdicts 1 lần cho mỗi lot sau vòng lặp.
+        """
         try:
             if isinstance(dt, (pd.Timestamp, datetime)):
                 d_str = dt.strftime('%Y-%m-%d %H:%M:%S')
             else:
                 d_str = str(dt)
+            before = self.supabase.table("iqc_results").select("lot_id, date, level, value")\
+                .eq("id", iqc_id).execute().data
             data = {"date": d_str, "level": level, "value": value, "note": note}
             self.supabase.table("iqc_results").update(data).eq("id", iqc_id).execute()
+            if refresh:
+                for lot_id in {r['lot_id'] for r in before if r.get('lot_id') is not None
+                               and _scored_fields_changed(r, d_str, level, value)}:
+                    self.refresh_lot_verdicts(lot_id)
             return True
         except Exception as e:
             print(f"Lỗi SQL: {e}")
             return False
   
-    def delete_iqc_result(self, row_id):
+    def delete_iqc_result(self, row_id, refresh=True):
+        """Xóa 1 kết quả IQC rồi chấm lại lot của nó (refresh=False: người gọi tự chấm lại sau khi xóa xong)."""
         try:
             res = self.supabase.table("iqc_results").delete().eq("id", int(row_id)).execute()
+            if refresh:
+                for lot_id in {r['lot_id'] for r in res.data or [] if r.get('lot_id') is not None}:
+                    self.refresh_lot_verdicts(lot_id)
             return True
         except Exception as e:
             print(f"Lỗi xóa IQC: {e}")
             return False
 
+    # --- KẾT QUẢ WESTGARD LƯU SẴN (cột iqc_results.violation) ---
+    # Mỗi điểm IQC được chấm ngay khi ghi theo chuỗi (lot, level) của nó, thứ tự (date, id),
+    # bằng Mean/SD của lot. NULL = chưa chấm (dữ liệu cũ, vừa đổi Mean/SD) -> chấm lại khi đọc.
+    def _verdicts_supported(self):
+        """Supabase chỉ có cột violation sau khi chạy supabase_functions.sql; kiểm tra 1 lần mỗi CACHE_TTL."""
+        def probe():
+            try:
+                self.supabase.table("iqc_results").select("violation").limit(1).execute()
+                return [{"supported": True}]
+            except Exception:
+                return [{"supported": False}]
+        return self._cached_rows(["iqc_schema"], ("iqc_results", "violation"), probe)[0]["supported"]
+
+    def _lot_versions(self, lot_ids):
+        """dict lot_id -> data_version; {} nếu DB chưa có cột (chưa chạy supabase_functions.sql)."""
+        def probe():
+            try:
+                self.supabase.table("lots").select("data_version").limit(1).execute()
+                return [{"supported": True}]
+            except Exception:
+                return [{"supported": False}]
+        if not lot_ids or not self._cached_rows(["lots_schema"], ("lots", "data_version"), probe)[0]["supported"]:
+            return {}
+        try:
+            res = self.supabase.table("lots").select("id, data_version").in_("id", [int(l) for l in lot_ids]).execute()
+            return {r['id']: r['data_version'] for r in res.data if r.get('data_version') is not None}
+        except Exception as e:
+            print(f"Lỗi đọc phiên bản dữ liệu lot: {e}")
+            return {}
+
+    def _forget_verdicts(self, lot_ids):
+        """Bỏ kết quả đã nhớ của các lot (khi đổi bộ quy tắc: violation bị xóa nhưng data_version không đổi)."""
+        lots = {int(l) for l in lot_ids}
+        with _VERDICT_CACHE_LOCK:
+            for k in [k for k in _VERDICT_CACHE if k[1] in lots]:
+                del _VERDICT_CACHE[k]
+
+    def _score_new_rows(self, rows):
+        """
+        Chấm Westgard cho các dòng IQC sắp ghi (dict có lot_id, level, date, value), gán row['violation'] tại chỗ.
+        Mỗi (lot, level) chỉ đọc vài điểm cuối đã lưu (đủ cho bộ quy tắc của test). Điểm nhập bù (sớm hơn điểm cuối)
+        làm đổi kết quả các điểm sau: để NULL và trả về tập lot_id cần chấm lại sau khi ghi.
+        Cột drift (EWMA/CUSUM) được cập nhật O(1) từ drift_state của chuỗi; trạng thái chưa có hoặc không khớp
+        điểm cuối đã lưu thì để NULL và chấm lại cả lot (vector hóa) sau khi ghi.
+        """
+        stale = set()
+        if not rows or not self._verdicts_supported():
+            return stale
+        drift_on = self._drift_supported()
+        try:
+            lot_ids = sorted({r['lot_id'] for r in rows})
+            params = self._fetch_lot_params(lot_ids)
+            states = self._load_drift_states(lot_ids) if drift_on else {}
+            new_states = []
+            groups = {}
+            for r in rows:
+                groups.setdefault((r['lot_id'], r['level']), []).append(r)
+            for (lot_id, level), group in groups.items():
+                lot = params.get(lot_id, {})
+                stream = LevelStream(lot.get('mean'), lot.get('sd'), self.get_rule_set(lot.get('test_id')))
+                tail = self._fetch_level_tail(lot_id, level, stream.window)
+                stream.extend(t['value'] for t in reversed(tail))
+                last = _parse_dates([tail[0]['date']]).iloc[0] if tail else None
+                drift = self._drift_stream(lot, states.get((lot_id, level)), tail) if drift_on else None
+                # Cùng thời điểm: dòng ghi sau có id lớn hơn nên giữ nguyên thứ tự trong danh sách
+                ordered = sorted(group, key=lambda r: pd.Timestamp(r['date']))
+                for r in ordered:
+                    d = pd.Timestamp(r['date'])
+                    if lot_id in stale or (last is not None and d < last):
+                        stale.add(lot_id)
+                        r['violation'] = None
+                        if drift_on:
+                            r['drift'] = None
+                        continue
+                    r['violation'] = stream.push_label(r['value'])
+                    if drift_on:
+                        r['drift'] = drift.push(r['value'])[3] if drift is not None else None
+                        if drift is None:
+                            stale.add(lot_id)
+                    last = d
+                if drift is not None and lot_id not in stale:
+                    new_states.append(self._drift_state_row(lot_id, level, lot, drift.state, ordered[-1]))
+            # Lưu trước khi ghi: nếu ghi lỗi, trạng thái không khớp điểm cuối trong DB nên lần sau tự chấm lại
+            self._save_drift_states(new_states)
+        except Exception as e:
+            print(f"Lỗi chấm Westgard khi ghi: {e}")
+            for r in rows:
+                r['violation'] = None
+                if drift_on:
+                    r['drift'] = None
+            stale = set()
+        return stale
+
+    def refresh_lot_verdicts(self, lot_id):
+        """Chấm lại toàn bộ kết quả của 1 lot, chỉ ghi các dòng có kết quả thay đổi. Trả về số dòng đã cập nhật."""
+        if not self._verdicts_supported():
+            return 0
+        try:
+            lot_id = int(lot_id)
+            df = self._fetch_lot_series(lot_id)
+            if df.empty:
+                return 0
+            lot = self._fetch_lot_params([lot_id]).get(lot_id, {})
+            rules = self.get_rule_set(lot.get('test_id'))
+            df = df.assign(date=_parse_dates(df['date']).values).sort_values(['date', 'id'], kind='stable')
+            valid = df['date'].notna() & df['level'].notna()
+            labels = pd.Series(PASS_LABEL, index=df.index, dtype=object)
+            for _, g in df[valid].groupby('level', sort=False):
+                labels[g.index] = LevelStream(lot.get('mean'), lot.get('sd'), rules).score(g['value'])
+            changed = df['violation'].astype(object).ne(labels)
+            self._write_verdicts(dict(zip(df.loc[changed, 'id'], labels[changed])))
+            if 'drift' in df.columns:
+                # EWMA/CUSUM tính lại cả lịch sử (vector hóa), lưu nhãn đổi và trạng thái cuối của từng mức
+                scored, states = add_drift_columns(df[valid], lot.get('mean'), lot.get('sd'),
+                                                   self.get_drift_params(lot.get('test_id')))
+                drift = pd.Series("", index=df.index, dtype=object)
+                drift[scored.index] = scored['drift']
+                drift_changed = df['drift'].astype(object).ne(drift)
+                self._write_verdicts(dict(zip(df.loc[drift_changed, 'id'], drift[drift_changed])), column="drift")
+                last_rows = df[valid].groupby('level', sort=False).tail(1)
+                self._save_drift_states([self._drift_state_row(lot_id, r['level'], lot, states[int(r['level'])], r)
+                                         for r in last_rows.to_dict('records')])
+                changed |= drift_changed
+            return int(changed.sum())
+        except Exception as e:
+            print(f"Lỗi chấm lại Westgard cho Lot {lot_id}: {e}")
+            return 0
+
+    def get_rule_set(self, test_id):
+        """Tên bộ quy tắc Westgard của 1 xét nghiệm (lưu trong settings), mặc định DEFAULT_RULE_SET."""
+        if test_id is None:
+            return DEFAULT_RULE_SET
+        name = self.get_setting(f"westgard_rules_{int(test_id)}", DEFAULT_RULE_SET)
+        return name if name in RULE_SETS else DEFAULT_RULE_SET
+
+    def set_rule_set(self, test_id, name):
+        """Đổi bộ quy tắc của 1 xét nghiệm; kết quả đã lưu của các lot được chấm lại khi đọc."""
+        if name not in RULE_SETS or not self.set_setting(f"westgard_rules_{int(test_id)}", name):
+            return False
+        lots = self.get_lots_for_test(test_id)
+        if not lots.empty:
+            self._reset_verdicts(lots['id'].astype(int).tolist())
+            self._forget_verdicts(lots['id'].astype(int).tolist())
+        return True
+
+    # --- EWMA / CUSUM (cột iqc_results.drift + bảng drift_state, 1 dòng / lot / mức) ---
+    def get_drift_params(self, test_id):
+        """Thông số EWMA/CUSUM (DriftParams) của 1 xét nghiệm, lưu trong settings; mặc định DEFAULT_DRIFT_PARAMS."""
+        if test_id is None:
+            return parse_drift_params(None)
+        return parse_drift_params(self.get_setting(f"drift_params_{int(test_id)}"))
+
+    def set_drift_params(self, test_id, params):
+        """Đổi thông số EWMA/CUSUM của 1 xét nghiệm; nhãn drift đã lưu của các lot được chấm lại khi đọc."""
+        if not self.set_setting(f"drift_params_{int(test_id)}", dump_drift_params(params)):
+            return False
+        lots = self.get_lots_for_test(test_id)
+        if not lots.empty:
+            self._reset_drift(lots['id'].astype(int).tolist())
+            self._forget_verdicts(lots['id'].astype(int).tolist())
+        return True
+
+    def _drift_supported(self):
+        """Supabase chỉ có cột drift / bảng drift_state sau khi chạy supabase_functions.sql."""
+        def probe():
+            try:
+                self.supabase.table("iqc_results").select("drift").limit(1).execute()
+                self.supabase.table("drift_state").select("lot_id").limit(1).execute()
+                return [{"supported": True}]
+            except Exception:
+                return [{"supported": False}]
+        return self._cached_rows(["iqc_schema"], ("iqc_results", "drift"), probe)[0]["supported"]
+
+    def _drift_stream(self, lot, state, tail):
+        """
+        DriftStream tiếp nối trạng thái đã lưu của 1 chuỗi, hoặc None nếu trạng thái không dùng được
+        (chưa có, khác Mean/SD/thông số, hoặc điểm cuối đã lưu không còn là điểm cuối của chuỗi).
+        """
+        params = self.get_drift_params(lot.get('test_id'))
+        if not tail:
+            return DriftStream(lot.get('mean'), lot.get('sd'), params)
+        if not state:
+            return None
+        try:
+            same = (state['mean'] == lot.get('mean') and state['sd'] == lot.get('sd')
+                    and parse_drift_params(state['params']) == params
+                    and _parse_dates([state['last_date']]).iloc[0] == _parse_dates([tail[0]['date']]).iloc[0]
+                    and float(state['last_value']) == float(tail[0]['value']))
+        except (TypeError, ValueError):
+            same = False
+        if not same:
+            return None
+        return DriftStream(lot.get('mean'), lot.get('sd'), params,
+                           (int(state['n']), float(state['ewma']), float(state['cusum_hi']), float(state['cusum_lo'])))
+
+    def _drift_state_row(self, lot_id, level, lot, state, last):
+        """Dòng drift_state sau điểm `last` (dict có date, value) của chuỗi (lot, level)."""
+        last_date = last['date']
+        return {
+            "lot_id": int(lot_id), "level": int(level),
+            "n": int(state[0]), "ewma": float(state[1]), "cusum_hi": float(state[2]), "cusum_lo": float(state[3]),
+            "last_date": last_date.strftime('%Y-%m-%d %H:%M:%S') if hasattr(last_date, 'strftime') else str(last_date),
+            "last_value": None if pd.isna(last['value']) else float(last['value']),
+            "mean": lot.get('mean'), "sd": lot.get('sd'),
+            "params": dump_drift_params(self.get_drift_params(lot.get('test_id'))),
+        }
+
+    def _load_drift_states(self, lot_ids):
+        """dict (lot_id, level) -> dòng drift_state của các lot (1 truy vấn)."""
+        if not lot_ids:
+            return {}
+        res = self.supabase.table("drift_state").select("*").in_("lot_id", [int(l) for l in lot_ids]).execute()
+        return {(r['lot_id'], r['level']): r for r in res.data}
+
+    def _save_drift_states(self, rows):
+        if rows:
+            self.supabase.table("drift_state").upsert(rows, on_conflict="lot_id,level").execute()
+
+    def _reset_drift(self, lot_ids):
+        """Đánh dấu chưa chấm (NULL) cột drift của các lot; trạng thái được dựng lại khi chấm."""
+        if not lot_ids or not self._drift_supported():
+            return
+        try:
+            self.supabase.table("iqc_results").update({"drift": None}).in_("lot_id", [int(l) for l in lot_ids]).execute()
+            self.supabase.table("drift_state").delete().in_("lot_id", [int(l) for l in lot_ids]).execute()
+        except Exception as e:
+            print(f"Lỗi đánh dấu chấm lại EWMA/CUSUM: {e}")
+
+    def get_iqc_verdicts_by_lot(self, lot_id, mean, sd, rules=None, drift_params=None):
+        """
+        Kết quả IQC của 1 lot (mới nhất lên đầu) kèm cột 'Violation' và 'Drift' (EWMA/CUSUM, '' nếu không báo)
+        đọc từ kết quả đã lưu. Dòng chưa chấm được chấm lại 1 lần rồi lưu; DB chưa có cột thì tính trực tiếp.
+        rules / drift_params: dùng khi phải tính trực tiếp (thường là db.get_rule_set / db.get_drift_params của test).
+        Kết quả được nhớ theo (lot, data_version, mean, sd, rules, drift_params): xem lại khi dữ liệu chưa đổi
+        chỉ tốn 1 truy vấn đọc data_version.
+        """
+        version = self._lot_versions([lot_id]).get(int(lot_id))
+        key = (getattr(self, 'url', None), int(lot_id), version, mean, sd,
+               rules if rules is None or isinstance(rules, str) else tuple(rules), parse_drift_params(drift_params))
+        if version is not None:
+            with _VERDICT_CACHE_LOCK:
+                hit = _VERDICT_CACHE.get(key)
+                if hit is not None:
+                    _VERDICT_CACHE.move_to_end(key)
+                    return hit.copy()
+
+        df = self.get_iqc_data_by_lot(lot_id, with_verdicts=True)
+        if df.empty:
+            return df
+        stored = [c for c in ('violation', 'drift') if c in df.columns]
+        if stored and df[stored].isna().any().any() and self.refresh_lot_verdicts(lot_id):
+            df = self.get_iqc_data_by_lot(lot_id, with_verdicts=True)
+        if 'violation' not in df.columns or df['violation'].isna().any():
+            df = get_westgard_violations(df.drop(columns='violation', errors='ignore'), mean, sd, rules)
+        else:
+            df = df.rename(columns={'violation': 'Violation'})
+        if 'drift' not in df.columns or df['drift'].isna().any():
+            df['Drift'] = add_drift_columns(df.drop(columns='drift', errors='ignore'), mean, sd, drift_params)[0]['drift']
+            df = df.drop(columns='drift', errors='ignore')
+        else:
+            df = df.rename(columns={'drift': 'Drift'})
+
+        # Phiên bản đọc TRƯỚC khi tải dữ liệu: nếu có ghi xen giữa thì lần sau phiên bản đã khác, không dùng nhầm
+        if version is not None:
+            with _VERDICT_CACHE_LOCK:
+                _VERDICT_CACHE[key] = df.copy()
+                while len(_VERDICT_CACHE) > VERDICT_CACHE_SIZE:
+                    _VERDICT_CACHE.popitem(last=False)
+        return df
+
+    # --- TRẠNG THÁI QC TOÀN PHÒNG (bảng qc_status, ghi bởi qc_status.scan_qc_status) ---
+    def get_qc_status(self):
+        """
+        Bảng qc_status (1 dòng / test / mức) cho màn hình tổng quan; không đọc iqc_results.
+        Không qua _cached_rows: bảng nhỏ và thường được ghi bởi tiến trình quét khác (cron),
+        nên màn hình treo tường phải thấy trạng thái mới ở mỗi lần làm mới.
+        """
+        def fetch():
+            rows, page = [], self.STREAM_PAGE_SIZE
+            while True:
+                res = self.supabase.table("qc_status").select("*").order("test_id").order("level")\
+                    .range(len(rows), len(rows) + page - 1).execute()
+                rows.extend(res.data)
+                if len(res.data) < page:
+                    return rows
+        try:
+            return coerce_frame(pd.DataFrame(fetch()), "qc_status")
+        except Exception as e:
+            print(f"Lỗi đọc bảng qc_status: {e}")
+            return pd.DataFrame()
+
+    def save_qc_status(self, rows, test_ids):
+        """
+        Ghi trạng thái của các test vừa quét: upsert theo (test_id, level), sau đó xóa các mức
+        của những test này không còn trong lần quét (updated_at cũ hơn lần quét).
+        """
+        try:
+            for i in range(0, len(rows), self.IMPORT_CHUNK_SIZE):
+                self.supabase.table("qc_status").upsert(rows[i:i + self.IMPORT_CHUNK_SIZE], on_conflict="test_id,level").execute()
+            if test_ids and rows:
+                self.supabase.table("qc_status").delete().in_("test_id", [int(t) for t in test_ids])\
+                    .lt("updated_at", rows[0]['updated_at']).execute()
+            elif test_ids:
+                self.supabase.table("qc_status").delete().in_("test_id", [int(t) for t in test_ids]).execute()
+            return True
+        except Exception as e:
+            print(f"Lỗi ghi bảng qc_status: {e}")
+            return False
+
+    def get_current_lots(self, test_id):
+        """dict level -> lot_id của lot có kết quả IQC mới nhất (theo date, id) ở mỗi mức của test."""
+        lots = self.get_lots_for_test(test_id)
+        current = {}
+        if lots.empty:
+            return current
+        for level, lot_ids in lots.groupby('level')['id']:
+            res = self.supabase.table("iqc_results").select("lot_id").in_("lot_id", [int(l) for l in lot_ids])\
+                .order("date", desc=True).order("id", desc=True).limit(1).execute()
+            if res.data:
+                current[int(level)] = res.data[0]['lot_id']
+        return current
+
+    def worker_factory(self):
+        """Hàm tạo DBManager cùng cấu hình trong tiến trình con (picklable, dùng cho ProcessPoolExecutor)."""
+        return get_db_manager
+
     def upgrade_db(self):
         # Giữ nguyên để không lỗi app, nhưng Supabase quản lý cột qua Dashboard
         pass
 
     def import_iqc_from_dataframe(self, df):
+        """
+        Import kết quả IQC theo lô (batch) thay vì 4 request/dòng:
+        1. Chuẩn hóa toàn bộ cột (ngày, mức, kết quả) một lần.
+        2. Tra mapping và Lot ứng viên, mỗi loại 1 truy vấn.
+        3. Kiểm tra trùng bằng 1 truy vấn theo khoảng ngày.
+        4. Ghi theo từng khối IMPORT_CHUNK_SIZE dòng.
+        Trả về (success_count, errors); thời gian từng bước lưu ở self.last_import_timings.
+        """
+        timings = {}
+        t_start = t0 = time.perf_counter()
+        errors = []  # (vị trí dòng, thông báo) để giữ đúng thứ tự dòng trong file
+
+        # --- 1. CHUẨN HÓA DỮ LIỆU ---
+        work = pd.DataFrame({
+            'pos': np.arange(len(df)),
+            'raw_name': df['Tên xét nghiệm'] if 'Tên xét nghiệm' in df.columns else 'N/A',
+        })
+        work['ext_name'] = work['raw_name'].astype(str).str.strip()
+        work['lot_num'] = df['Lô'].astype(str).str.strip().values if 'Lô' in df.columns else None
+        work['level'] = pd.to_numeric(df['Mức QC'], errors='coerce').values if 'Mức QC' in df.columns else np.nan
+        work['value'] = pd.to_numeric(df['Kết quả'], errors='coerce').values if 'Kết quả' in df.columns else np.nan
+        work['run_date'] = _parse_dates(df['Thời gian chạy']).values if 'Thời gian chạy' in df.columns else pd.NaT
+        device = df['Máy xét nghiệm'].astype(str).values if 'Máy xét nghiệm' in df.columns else 'Excel'
+        work['note'] = 'Import từ máy ' + pd.Series(device, index=work.index).astype(str)
+
+        bad = work['lot_num'].isna() | work['level'].isna() | work['value'].isna() | work['run_date'].isna()
+        for pos, name in work.loc[bad, ['pos', 'raw_name']].itertuples(index=False):
+            errors.append((pos, f"Lỗi dòng {name}: Thiếu hoặc sai định dạng Lô/Mức QC/Kết quả/Thời gian chạy"))
+        work = work[~bad].copy()
+        work['level'] = work['level'].astype(int)
+        work['run_date'] = work['run_date'].dt.floor('s')
+        timings['parse'] = time.perf_counter() - t0
+
+        # --- 2. MAPPING TÊN XÉT NGHIỆM (1 truy vấn) ---
+        t0 = time.perf_counter()
+        name_map = self._fetch_mappings(work['ext_name'].unique().tolist()) if not work.empty else {}
+        work['test_id'] = work['ext_name'].map(name_map)
+        unmapped = work['test_id'].isna()
+        for pos, name in work.loc[unmapped, ['pos', 'ext_name']].itertuples(index=False):
+            errors.append((pos, f"Chưa mapping tên: {name}"))
+        work = work[~unmapped].copy()
+        timings['mapping'] = time.perf_counter() - t0
+
+        # --- 3. TÌM LOT (1 truy vấn, so khớp như ilike '%lot%') ---
+        t0 = time.perf_counter()
+        lots = self._fetch_lots_for_tests(work['test_id'].astype(int).unique().tolist()) if not work.empty else pd.DataFrame()
+        if not lots.empty:
+            cand = work[['pos', 'test_id', 'level', 'lot_num']].merge(
+                lots[['id', 'test_id', 'level', 'lot_number']].sort_values('id'), on=['test_id', 'level'], how='inner')
+            hit = [ln.lower() in str(lot).lower() for ln, lot in zip(cand['lot_num'], cand['lot_number'])]
+            first_lot = cand[hit].drop_duplicates('pos').set_index('pos')['id']
+            work['lot_id'] = work['pos'].map(first_lot)
+        else:
+            work['lot_id'] = np.nan
+        no_lot = work['lot_id'].isna()
+        for pos, ln, lvl in work.loc[no_lot, ['pos', 'lot_num', 'level']].itertuples(index=False):
+            errors.append((pos, f"Không tìm thấy Lô {ln} (Mức {lvl}) cho XN này."))
+        work = work[~no_lot].copy()
+        work['lot_id'] = work['lot_id'].astype(int)
+        timings['lots'] = time.perf_counter() - t0
+
+        # --- 4. KIỂM TRA TRÙNG (1 truy vấn theo khoảng ngày) ---
+        t0 = time.perf_counter()
+        if not work.empty:
+            existing = self._fetch_iqc_keys(
+                work['lot_id'].unique().tolist(),
+                work['run_date'].min().strftime('%Y-%m-%d %H:%M:%S'),
+                work['run_date'].max().strftime('%Y-%m-%d %H:%M:%S'))
+            if not existing.empty:
+                existing = pd.DataFrame({
+                    'lot_id': existing['lot_id'].astype(int),
+                    'run_date': _parse_dates(existing['date']).dt.floor('s'),
+                    'value': existing['value'].astype(float),
+                    'dup': True,
+                }).drop_duplicates(['lot_id', 'run_date', 'value'])
+                work = work.merge(existing, on=['lot_id', 'run_date', 'value'], how='left')
+                work = work[work['dup'].isna()].drop(columns='dup')
+            # Các dòng trùng nhau ngay trong file chỉ ghi 1 lần
+            work = work.drop_duplicates(['lot_id', 'run_date', 'value'])
+        timings['duplicates'] = time.perf_counter() - t0
+
+        # --- 5. GHI THEO KHỐI ---
+        t0 = time.perf_counter()
+        rows = [
+            {"lot_id": int(lot_id), "date": d.strftime('%Y-%m-%d %H:%M:%S'), "value": float(v), "level": int(lvl), "note": note}
+            for lot_id, d, v, lvl, note in work[['lot_id', 'run_date', 'value', 'level', 'note']].itertuples(index=False)
+        ]
+        # Chấm Westgard từng điểm mới theo trạng thái 10 điểm cuối của mỗi lot/level
+        stale = self._score_new_rows(rows)
         success_count = 0
-        errors = []
-        for _, row in df.iterrows():
+        for i in range(0, len(rows), self.IMPORT_CHUNK_SIZE):
+            chunk = rows[i:i + self.IMPORT_CHUNK_SIZE]
             try:
-                ext_name = str(row['Tên xét nghiệm']).strip()
-                lot_num = str(row['Lô']).strip()
-                level = int(row['Mức QC'])
-                value = float(row['Kết quả'])
-                run_date_raw = pd.to_datetime(row['Thời gian chạy'])
-                run_date_iso = run_date_raw.strftime('%Y-%m-%d %H:%M:%S')
-
-                # Mapping
-                map_res = self.supabase.table("test_mapping").select("test_id").eq("external_name", ext_name).execute()
-                if not map_res.data:
-                    errors.append(f"Chưa mapping tên: {ext_name}")
-                    continue
-                test_id = map_res.data[0]['test_id']
-
-                # Lot lookup (Sử dụng ilike cho Supabase)
-                lot_res = self.supabase.table("lots").select("id")\
-                    .eq("test_id", test_id).ilike("lot_number", f"%{lot_num}%").eq("level", level).execute()
-
-                if not lot_res.data:
-                    errors.append(f"Không tìm thấy Lô {lot_num} (Mức {level}) cho XN này.")
-                    continue
-                lot_id = lot_res.data[0]['id']
-
-                # Check duplicate
-                dup_check = self.supabase.table("iqc_results").select("id")\
-                    .eq("lot_id", lot_id).eq("date", run_date_iso).eq("value", value).execute()
-                if dup_check.data: continue 
-
-                # Insert
-                ins_data = {
-                    "lot_id": lot_id, "date": run_date_iso, "value": value, 
-                    "level": level, "note": f"Import từ máy {row.get('Máy xét nghiệm', 'Excel')}"
-                }
-                self.supabase.table("iqc_results").insert(ins_data).execute()
-                success_count += 1
+                self._insert_rows("iqc_results", chunk)
+                success_count += len(chunk)
             except Exception as e:
-                errors.append(f"Lỗi dòng {row.get('Tên xét nghiệm', 'N/A')}: {str(e)}")
-        return success_count, errors
+                errors.append((len(df), f"Lỗi ghi khối dòng {i + 1}-{i + len(chunk)}: {str(e)}"))
+                # Các điểm sau khối lỗi đã được chấm như thể khối này có trong DB
+                stale.update(r['lot_id'] for r in chunk)
+        for lot_id in stale:
+            self.refresh_lot_verdicts(lot_id)
+        timings['insert'] = time.perf_counter() - t0
+        timings['total'] = time.perf_counter() - t_start
+
+        self.last_import_timings = timings
+        return success_count, [msg for _, msg in sorted(errors, key=lambda e: e[0])]
+
+    # --- CÁC TRUY VẤN THEO LÔ DÙNG CHO IMPORT ---
+    def _fetch_mappings(self, external_names):
+        """Trả về dict external_name -> test_id cho danh sách tên (1 truy vấn)."""
+        if not external_names:
+            return {}
+        res = self.supabase.table("test_mapping").select("external_name, test_id").in_("external_name", external_names).execute()
+        return {r['external_name']: r['test_id'] for r in res.data}
+
+    def _fetch_lots_for_tests(self, test_ids):
+        if not test_ids:
+            return pd.DataFrame()
+        res = self.supabase.table("lots").select("id, test_id, lot_number, level").in_("test_id", test_ids).execute()
+        return pd.DataFrame(res.data)
+
+    def _fetch_iqc_keys(self, lot_ids, d_min, d_max):
+        """Lấy (lot_id, date, value) đã có trong khoảng ngày, đọc theo trang để không bị giới hạn 1000 dòng."""
+        rows, page = [], 1000
+        while True:
+            res = self.supabase.table("iqc_results").select("id, lot_id, date, value")\
+                .in_("lot_id", lot_ids).gte("date", d_min).lte("date", d_max)\
+                .order("id").range(len(rows), len(rows) + page - 1).execute()
+            rows.extend(res.data)
+            if len(res.data) < page:
+                break
+        return pd.DataFrame(rows)
+
+    def _fetch_lot_params(self, lot_ids):
+        """dict lot_id -> {'mean', 'sd', 'test_id'} cho danh sách lot (1 truy vấn)."""
+        if not lot_ids:
+            return {}
+        res = self.supabase.table("lots").select("id, test_id, mean, sd").in_("id", [int(l) for l in lot_ids]).execute()
+        return {r['id']: r for r in res.data}
+
+    def _fetch_level_tail(self, lot_id, level, limit):
+        """limit điểm cuối (mới nhất trước) của 1 chuỗi (lot, level) theo thứ tự (date, id)."""
+        res = self.supabase.table("iqc_results").select("id, date, value")\
+            .eq("lot_id", int(lot_id)).eq("level", int(level))\
+            .order("date", desc=True).order("id", desc=True).limit(limit).execute()
+        return res.data
+
+    def _fetch_lot_series(self, lot_id):
+        """Mọi kết quả của 1 lot (id, date, level, value, violation[, drift]), đọc theo trang."""
+        cols = ["id", "date", "level", "value", "violation"] + (["drift"] if self._drift_supported() else [])
+        rows, page = [], 1000
+        while True:
+            res = self.supabase.table("iqc_results").select(", ".join(cols))\
+                .eq("lot_id", int(lot_id)).order("id").range(len(rows), len(rows) + page - 1).execute()
+            rows.extend(res.data)
+            if len(res.data) < page:
+                break
+        return pd.DataFrame(rows, columns=cols)
+
+    def _write_verdicts(self, verdicts, column="violation"):
+        """verdicts: dict id -> kết quả. Gom theo kết quả nên mỗi loại vi phạm chỉ 1 request/khối id."""
+        by_label = {}
+        for row_id, label in verdicts.items():
+            by_label.setdefault(label, []).append(int(row_id))
+        for label, ids in by_label.items():
+            for i in range(0, len(ids), self.IMPORT_CHUNK_SIZE):
+                self.supabase.table("iqc_results").update({column: label})\
+                    .in_("id", ids[i:i + self.IMPORT_CHUNK_SIZE]).execute()
+
+    def _reset_verdicts(self, lot_ids):
+        """Đánh dấu chưa chấm (NULL) cho mọi kết quả của các lot."""
+        if not lot_ids or not self._verdicts_supported():
+            return
+        try:
+            self.supabase.table("iqc_results").update({"violation": None}).in_("lot_id", [int(l) for l in lot_ids]).execute()
+        except Exception as e:
+            print(f"Lỗi đánh dấu chấm lại Westgard: {e}")
+
+    def _insert_rows(self, table, rows):
+        """Ghi nhiều dòng trong 1 request."""
+        if rows:
+            self.supabase.table(table).insert(rows).execute()
+
+    def _update_rows_by_id(self, table, rows):
+        """Cập nhật nhiều dòng (mỗi dòng có 'id') trong 1 request bằng upsert theo khóa chính."""
+        if rows:
+            self.supabase.table(table).upsert(rows, on_conflict="id").execute()
 
     def get_iqc_results_all_sources(self, test_id):
-        res = self.supabase.table("iqc_results").select("*, lots!inner(lot_number, test_id)")\
-            .eq("lots.test_id", test_id).order("date", desc=True).execute()
-        flat_data = []
-        for r in res.data:
-            r['lot_number'] = r['lots']['lot_number']
-            flat_data.append(r)
-        return pd.DataFrame(flat_data)
+        df = self.read_iqc_stream(test_id)
+        # Mới nhất lên đầu như trước
+        return df.iloc[::-1].reset_index(drop=True)
 
     def debug_all_iqc_data(self):
-        # Supabase thực hiện left join
-        res = self.supabase.table("iqc_results").select("*, lots(lot_number, tests(name))").order("date", desc=True).execute()
-        flat_data = []
-        for r in res.data:
-            lot_info = r.get('lots', {})
-            test_info = lot_info.get('tests', {}) if lot_info else {}
-            flat_data.append({
-                "id": r['id'],
-                "lot_number": lot_info.get('lot_number') if lot_info else None,
-                "test_name": test_info.get('name') if test_info else None,
-                "date": r['date'],
-                "value": r['value'],
-                "level": r['level'],
-                "note": r['note']
-            })
-        return pd.DataFrame(flat_data)
+        df = self.read_iqc_stream(columns=("id", "date", "value", "level", "note"))
+        if df.empty:
+            return df
+        cols = ["id", "lot_number", "test_name", "date", "value", "level", "note"]
+        return df[cols].iloc[::-1].reset_index(drop=True)
 
     def add_mapping(self, test_id, external_name):
         data = {"test_id": test_id, "external_name": external_name}
         # upsert trong supabase yêu cầu cột external_name phải có ràng buộc UNIQUE
         self.supabase.table("test_mapping").upsert(data, on_conflict="external_name").execute()
+        self._invalidate("test_mapping")
 
     def get_all_mappings(self):
-        res = self.supabase.table("test_mapping").select("*, tests(name)").execute()
-        flat_data = []
-        for r in res.data:
-            r['internal_name'] = r['tests']['name']
-            flat_data.append(r)
-        return pd.DataFrame(flat_data)
+        rows = self._cached_rows(
+            ["test_mapping", "tests"], ("test_mapping", "all"),
+            lambda: self.supabase.table("test_mapping").select("*, tests(name)").execute().data
+        )
+        if not rows:
+            return pd.DataFrame()
+        df = pd.json_normalize(rows).rename(columns={'tests.name': 'internal_name'})
+        df['tests'] = [r['tests'] for r in rows]
+        return df
 
     def update_mapping(self, mapping_id, new_external_name):
         self.supabase.table("test_mapping").update({"external_name": new_external_name}).eq("id", mapping_id).execute()
+        self._invalidate("test_mapping")
 
     def delete_mapping(self, mapping_id):
         self.supabase.table("test_mapping").delete().eq("id", mapping_id).execute()
+        self._invalidate("test_mapping")
 
     def get_unmapped_tests(self, excel_test_names):
-        res = self.supabase.table("test_mapping").select("external_name").execute()
-        mapped_names = [row['external_name'] for row in res.data]
+        rows = self._cached_rows(
+            ["test_mapping"], ("test_mapping", "external_names"),
+            lambda: self.supabase.table("test_mapping").select("external_name").execute().data
+        )
+        mapped_names = [row['external_name'] for row in rows]
         unmapped = [name for name in excel_test_names if name not in mapped_names]
         return list(set(unmapped))
     
@@ -363,7 +1359,7 @@ class DBManager:
 
     def get_eqa_data(self, test_id):
         res = self.supabase.table("eqa_results").select("*").eq("test_id", test_id).order("date", desc=False).execute()
-        return pd.DataFrame(res.data)
+        return coerce_frame(pd.DataFrame(res.data), "eqa_results")
         
     def delete_eqa(self, eqa_id):
         try:
@@ -383,8 +1379,11 @@ class DBManager:
             return False
    
     def import_eqa_from_dataframe(self, df):
-        success_count = 0
-        errors = []
+        """
+        Import kết quả EQA: nhận diện cột 1 lần, tính SDI/ngày trên toàn cột,
+        tra mapping bằng 1 truy vấn và ghi theo khối. Vẫn báo lỗi theo từng dòng.
+        """
+        errors = []  # (vị trí dòng, thông báo)
         df.columns = [str(c).strip() for c in df.columns]
         cols = df.columns
         lab_col = next((c for c in cols if any(k in c.lower() for k in ['phòng xét nghiệm', 'kết quả', 'lab', 'pxn'])), None)
@@ -394,36 +1393,69 @@ class DBManager:
         prog_col = next((c for c in cols if any(k in c.lower() for k in ['chương trình', 'mã', 'đợt', 'program'])), None)
         date_col = next((c for c in cols if 'ngày' in c.lower()), None)
 
-        for index, row in df.iterrows():
+        line_no = pd.Series(df.index, index=df.index).map(lambda i: i + 2 if isinstance(i, (int, np.integer)) else i)
+        if not name_col or not lab_col or not ref_col:
+            return 0, [f"Dòng {n}: Thiếu cột." for n in line_no]
+
+        # --- TÍNH TOÁN TRÊN TOÀN CỘT ---
+        work = pd.DataFrame({
+            'pos': np.arange(len(df)),
+            'line': line_no.values,
+            'ext_name': df[name_col].astype(str).str.strip().values,
+            'lab_value': pd.to_numeric(df[lab_col], errors='coerce').values,
+            'ref_value': pd.to_numeric(df[ref_col], errors='coerce').values,
+        })
+        sd_group = pd.to_numeric(df[sd_col], errors='coerce').fillna(0).values if sd_col else np.zeros(len(df))
+        work['sd_group'] = sd_group
+        with np.errstate(divide='ignore', invalid='ignore'):
+            work['sdi'] = np.where(sd_group > 0, (work['lab_value'] - work['ref_value']) / np.where(sd_group > 0, sd_group, 1), 0.0)
+        if prog_col:
+            work['program_name'] = np.where(df[prog_col].isna(), "EQA Import", df[prog_col].astype(str))
+        else:
+            work['program_name'] = "EQA Import"
+        if date_col:
+            parsed = _parse_dates(df[date_col]).values
+            work['date'] = pd.Series(parsed).dt.strftime('%Y-%m-%d').values
+            work['bad_date'] = df[date_col].notna().values & pd.isna(parsed)
+            work['date'] = work['date'].fillna(datetime.now().strftime('%Y-%m-%d'))
+        else:
+            work['date'] = datetime.now().strftime('%Y-%m-%d')
+            work['bad_date'] = False
+
+        bad_value = work['lab_value'].isna() | work['ref_value'].isna()
+        for pos, line in work.loc[bad_value, ['pos', 'line']].itertuples(index=False):
+            errors.append((pos, f"Lỗi dòng {line}: Giá trị PXN/mục tiêu không phải số."))
+        work = work[~bad_value]
+
+        # --- MAPPING (1 truy vấn) ---
+        name_map = self._fetch_mappings(work['ext_name'].unique().tolist()) if not work.empty else {}
+        work = work.assign(test_id=work['ext_name'].map(name_map))
+        unmapped = work['test_id'].isna()
+        for pos, line, name in work.loc[unmapped, ['pos', 'line', 'ext_name']].itertuples(index=False):
+            errors.append((pos, f"Dòng {line}: Chưa map tên '{name}'"))
+        work = work[~unmapped]
+
+        for pos, line in work.loc[work['bad_date'], ['pos', 'line']].itertuples(index=False):
+            errors.append((pos, f"Lỗi dòng {line}: Không đọc được ngày."))
+        work = work[~work['bad_date']]
+
+        # --- GHI THEO KHỐI ---
+        rows = [
+            {"test_id": int(tid), "date": d, "lab_value": float(lab), "ref_value": float(ref),
+             "sd_group": float(sd), "sdi": float(sdi), "program_name": prog}
+            for tid, d, lab, ref, sd, sdi, prog in work[
+                ['test_id', 'date', 'lab_value', 'ref_value', 'sd_group', 'sdi', 'program_name']].itertuples(index=False)
+        ]
+        positions = work['pos'].tolist()
+        success_count = 0
+        for i in range(0, len(rows), self.IMPORT_CHUNK_SIZE):
+            chunk = rows[i:i + self.IMPORT_CHUNK_SIZE]
             try:
-                if not name_col or not lab_col or not ref_col:
-                    errors.append(f"Dòng {index+2}: Thiếu cột.")
-                    continue
-                ext_name = str(row[name_col]).strip()
-                lab_val = pd.to_numeric(row[lab_col], errors='coerce')
-                ref_val = pd.to_numeric(row[ref_col], errors='coerce')
-                sd_group = pd.to_numeric(row[sd_col], errors='coerce') if sd_col else 0
-                if pd.isna(sd_group): sd_group = 0
-                program_name = str(row[prog_col]) if prog_col and not pd.isna(row[prog_col]) else "EQA Import"
-                sdi_val = (lab_val - ref_val) / sd_group if sd_group > 0 else 0.0
-
-                map_res = self.supabase.table("test_mapping").select("test_id").eq("external_name", ext_name).execute()
-                if not map_res.data:
-                    errors.append(f"Dòng {index+2}: Chưa map tên '{ext_name}'")
-                    continue
-                test_id = map_res.data[0]['test_id']
-                res_date = pd.to_datetime(row[date_col]).strftime('%Y-%m-%d') if date_col and not pd.isna(row[date_col]) else datetime.now().strftime('%Y-%m-%d')
-
-                ins_data = {
-                    "test_id": test_id, "date": res_date, "lab_value": float(lab_val), 
-                    "ref_value": float(ref_val), "sd_group": float(sd_group), 
-                    "sdi": float(sdi_val), "program_name": program_name
-                }
-                self.supabase.table("eqa_results").insert(ins_data).execute()
-                success_count += 1
+                self._insert_rows("eqa_results", chunk)
+                success_count += len(chunk)
             except Exception as e:
-                errors.append(f"Lỗi dòng {index+2}: {str(e)}")
-        return success_count, errors
+                errors.append((positions[i], f"Lỗi dòng {line_no.iloc[positions[i]]}-{line_no.iloc[positions[i + len(chunk) - 1]]}: {str(e)}"))
+        return success_count, [msg for _, msg in sorted(errors, key=lambda e: e[0])]
 
     def upgrade_eqa_table(self):
         pass
@@ -452,6 +1484,7 @@ class DBManager:
     def update_mu_review(self, test_id, review_date):
         try:
             self.supabase.table("tests").update({"last_mu_review": review_date}).eq("id", test_id).execute()
+            self._invalidate("tests")
             return True
         except Exception as e:
             print(f"Error updating MU review: {e}")
@@ -460,6 +1493,7 @@ class DBManager:
     def set_setting(self, key, value):
         try:
             self.supabase.table("settings").upsert({"key": key, "value": value}, on_conflict="key").execute()
+            self._invalidate("settings")
             return True
         except Exception as e:
             print(f"LỖI DB: Không thể lưu cài đặt {key}: {e}")
@@ -474,16 +1508,18 @@ class DBManager:
         pass
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
+def get_db_manager():
+    """
+    Chọn backend lưu trữ theo cấu hình trong Streamlit Secrets:
+        [database]
+        backend = "sqlite"      # hoặc "supabase" (mặc định)
+        path = "lab_data.db"    # chỉ dùng cho sqlite
+    """
+    try:
+        cfg = dict(st.secrets.get("database", {}))
+    except Exception:
+        cfg = {}
+    if str(cfg.get("backend", "supabase")).lower() == "sqlite":
+        from sqlite_backend import SQLiteDBManager
+        return SQLiteDBManager(cfg.get("path", "lab_data.db"))
+    return DBManager()
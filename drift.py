@@ -0,0 +1,141 @@
+# File: drift.py
+"""
+Phát hiện trôi nhỏ kéo dài trên z-score IQC bằng EWMA và CUSUM dạng bảng, chạy song song với Westgard.
+Mỗi chuỗi (lot, level) có 1 trạng thái DriftState; điểm mới được cập nhật O(1) từ trạng thái đã lưu
+(DriftStream), còn lịch sử được tính lại vector hóa (drift_history) cho biểu đồ và nhật ký vi phạm.
+  EWMA:  e_n = λ z_n + (1 - λ) e_{n-1},  báo khi |e_n| > L * σ_e(n),  σ_e(n)² = λ/(2-λ) * (1 - (1-λ)^(2n))
+  CUSUM: C+_n = max(0, C+_{n-1} + z_n - k),  C-_n = max(0, C-_{n-1} - z_n - k),  báo khi C > h
+Sau mỗi lần báo, trạng thái được đặt lại về 0 (bắt đầu theo dõi lại) để 1 đợt trôi không báo liên tục.
+"""
+import json
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+DriftParams = namedtuple("DriftParams", ["lam", "L", "k", "h"])
+DEFAULT_DRIFT_PARAMS = DriftParams(lam=0.2, L=3.0, k=0.5, h=5.0)
+DriftState = namedtuple("DriftState", ["n", "ewma", "cusum_hi", "cusum_lo"])
+EMPTY_STATE = DriftState(0, 0.0, 0.0, 0.0)
+DRIFT_LABELS = ("EWMA (+)", "EWMA (-)", "CUSUM (+)", "CUSUM (-)")
+# Số điểm mỗi khối khi tính lại lịch sử: mỗi lần báo chỉ phải tính lại tối đa 1 khối
+HISTORY_BLOCK = 256
+
+
+def parse_drift_params(value):
+    """Thông số lưu trong settings (JSON) -> DriftParams; thiếu/sai thì dùng mặc định."""
+    if isinstance(value, DriftParams):
+        return value
+    try:
+        raw = json.loads(value) if isinstance(value, str) else dict(value or {})
+        params = DEFAULT_DRIFT_PARAMS._replace(**{f: float(raw[f]) for f in DriftParams._fields if f in raw})
+    except Exception:
+        return DEFAULT_DRIFT_PARAMS
+    if not (0 < params.lam <= 1 and params.L > 0 and params.k >= 0 and params.h > 0):
+        return DEFAULT_DRIFT_PARAMS
+    return params
+
+
+def dump_drift_params(params):
+    return json.dumps(dict(parse_drift_params(params)._asdict()))
+
+
+def _ewma_sigma(n, lam):
+    return np.sqrt(lam / (2 - lam) * (1 - (1 - lam) ** (2 * np.asarray(n, dtype=float))))
+
+
+def drift_label(n, ewma, cusum_hi, cusum_lo, params):
+    """Nhãn báo trôi của 1 điểm ('' nếu không báo), các nhãn nối bằng ', '."""
+    limit = params.L * _ewma_sigma(n, params.lam)
+    flags = (ewma > limit, ewma < -limit, cusum_hi > params.h, cusum_lo > params.h)
+    return ", ".join(label for label, hit in zip(DRIFT_LABELS, flags) if hit)
+
+
+class DriftStream:
+    """Cập nhật EWMA/CUSUM của 1 chuỗi (lot, level) từng điểm một từ trạng thái đã lưu."""
+
+    def __init__(self, mean, sd, params=None, state=None):
+        self.mean, self.sd = mean, sd
+        self.params = parse_drift_params(params)
+        self.state = DriftState(*state) if state is not None else EMPTY_STATE
+
+    def z_score(self, value):
+        # Cùng quy ước với LevelStream: z = 0 khi sd <= 0, thiếu thông số hoặc giá trị lỗi
+        try:
+            v = float(value)
+            return (v - self.mean) / self.sd if self.sd > 0 else 0
+        except Exception:
+            return 0
+
+    def push(self, value):
+        """Thêm 1 điểm, trả về (ewma, cusum_hi, cusum_lo, nhãn báo) của điểm đó."""
+        p, s, z = self.params, self.state, self.z_score(value)
+        n = s.n + 1
+        ewma = p.lam * z + (1 - p.lam) * s.ewma
+        hi = max(0.0, s.cusum_hi + z - p.k)
+        lo = max(0.0, s.cusum_lo - z - p.k)
+        label = drift_label(n, ewma, hi, lo, p)
+        self.state = EMPTY_STATE if label else DriftState(n, ewma, hi, lo)
+        return ewma, hi, lo, label
+
+
+def _lindley(x, start):
+    """C_t = max(0, C_{t-1} + x_t), C_0 = start, cho cả mảng: C_t = S_t - min(0, min_{j<=t} S_j)."""
+    s = start + np.cumsum(x)
+    return s - np.minimum(np.minimum.accumulate(s), 0)
+
+
+def drift_history(z, params=None, state=None):
+    """
+    EWMA/CUSUM của cả chuỗi z (cũ -> mới) bắt đầu từ `state`, vector hóa theo khối HISTORY_BLOCK điểm;
+    mỗi lần báo chỉ tính lại phần sau điểm báo. Trả về (DataFrame ewma/cusum_hi/cusum_lo/drift, trạng thái cuối).
+    """
+    p = parse_drift_params(params)
+    z = np.asarray(z, dtype=float)
+    total = len(z)
+    ewma, hi, lo = np.zeros(total), np.zeros(total), np.zeros(total)
+    labels = [""] * total
+    s = DriftState(*state) if state is not None else EMPTY_STATE
+    pos = 0
+    while pos < total:
+        block = z[pos:pos + HISTORY_BLOCK]
+        e, _ = lfilter([p.lam], [1, -(1 - p.lam)], block, zi=[(1 - p.lam) * s.ewma])
+        c_hi, c_lo = _lindley(block - p.k, s.cusum_hi), _lindley(-block - p.k, s.cusum_lo)
+        n = s.n + np.arange(1, len(block) + 1)
+        limit = p.L * _ewma_sigma(n, p.lam)
+        hit = (np.abs(e) > limit) | (c_hi > p.h) | (c_lo > p.h)
+        end = int(np.argmax(hit)) + 1 if hit.any() else len(block)
+        ewma[pos:pos + end], hi[pos:pos + end], lo[pos:pos + end] = e[:end], c_hi[:end], c_lo[:end]
+        if hit.any():
+            j = end - 1
+            labels[pos + j] = drift_label(n[j], e[j], c_hi[j], c_lo[j], p)
+            s = EMPTY_STATE
+        else:
+            s = DriftState(int(n[-1]), float(e[-1]), float(c_hi[-1]), float(c_lo[-1]))
+        pos += end
+    return pd.DataFrame({"ewma": ewma, "cusum_hi": hi, "cusum_lo": lo, "drift": labels}), s
+
+
+def add_drift_columns(df, mean, sd, params=None):
+    """
+    Thêm cột ewma, cusum_hi, cusum_lo, drift (nhãn báo, '' nếu không) cho kết quả IQC của 1 lot,
+    tính riêng từng mức theo thứ tự (date, id). Trả về (df mới, {level: trạng thái cuối}).
+    """
+    out = df.copy()
+    for col in ("ewma", "cusum_hi", "cusum_lo"):
+        out[col] = np.nan
+    out["drift"] = ""
+    states = {}
+    if out.empty:
+        return out, states
+    dates = out['date'] if pd.api.types.is_datetime64_any_dtype(out['date']) else pd.to_datetime(out['date'], errors='coerce')
+    valid = dates.notna() & out['level'].notna()
+    order = out[valid].assign(_d=dates[valid]).sort_values(['_d', 'id'], kind='stable')
+    stream = DriftStream(mean, sd, params)
+    for level, g in order.groupby('level', sort=False):
+        z = [stream.z_score(v) for v in g['value']]
+        hist, states[int(level)] = drift_history(z, stream.params)
+        out.loc[g.index, ["ewma", "cusum_hi", "cusum_lo"]] = hist[["ewma", "cusum_hi", "cusum_lo"]].to_numpy()
+        out.loc[g.index, "drift"] = hist["drift"].to_numpy()
+    return out, states
@@ -5,15 +5,25 @@ import sqlite3
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime, date, timedelta
-import matplotlib.dates as mdates
 import io
+import html
 import time
 import xlsxwriter
 from docx import Document
 from docx.shared import Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 
-from db_module import DBManager  
+from db_module import get_db_manager, get_pool_stats, stats_from_sums
+from westgard import get_westgard_violations, RULE_SETS, RULE_SET_LABELS
+from charts import render_levey_jennings
+from verification import calculate_clsi_ep15_a3_final
+from qc_status import scan_qc_status
+from qc_design import recommend_qc_design, TARGET_PED, MAX_PFR
+from drift import add_drift_columns
+from rule_replay import replay_rule_sets, REPLAY_MONTHS, EVENT_POINTS
+from render_cache import cached_render, render_cache_stats
+from vega_charts import (CHART_BACKEND_SETTING, CHART_BACKENDS, chart_backend, cusum_vmask_spec,
+                         render_levey_jennings_vega, sigma_chart_spec)
 
 # Nhập hàm từ file license_check.py
 # from license_check import verify_license, get_hwid 
@@ -28,13 +38,19 @@ from db_module import DBManager
 #st.success("Bản quyền hợp lệ. Chào mừng bạn!")
 # --- CẤU HÌNH ---
 st.set_page_config(page_title="QLCL Phòng Xét Nghiệm", layout="wide", page_icon="🔬")
-db = DBManager()
+db = get_db_manager()
 
 # --- STYLE CSS TÙY CHỈNH ---
 st.markdown("""
 <style>
     .footer {position: fixed; left: 0; bottom: 0; width: 100%; background-color: #f1f1f1; color: #333; text-align: center; padding: 10px; font-size: 14px; z-index: 999;}
     .block-container {padding-bottom: 50px;}
+    .qc-grid {display: grid; grid-template-columns: repeat(auto-fill, minmax(190px, 1fr)); gap: 8px;}
+    .qc-tile {border-radius: 6px; padding: 8px 10px; font-size: 13px; line-height: 1.35; color: #222;}
+    .qc-tile b {font-size: 15px;}
+    .qc-pass {background: #d4edda; border-left: 6px solid #28a745;}
+    .qc-warning {background: #fff3cd; border-left: 6px solid #ffc107;}
+    .qc-reject {background: #f8d7da; border-left: 6px solid #dc3545;}
 </style>
 """, unsafe_allow_html=True)
 
@@ -337,397 +353,46 @@ def upgrade_database_structure():
         if conn is not None:
             conn.close()
 
-def show_qc_dashboard():
-    st.header("📊 Bảng theo dõi chất lượng tổng thể")
-    all_tests = db.get_all_tests()
-    
-    # Tạo lưới hiển thị (4 cột)
-    cols = st.columns(4)
-    for i, test in enumerate(all_tests):
-        with cols[i % 4]:
-            # Lấy kết quả mới nhất của XN này
-            latest_status = db.get_latest_westgard_status(test['id']) 
-            
-            if latest_status == "OK":
-                st.info(f"✅ **{test['name']}**\n\nTrạng thái: Đạt")
-            else:
-                st.error(f"❌ **{test['name']}**\n\nLỗi: {latest_status}")
-def check_westgard_multi_level(df):
-    """
-    Kiểm tra lỗi 6x, 9x, 12x cho 3 mức nồng độ cùng 1 bên so với đường trung tâm.
-    Quy tắc: n kết quả liên tiếp (gộp cả 3 levels) nằm cùng phía so với Mean.
-    """
-    # Sắp xếp toàn bộ dữ liệu theo thời gian
-    df_sorted = df.sort_values('date').copy()
-    if len(df_sorted) < 6:
-        return []
-
-    # Tính Z-score cho từng dòng để biết nằm bên nào của đường Mean (0)
-    df_sorted['side'] = df_sorted.apply(
-        lambda r: 1 if (r['value'] - r['target_mean']) > 0 else -1 if (r['value'] - r['target_mean']) < 0 else 0,
-        axis=1
-    )
-    
-    violation_logs = []
-    sides = df_sorted['side'].tolist()
-    dates = df_sorted['date'].tolist()
-    levels = df_sorted['level'].tolist()
-
-    for i in range(len(sides)):
-        # Kiểm tra 12x (4 lượt chạy x 3 mức = 12 điểm liên tiếp)
-        if i >= 11:
-            window = sides[i-11:i+1]
-            if all(x == 1 for x in window) or all(x == -1 for x in window):
-                violation_logs.append(f"❌ Lỗi 12x: 4 lượt chạy (12 điểm) cùng bên tại {dates[i].strftime('%d/%m %H:%M')}")
-                continue # Đã dính lỗi nặng nhất thì bỏ qua các lỗi nhỏ hơn tại điểm đó
-
-        # Kiểm tra 9x (3 lượt chạy x 3 mức = 9 điểm liên tiếp)
-        if i >= 8:
-            window = sides[i-8:i+1]
-            if all(x == 1 for x in window) or all(x == -1 for x in window):
-                violation_logs.append(f"⚠️ Lỗi 9x: 3 lượt chạy (9 điểm) cùng bên tại {dates[i].strftime('%d/%m %H:%M')}")
-                continue
-
-        # Kiểm tra 6x (2 lượt chạy x 3 mức = 6 điểm liên tiếp)
-        if i >= 5:
-            window = sides[i-5:i+1]
-            if all(x == 1 for x in window) or all(x == -1 for x in window):
-                violation_logs.append(f"ℹ️ Lỗi 6x: 2 lượt chạy (6 điểm) cùng bên tại {dates[i].strftime('%d/%m %H:%M')}")
-
-    return violation_logs
-def get_westgard_violations(df, mean_map, sd_map):
-    if df is None or df.empty:
-        return df
-
-    df = df.copy()
-    if 'id' not in df.columns: df['id'] = range(len(df))
-    df['date'] = pd.to_datetime(df['date'], format='mixed', dayfirst=True, errors='coerce')
-    df_calc = df.dropna(subset=['date']).sort_values(by=['date', 'level']).copy()
-    
-    def calc_z(row):
-        try:
-            lvl = row['level']
-            val = float(row['value'])
-            
-            # Lấy Mean/SD từ dict hoặc từ giá trị đơn lẻ một cách an toàn
-            m = mean_map.get(lvl, 0) if isinstance(mean_map, dict) else mean_map
-            s = sd_map.get(lvl, 0) if isinstance(sd_map, dict) else sd_map
-            
-            return (val - m) / s if s > 0 else 0
-        except Exception:
-            return 0
-
-    # Tính toán Z-score an toàn, không còn lỗi dict > int
-    df_calc['z_score'] = df_calc.apply(calc_z, axis=1)
-    
-    violation_map = {row_id: set() for row_id in df_calc['id']}
-
-# --- 1. KIỂM TRA ACROSS-LEVEL (Cập nhật cho 3 mức) ---
-    groups = [group for _, group in df_calc.groupby('date')]
-    for i in range(len(groups)):
-        df_day = groups[i]
-        # Lấy dữ liệu 3 mức của ngày đó
-        l1 = df_day[df_day['level'] == 1].head(1)
-        l2 = df_day[df_day['level'] == 2].head(1)
-        l3 = df_day[df_day['level'] == 3].head(1)
-        
-        levels_present = [l for l in [l1, l2, l3] if not l.empty]
-        
-        # Kiểm tra R-4s giữa bất kỳ cặp mức nào (1-2, 2-3, 1-3)
-        if len(levels_present) >= 2:
-            for a in range(len(levels_present)):
-                for b in range(a + 1, len(levels_present)):
-                    z_a = levels_present[a]['z_score'].iloc[0]
-                    z_b = levels_present[b]['z_score'].iloc[0]
-                    if (z_a >= 2 and z_b <= -2) or (z_a <= -2 and z_b >= 2):
-                        violation_map[levels_present[a]['id'].iloc[0]].add("R-4s")
-                        violation_map[levels_present[b]['id'].iloc[0]].add("R-4s")
-        
-        # 2-2s (Across): Cả 3 mức (hoặc 2/3 mức) cùng vi phạm > 2SD về 1 phía
-        z_scores = [l['z_score'].iloc[0] for l in levels_present]
-        if len(z_scores) >= 2:
-            if all(z > 2 for z in z_scores) or all(z < -2 for z in z_scores):
-                 for l in levels_present: violation_map[l['id'].iloc[0]].add("2-2s")
-
-    # --- 1. KIỂM TRA ACROSS-LEVEL (So sánh giữa các mức) ---
-    groups = [group for _, group in df_calc.groupby('date')]
-    for i in range(len(groups)):
-        df_day = groups[i]
-        l1_curr = df_day[df_day['level'] == 1].head(1)
-        l2_curr = df_day[df_day['level'] == 2].head(1)
-        
-        if not l1_curr.empty and not l2_curr.empty:
-            z1, z2 = l1_curr['z_score'].iloc[0], l2_curr['z_score'].iloc[0]
-            id1, id2 = l1_curr['id'].iloc[0], l2_curr['id'].iloc[0]
-
-            # R-4s: 1 cái > +2SD và 1 cái < -2SD
-            if (z1 >= 2 and z2 <= -2) or (z1 <= -2 and z2 >= 2):
-                violation_map[id1].add("R-4s"); violation_map[id2].add("R-4s")
-
-            # 2-2s (Across): Cả 2 mức cùng nằm 1 bên và rơi vào khoảng ±2SD đến ±3SD
-            if (2 < z1 < 3 and 2 < z2 < 3) or (-3 < z1 < -2 and -3 < z2 < -2):
-                violation_map[id1].add("2-2s") ; violation_map[id2].add("2-2s")
-
-            # 4-1s (Across): 2 phiên liên tiếp của 2 mức cùng phía > 1SD
-            if i >= 1:
-                prev_g = groups[i-1]
-                l1p, l2p = prev_g[prev_g['level']==1], prev_g[prev_g['level']==2]
-                if not l1p.empty and not l2p.empty:
-                    zs = [z1, z2, l1p['z_score'].iloc[0], l2p['z_score'].iloc[0]]
-                    ids = [id1, id2, l1p['id'].iloc[0], l2p['id'].iloc[0]]
-                    if all(v > 1 for v in zs) or all(v < -1 for v in zs):
-                        for tid in ids: violation_map[tid].add("4-1s")
-
-            # 10x (Across): 5 phiên liên tiếp của 2 mức cùng phía Mean
-            if i >= 4:
-                combined_z = []
-                combined_ids = []
-                for k in range(i-4, i+1):
-                    combined_z.extend(groups[k]['z_score'].tolist())
-                    combined_ids.extend(groups[k]['id'].tolist())
-                if len(combined_z) >= 10 and (all(v > 0 for v in combined_z) or all(v < 0 for v in combined_z)):
-                    for tid in combined_ids: violation_map[tid].add("10x")
-
-    # --- 2. KIỂM TRA WITHIN-LEVEL (Chuỗi thời gian từng mức) ---
-    for level, df_level in df_calc.groupby('level'):
-        df_level = df_level.sort_values(by='date').reset_index(drop=True)
-        z, ids = df_level['z_score'].tolist(), df_level['id'].tolist()
-        for i in range(len(z)):
-            cid = ids[i]
-            if abs(z[i]) > 3: violation_map[cid].add("1-3s")
-            if i >= 1 and ((2 < z[i] < 3 and 2 < z[i-1] < 3) or (-3 < z[i] < -2 and -3 < z[i-1] < -2)):
-                violation_map[cid].add("2-2s")
-            if i >= 3:
-                sub4 = z[i-3:i+1]
-                if all(v > 1 for v in sub4) or all(v < -1 for v in sub4): violation_map[cid].add("4-1s")
-            if i >= 5:
-                sub6 = z[i-5:i+1]
-                if all(v > 1 for v in sub6) or all(v < -1 for v in sub6): violation_map[cid].add("Shift")
-                if all(sub6[k] < sub6[k+1] for k in range(5)): violation_map[cid].add("Trend (+)")
-                elif all(sub6[k] > sub6[k+1] for k in range(5)): violation_map[cid].add("Trend (-)")
-            if i >= 9:
-                sub10 = z[i-9:i+1]
-                if all(v > 0 for v in sub10) or all(v < 0 for v in sub10): violation_map[cid].add("10x")
-            if not violation_map[cid] and 2 < abs(z[i]) <= 3: violation_map[cid].add("1-2s")
-
-    final_res = {k: ", ".join(sorted(list(v))) for k, v in violation_map.items()}
-    df['Violation'] = df['id'].map(final_res).replace("", "ĐẠT").fillna("ĐẠT")
-    return df
-
-# 2. HÀM KIỂM TRA WESTGARD CHÍNH
-def check_westgard_rules(df_all):
-    """
-    Hàm chính kiểm tra toàn bộ quy tắc Westgard (Within & Across).
-    Input: DataFrame chứa toàn bộ dữ liệu IQC (cần có cột: id, date, level, z_score).
-    Output: Tuple (final_rejections, final_warnings)
-            Mỗi phần tử là list các tuple: (iqc_id, "Tên lỗi", "Mức độ")
-    """
-    
-    if df_all.empty or 'z_score' not in df_all.columns:
-        return ([], [])
-
-    # Sắp xếp dữ liệu theo thời gian
-    df_all = df_all.sort_values(by=['date', 'level']).reset_index(drop=True)
-
-    rejection_details = {} # {id: "Rule name"}
-    warning_details = {}   # {id: "Rule name"}
-
-    # --- BƯỚC 1: KIỂM TRA ACROSS-LEVELS (Check từng ngày) ---
-    for date, df_day in df_all.groupby('date'):
-        cross_errors = check_cross_level_rules(df_day)
-        # Cập nhật lỗi vào danh sách từ chối
-        rejection_details.update(cross_errors)
-
-    # --- BƯỚC 2: KIỂM TRA WITHIN-LEVEL (Check chuỗi thời gian của từng Level) ---
-    
-    # Tạo bản sao để xử lý
-    df_temp = df_all.copy()
-    
-    # Lặp qua từng Level (L1, L2)
-    for level, df_level in df_temp.groupby('level'):
-        df_level = df_level.sort_values(by='date').reset_index(drop=True)
-        z_values = df_level['z_score'].tolist()
-        id_values = df_level['id'].tolist()
-        n = len(z_values)
-        
-        for i in range(n):
-            current_id = id_values[i]
-            current_z = z_values[i]
-            
-     # Nếu điểm này đã bị lỗi Across-Level (R4s, v.v) thì bỏ qua
-            if current_id in rejection_details:
-                continue
-
-    # === QUY TẮC TỪ CHỐI (REJECTION) ===
-            
-      # 1-3s: Một điểm nằm ngoài ±3SD
-            if abs(current_z) > 3:
-                rejection_details[current_id] = "1-3s: Điểm vượt quá 3SD (Lỗi Ngẫu nhiên)"
-                continue
-                
-     # 2-2s (Within): Hai điểm liên tiếp cùng phía nằm ngoài ±2SD
-            if i >= 1:
-                prev_z = z_values[i-1]
-                if ((current_z > 2 and prev_z > 2) or (current_z < -2 and prev_z < -2)):
-                    rule = "2-2s(Within): 2 điểm liên tiếp vượt 2SD (Lỗi Hệ thống)"
-                    rejection_details[current_id] = rule
-                    rejection_details[id_values[i-1]] = rule # Đánh dấu cả điểm trước
-                    continue
-            
-    # 4-1s (Within): Bốn điểm liên tiếp cùng phía ngoài ±1SD
-            if i >= 3:
-                last_4_z = z_values[i-3:i+1]
-                if all(z > 1 for z in last_4_z) or all(z < -1 for z in last_4_z):
-                    rule = "4-1s: 4 điểm liên tiếp vượt 1SD (Lỗi Hệ thống)"
-                    for k in range(4): rejection_details[id_values[i-k]] = rule
-                    continue
-            
-    # 10x (Shift): 10 điểm liên tiếp cùng phía Mean
-            if i >= 9:
-                last_10_z = z_values[i-9:i+1]
-                if all(z > 0 for z in last_10_z) or all(z < 0 for z in last_10_z):
-                    rule = "10x: 10 điểm liên tiếp cùng phía Mean (Shift)"
-                    for k in range(10): rejection_details[id_values[i-k]] = rule
-                    continue
-
-            # === QUY TẮC CẢNH BÁO (WARNING) ===
-            
-     # 1-2s: Điểm nằm ngoài ±2SD (nhưng < 3SD)
-            if current_id not in rejection_details:
-                if abs(current_z) > 2 and abs(current_z) <= 3:
-                    warning_details[current_id] = "1-2s: Cảnh báo (Điểm vượt 2SD)"
-            
-   # Trend: 6 điểm liên tiếp tăng hoặc giảm
-            if i >= 5:
-                last_6 = z_values[i-5:i+1]
-          # Tăng dần
-                if all(last_6[k] < last_6[k+1] for k in range(5)):
-                    warning_details[current_id] = "Trend: 6 điểm tăng dần liên tiếp"
-          # Giảm dần
-                elif all(last_6[k] > last_6[k+1] for k in range(5)):
-                    warning_details[current_id] = "Trend: 6 điểm giảm dần liên tiếp"
-
-
-    # --- BƯỚC 3: TỔNG HỢP KẾT QUẢ ---
-
-    final_rejections = []
-    final_warnings = []
-    
-    # Duyệt lại df_all để giữ thứ tự thời gian khi trả về
-    for index, row in df_all.iterrows():
-        iqc_id = row['id']
-        
-        # Ưu tiên lỗi REJECTION trước
-        if iqc_id in rejection_details:
-            final_rejections.append((iqc_id, rejection_details[iqc_id], "REJECTION"))
-            
-        # Nếu không Rejection thì xem có Warning không
-        elif iqc_id in warning_details:
-            final_warnings.append((iqc_id, warning_details[iqc_id], "WARNING"))
-            
-    # Trả về kết quả
-    return final_rejections, final_warnings
-
-
-
-def plot_levey_jennings(df, title, show_legend=True):
+def show_qc_dashboard(refresh_seconds=60):
     """
-    Vẽ biểu đồ Levey-Jennings dựa trên Z-Score.
-    Đã xử lý lỗi thiếu cột và định dạng ngày tháng hiển thị sai.
+    Tổng quan QC toàn phòng: chỉ đọc bảng qc_status (ghi bởi qc_status.scan_qc_status).
+    Phần lưới tự làm mới mỗi refresh_seconds giây mà không chạy lại cả trang.
     """
-    if df.empty: 
-        return None
-    
-    # 1. Đảm bảo cột date là định dạng datetime để matplotlib xử lý đúng trục X
-    df = df.copy()
-    # Sử dụng dayfirst=True để tránh lỗi đảo ngược ngày/tháng
-    df['date'] = pd.to_datetime(df['date'], dayfirst=True, errors='coerce')
-    df = df.dropna(subset=['date'])
-    # Sắp xếp toàn bộ dataframe theo ngày để tránh đường nối bị nhảy ngược
-    df = df.sort_values('date')
-
-    fig, ax = plt.subplots(figsize=(11, 6))
-    
-    # 2. Vẽ các vùng giới hạn SD (Duy trì các đường nằm ngang cố định tại Z = 0, 1, 2, 3)
-    ax.axhline(0, color='green', lw=2, label='Mean (Target)')
-    
-    # Vẽ các đường SD với nhãn cụ thể
-    sd_config = {
-        1: {'color': 'gold', 'label': '±1SD'},
-        2: {'color': 'red', 'label': '±2SD (Warning)'},
-        3: {'color': 'black', 'label': '±3SD (Reject)'}
-    }
-    
-    for sd, config in sd_config.items():
-        ax.axhline(sd, color=config['color'], ls='--', alpha=0.6, lw=1)
-        ax.axhline(-sd, color=config['color'], ls='--', alpha=0.6, lw=1)
-        # Ghi chú nhãn ở mép phải biểu đồ (sử dụng ngày cuối cùng trong dữ liệu)
-        last_date = df['date'].max()
-        ax.text(last_date, sd, f" +{sd}SD", va='center', fontsize=8, color=config['color'])
-        ax.text(last_date, -sd, f" -{sd}SD", va='center', fontsize=8, color=config['color'])
-    
-    colors = {1: 'blue', 2: 'orange', 3: 'red'}
-        
-    # 3. Tính Z-Score và Vẽ dữ liệu từng Level
-    for lvl in [1, 2, 3]:
-        d_lvl = df[df['level'] == lvl].copy()
-        if d_lvl.empty:
-            continue
-            
-        # Kiểm tra xem có đủ cột để tính toán không (Tránh KeyError)
-        if 'target_mean' in d_lvl.columns and 'target_sd' in d_lvl.columns:
-            # Tránh chia cho 0 nếu SD chưa được thiết lập
-            d_lvl['z'] = d_lvl.apply(
-                lambda r: (r['value'] - r['target_mean']) / r['target_sd'] if r['target_sd'] > 0 else 0, 
-                axis=1
+    st.header("📊 Bảng theo dõi chất lượng tổng thể")
+    order = {"reject": 0, "warning": 1, "pass": 2}
+
+    @st.fragment(run_every=refresh_seconds)
+    def status_grid():
+        df_status = db.get_qc_status()
+        if df_status.empty:
+            st.info("Chưa có dữ liệu trạng thái. Vào tab Quản trị > Trạng thái QC toàn phòng và bấm Quét lại, "
+                    "hoặc chạy định kỳ `python qc_status.py`.")
+            return
+
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("Xét nghiệm", df_status['test_id'].nunique())
+        c2.metric("❌ Vi phạm dừng", int((df_status['status'] == "reject").sum()))
+        c3.metric("⚠️ Cảnh báo", int((df_status['status'] == "warning").sum()))
+        c4.metric("📝 Vi phạm chưa xử lý", int(df_status['open_rejections'].sum()))
+
+        # Mỗi test 1 ô, màu theo mức nặng nhất; ô lỗi lên đầu
+        tiles = []
+        for _, g in df_status.groupby('test_id', sort=False):
+            worst = min(g['status'].fillna("pass"), key=lambda v: order.get(v, 0))
+            lines = "".join(
+                f"<div>L{int(r['level'])} · {html.escape(str(r['last_verdict']))} · {r['last_run']:%d/%m %H:%M}"
+                + (f" · 📝{int(r['open_rejections'])}" if r['open_rejections'] else "") + "</div>"
+                for _, r in g.iterrows()
             )
-        else:
-            d_lvl['z'] = 0 
-            
-        # Vẽ đường nối và điểm dữ liệu
-        ax.plot(d_lvl['date'], d_lvl['z'], color=colors[lvl], alpha=0.4, lw=1.5, zorder=2)
-        ax.scatter(d_lvl['date'], d_lvl['z'], color=colors[lvl], s=40, 
-                   label=f"Level {lvl}", edgecolors='white', zorder=4)
-        
-        # 4. Đánh dấu thay đổi Lot
-        if 'lot_number' in d_lvl.columns and not d_lvl['lot_number'].isnull().all():
-            changes = d_lvl.drop_duplicates(subset=['lot_number'], keep='first')
-            for _, r in changes.iterrows():
-                if r['date'] != df['date'].min():
-                    ax.axvline(r['date'], color='gray', ls=':', alpha=0.4, zorder=1)
-                    ax.text(r['date'], 3.8, f" Lot: {r['lot_number']}", 
-                            rotation=90, fontsize=7, color='gray', va='top')
-# 5. Kiểm tra Westgard và hiển thị thông báo
-    violations = check_westgard_multi_level(df)
-    
-    # Hiển thị kết quả kiểm tra Westgard trực tiếp dưới biểu đồ bằng Streamlit
-    if violations:
-        with st.expander("🚨 CẢNH BÁO QUY TẮC WESTGARD (6x, 9x, 12x)", expanded=True):
-            for v in violations[-5:]: # Hiển thị 5 lỗi gần nhất
-                st.write(v)
-    # 5. CẤU HÌNH ĐỊNH DẠNG NGÀY THÁNG (SỬA LỖI HIỂN THỊ)
-    # Định dạng trục X hiển thị: Ngày/Tháng Giờ:Phút
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%d/%m'))
-    
-    # Thiết lập khoảng cách chia (tự động điều chỉnh để không quá dày)
-    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
-
-    ax.set_ylim(-4.5, 4.5) 
-    ax.set_ylabel("Z-Score (Độ lệch chuẩn)")
-    ax.set_xlabel("Thời gian thực hiện")
-    ax.set_title(title, fontweight='bold', pad=15)
-    
-    # Tự động xoay ngày tháng trên trục X và căn chỉnh
-    fig.autofmt_xdate(rotation=30, ha='right')
-    
-    if show_legend:
-        handles, labels = ax.get_legend_handles_labels()
-        by_label = dict(zip(labels, handles))
-        ax.legend(by_label.values(), by_label.keys(), loc='upper left', bbox_to_anchor=(1, 1))
-
-    plt.tight_layout()
-    return fig
-
+            first = g.iloc[0]
+            tiles.append((order.get(worst, 0), str(first['test_name']),
+                          f"<div class='qc-tile qc-{worst}'><b>{html.escape(str(first['test_name']))}</b> "
+                          f"<small>{html.escape(str(first['device']))}</small>{lines}</div>"))
+        tiles.sort(key=lambda t: t[:2])
+        st.markdown("<div class='qc-grid'>" + "".join(t[2] for t in tiles) + "</div>", unsafe_allow_html=True)
+        st.caption(f"Quét lúc {df_status['updated_at'].max():%d/%m/%Y %H:%M} · tự làm mới mỗi {refresh_seconds} giây")
+
+    status_grid()
 def plot_cusum_chart(df_eqa):
     """
     Vẽ biểu đồ CUSUM với V-Mask (Góc 28°, d=10)
@@ -795,75 +460,6 @@ def plot_cusum_chart(df_eqa):
     plt.tight_layout()
     return fig, is_violated
 
-import numpy as np
-import scipy.stats as stats
-def handle_outliers_grubbs(matrix):
-    """
-    Tự động phát hiện và xử lý giá trị ngoại lệ theo chuẩn EP15-A3.
-    Hệ số G tới hạn cho n=25 là 3.135.
-    """
-    flat_data = [item for sublist in matrix for item in sublist]
-    n = len(flat_data)
-    mean = np.mean(flat_data)
-    sd = np.std(flat_data, ddof=1)
-    
-    g_critical = 3.135 # Giá trị tới hạn cho n=25, alpha=0.05
-    
-    outliers = []
-    cleaned_matrix = []
-    
-    # Duyệt từng điểm dữ liệu
-    for i, day in enumerate(matrix):
-        new_day = []
-        for val in day:
-            g_score = abs(val - mean) / sd
-            if g_score > g_critical:
-                outliers.append({"day": i+1, "value": val, "g_score": g_score})
-                # Thay thế giá trị ngoại lệ bằng trung bình của ngày đó (để không làm hỏng ANOVA)
-                # Hoặc có thể dùng np.nan nếu hàm ANOVA của bạn xử lý được
-                new_day.append(np.mean(day)) 
-            else:
-                new_day.append(val)
-        cleaned_matrix.append(new_day)
-        
-    return cleaned_matrix, outliers
-def calculate_clsi_ep15_a3_final(matrix, claim_sr, claim_sl, target_mean):
-    # 1. Xử lý ngoại lệ trước khi tính toán
-    cleaned_matrix, found_outliers = handle_outliers_grubbs(matrix)
-    
-    n_run = 5
-    n_rep = 5
-    
-    # 2. ANOVA trên dữ liệu đã làm sạch
-    flat_data = [item for sublist in cleaned_matrix for item in sublist]
-    grand_mean = np.mean(flat_data)
-    
-    day_means = [np.mean(day) for day in cleaned_matrix]
-    day_vars = [np.var(day, ddof=1) for day in cleaned_matrix]
-    
-    ms_within = np.mean(day_vars) 
-    ms_between = np.var(day_means, ddof=1) * n_rep
-    
-    s_r = np.sqrt(ms_within)
-    v_b = max(0, (ms_between - ms_within) / n_rep)
-    s_l = np.sqrt(v_b + ms_within)
-    
-    # 3. Tính UVL và VI (giữ nguyên logic trước)
-    uvl_l = claim_sl * 1.32 
-    se_x_bar = np.sqrt((1/n_run) * (s_l**2 - (1 - 1/n_rep) * s_r**2))
-    t_val = 2.776 
-    vi_half = t_val * se_x_bar
-    vi_range = (target_mean - vi_half, target_mean + vi_half)
-    
-    return {
-        "grand_mean": grand_mean,
-        "s_r": s_r, "s_l": s_l,
-        "uvl_l": uvl_l,
-        "vi_range": vi_range,
-        "is_precision_pass": s_l <= uvl_l,
-        "is_trueness_pass": vi_range[0] <= grand_mean <= vi_range[1],
-        "outliers": found_outliers # Trả về danh sách ngoại lệ để hiển thị
-    }
 # --- CƠ SỞ DỮ LIỆU TRA CỨU TIÊU CHUẨN CLIA & BIOLOGICAL VARIATION ---
 STANDARD_DB = {
     "Glucose": {"tea": 8.0, "cvi": 5.6, "cvg": 7.8, "unit": "mg/dL"},
@@ -885,8 +481,9 @@ def generate_excel_report_comprehensive(test_info, df_full_iqc, df_eqa, mu_data,
     # --- 0. TIỀN XỬ LÝ DỮ LIỆU (QUAN TRỌNG NHẤT) ---
     # Ép buộc tính toán lỗi Westgard ngay tại đây để có cột 'Violation'
     if df_full_iqc is not None and not df_full_iqc.empty:
-        # Gọi hàm tính lỗi (Đảm bảo hàm get_westgard_violations đã có trong main)
-        df_full_iqc = get_westgard_violations(df_full_iqc, mu_data, sigma_data)
+        # Tính lỗi theo bộ quy tắc Westgard đã chọn cho test
+        rules = db.get_rule_set(test_info['id']) if test_info.get('id') is not None else None
+        df_full_iqc = get_westgard_violations(df_full_iqc, mu_data, sigma_data, rules)
         df_final = df_full_iqc.sort_values(['date', 'level'])
         
     else:
@@ -1292,6 +889,11 @@ def export_verification_excel(test_name, standard_info, input_matrix, results):
 
     return output.getvalue()
 
+# --- MÀN HÌNH TREO TƯỜNG (?view=wall): chỉ đọc bảng qc_status, không tải sidebar/tabs ---
+if st.query_params.get("view") == "wall":
+    show_qc_dashboard(refresh_seconds=30)
+    st.stop()
+
 # --- SIDEBAR: CONTROL PANEL ---
 
 st.sidebar.markdown("---")
@@ -1346,9 +948,15 @@ with st.sidebar.expander("➕ Thêm Test Mới"):
 if selected_test_name == "-- Chọn --":
     st.title("👋 Chào mừng đến với Phần mềm QLCL")
     st.info("Vui lòng chọn một xét nghiệm từ menu bên trái để bắt đầu.")
+    show_qc_dashboard()
+    st.caption("Màn hình treo tường: mở trang này với đường dẫn `?view=wall`.")
     st.stop()
 
 current_test = tests_options[selected_test_name]
+rule_set = db.get_rule_set(current_test['id'])
+drift_params = db.get_drift_params(current_test['id'])
+# Biểu đồ LJ / CUSUM / Decision Chart: ảnh matplotlib hoặc spec Vega-Lite vẽ trên trình duyệt (cài đặt ở tab Quản trị)
+chart_mode = chart_backend(db)
 
 
 # --- THAO TÁC SỬA/XÓA TEST ĐÃ CHỌN ---
@@ -1390,14 +998,52 @@ with st.sidebar.expander(f"⚙️ Sửa Test: {current_test['name']}"):
             else:
                 st.error("Lỗi khi lưu dữ liệu.")
 
-# 2. Nút Xóa Test
+# 2. Bộ quy tắc Westgard của Test
+with st.sidebar.expander(f"📐 Quy tắc Westgard: {RULE_SET_LABELS.get(rule_set, rule_set)}"):
+    rule_names = list(RULE_SETS)
+    new_rule_set = st.selectbox("Bộ quy tắc", rule_names, index=rule_names.index(rule_set),
+                                format_func=lambda k: RULE_SET_LABELS.get(k, k), key="rule_set_select")
+    st.caption(", ".join(spec.name for spec in RULE_SETS[new_rule_set]))
+    if st.button("Áp dụng bộ quy tắc", disabled=new_rule_set == rule_set):
+        if db.set_rule_set(current_test['id'], new_rule_set):
+            st.success("Đã đổi bộ quy tắc, kết quả IQC sẽ được chấm lại.")
+            st.rerun()
+        else:
+            st.error("Lỗi khi lưu bộ quy tắc.")
+
+# 2b. Báo trôi EWMA / CUSUM (chạy song song với Westgard, trên z-score của từng lot / mức)
+with st.sidebar.expander("📉 Báo trôi EWMA / CUSUM"):
+    st.caption("EWMA báo khi |EWMA| > L·σ(EWMA); CUSUM báo khi tổng lệch tích lũy (trừ k) vượt h. Đơn vị: SD.")
+    d_lam = st.number_input("λ (trọng số EWMA)", min_value=0.01, max_value=1.0, value=float(drift_params.lam),
+                            step=0.05, format="%.2f", key="drift_lam")
+    d_L = st.number_input("L (giới hạn EWMA)", min_value=0.5, value=float(drift_params.L), step=0.1,
+                          format="%.2f", key="drift_L")
+    d_k = st.number_input("k (độ lệch cho phép CUSUM)", min_value=0.0, value=float(drift_params.k), step=0.1,
+                          format="%.2f", key="drift_k")
+    d_h = st.number_input("h (ngưỡng báo CUSUM)", min_value=0.5, value=float(drift_params.h), step=0.5,
+                          format="%.2f", key="drift_h")
+    new_drift = {"lam": d_lam, "L": d_L, "k": d_k, "h": d_h}
+    if st.button("Áp dụng thông số", key="apply_drift_params",
+                 disabled=new_drift == dict(drift_params._asdict())):
+        if db.set_drift_params(current_test['id'], new_drift):
+            st.success("Đã lưu thông số, nhãn báo trôi sẽ được tính lại.")
+            st.rerun()
+        else:
+            st.error("Lỗi khi lưu thông số EWMA/CUSUM.")
+
+# 3. Nút Xóa Test
 with st.sidebar.expander("🗑️ Xóa Test (NGUY HIỂM)"):
     st.warning(f"Thao tác này sẽ xóa **Test {current_test['name']}** và **TẤT CẢ** dữ liệu IQC/EQA liên quan (Lot, Kết quả).")
     delete_confirm = st.checkbox(f"Tôi xác nhận muốn xóa Test **{current_test['name']}**", key="delete_test_confirm")
     
     if delete_confirm and st.button(f"THỰC HIỆN XÓA TEST", type="primary"):
-        db.delete_test(current_test['id'])
-        st.success("Đã xóa Test và dữ liệu liên quan."); st.rerun()
+        deleted = db.delete_test(current_test['id'])
+        if deleted:
+            st.success(f"Đã xóa Test và dữ liệu liên quan: {deleted.get('lots', 0)} Lot, "
+                       f"{deleted.get('iqc_results', 0)} kết quả IQC, {deleted.get('eqa_results', 0)} kết quả EQA.")
+            time.sleep(1); st.rerun()
+        else:
+            st.error("Không thể xóa Test. Dữ liệu chưa bị thay đổi.")
 # 3. QUẢN LÝ LOTS (CẬP NHẬT: Thêm Chỉnh sửa & Xóa)
 st.sidebar.markdown("---")
 st.sidebar.subheader("📦 Cấu hình Lot Đang Chạy")
@@ -1407,8 +1053,9 @@ lots_l1 = pd.DataFrame()
 lots_l2 = pd.DataFrame()
 lots_l3 = pd.DataFrame()
 
-# 2. Lấy dữ liệu (Giả sử bạn đã có all_lots từ db.get_lots_for_test)
-if 'all_lots' in locals() and not all_lots.empty:
+# 2. Lấy dữ liệu Lot của Test đang chọn (đọc qua bộ nhớ đệm của DBManager)
+all_lots = db.get_lots_for_test(current_test['id'])
+if not all_lots.empty:
     if 'level' in all_lots.columns:
         lots_l1 = all_lots[all_lots['level'] == 1]
         lots_l2 = all_lots[all_lots['level'] == 2]
@@ -1702,12 +1349,14 @@ with c_dat:
                             for idx in deleted_indices:
                                 try:
                                     actual_id = int(df_lvl.iloc[idx]['id'])
-                                    if db.delete_iqc_result(actual_id):
+                                    if db.delete_iqc_result(actual_id, refresh=False):
                                         success_count += 1
                                 except Exception as e:
                                     st.error(f"Lỗi truy xuất ID: {e}")
                             
                             if success_count > 0:
+                                # Chấm lại lot 1 lần sau khi xóa hết các dòng đã chọn
+                                db.refresh_lot_verdicts(cur_lot['id'])
                                 st.success(f"✅ Đã xóa {success_count} dòng Mức {lvl}")
                                 st.rerun()
                         else:
@@ -1771,7 +1420,8 @@ with tabs[1]:
                         data_list.append(df_tmp)
             df_plot = pd.concat(data_list) if data_list else pd.DataFrame()
         else:
-            # Lấy dư dữ liệu một chút để đảm bảo không sót khi lọc
+            # Lấy dư dữ liệu một chút để đảm bảo không sót khi lọc.
+            # Mỗi dòng đã có target_mean/target_sd và lot_number của chính lot của nó
             months_needed = 4 if "3 Tháng" in selected_label else 2
             df_plot = db.get_iqc_data_continuous(current_test['id'], max_months=months_needed)
 
@@ -1786,20 +1436,36 @@ with tabs[1]:
             df_plot = df_plot.loc[mask].sort_values('date')
 
             if not df_plot.empty:
-                # Gán thông số Target cho 3 Level
+                # lot_number là category: chuyển về chuỗi để gán được số Lot hiện tại
+                if 'lot_number' in df_plot.columns:
+                    df_plot['lot_number'] = df_plot['lot_number'].astype(object)
                 for lvl, lot in zip([1, 2, 3], [cur_lot_l1, cur_lot_l2, cur_lot_l3]):
                     if lot:
-                        l_mask = df_plot['level'] == lvl
-                        df_plot.loc[l_mask, 'target_mean'] = float(lot['mean'])
-                        df_plot.loc[l_mask, 'target_sd'] = float(lot['sd'])
-                        df_plot.loc[l_mask, 'lot_number'] = str(lot['lot_number'])
+                        # Chế độ lot đang chọn: dữ liệu đọc theo lot chưa có Target / số Lot
+                        if view_mode == "Chỉ Lot đang chọn":
+                            l_mask = df_plot['level'] == lvl
+                            df_plot.loc[l_mask, 'target_mean'] = float(lot['mean'])
+                            df_plot.loc[l_mask, 'target_sd'] = float(lot['sd'])
+                            df_plot.loc[l_mask, 'lot_number'] = str(lot['lot_number'])
+                        # EWMA và nhãn báo trôi của lot hiện tại (đường nét đứt / điểm hình thoi trên biểu đồ)
+                        analyzed = db.get_iqc_verdicts_by_lot(lot['id'], lot['mean'], lot['sd'], rule_set, drift_params)
+                        if not analyzed.empty and 'id' in df_plot.columns:
+                            ewma = add_drift_columns(analyzed, lot['mean'], lot['sd'], drift_params)[0]
+                            ewma = ewma.set_index('id')
+                            in_lot = df_plot['id'].isin(ewma.index)
+                            df_plot.loc[in_lot, 'ewma'] = df_plot.loc[in_lot, 'id'].map(ewma['ewma']).values
+                            df_plot.loc[in_lot, 'drift'] = df_plot.loc[in_lot, 'id'].map(ewma['Drift']).values
 
                 # 5. VẼ BIỂU ĐỒ
-                fig_lj = plot_levey_jennings(df_plot, f"Biểu đồ Levey-Jennings ({current_test['name']})")
-                st.pyplot(fig_lj)
-                
-                # Lưu vào Session State
-                st.session_state['fig_lj_report'] = fig_lj
+                # Ảnh lấy từ bộ nhớ đệm khi dữ liệu/tùy chọn không đổi giữa các lần rerun;
+                # lịch sử dài được giảm điểm theo chiều rộng ảnh, điểm vi phạm/đổi lot luôn được giữ
+                lj_title = f"Biểu đồ Levey-Jennings ({current_test['name']})"
+                lj_spec = render_levey_jennings_vega(df_plot, lj_title, rules=rule_set) if chart_mode == "vega" else None
+                if lj_spec:
+                    st.vega_lite_chart(lj_spec, use_container_width=True)
+                else:
+                    img_lj_view = render_levey_jennings(df_plot, lj_title, rules=rule_set)
+                    st.image(img_lj_view, use_container_width=True)
             else:
                 st.warning(f"Không tìm thấy dữ liệu trong khoảng từ {start_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}. Hãy thử mở rộng khoảng thời gian hoặc kiểm tra lại định dạng ngày nhập liệu.")
         else:
@@ -1807,6 +1473,9 @@ with tabs[1]:
 # --- CẢNH BÁO WESTGARD NHANH ---
         st.markdown("#### ⚠️ Cảnh báo Westgard")
         violations = {}
+        drift_alerts = {}
+        # Kết quả Westgard đã lưu theo từng điểm của lot (chấm khi nhập), dùng chung cho nhật ký vi phạm bên dưới
+        lot_verdicts = {}
 
         # KIỂM TRA AN TOÀN: Chỉ chạy nếu df_plot có dữ liệu và có cột 'level'
         if df_plot is not None and not df_plot.empty and 'level' in df_plot.columns:
@@ -1818,17 +1487,17 @@ with tabs[1]:
 
                 
                 if lot:
-                    sub = df_plot[df_plot['level'] == lvl].copy()
-                    if not sub.empty:
-                        # Sử dụng hàm get_westgard_violations đã tối ưu
-                        analyzed = get_westgard_violations(sub, lot['mean'], lot['sd'])
-                        
-                        # Kiểm tra xem cột 'Violation' có tồn tại sau khi tính toán không
-                        if 'Violation' in analyzed.columns:
-                            current_v = analyzed['Violation'].iloc[-1]
+                    analyzed = lot_verdicts[lvl] = db.get_iqc_verdicts_by_lot(lot['id'], lot['mean'], lot['sd'],
+                                                                              rule_set, drift_params)
+                    if not analyzed.empty:
+                        # Điểm mới nhất của lot trong khoảng thời gian đang xem
+                        sub = analyzed[(analyzed['date'] >= start_date) & (analyzed['date'] <= end_date)]
+                        if not sub.empty:
+                            latest = sub.sort_values(['date', 'id']).iloc[-1]
+                            current_v = latest['Violation']
                             violations[f"Mức {lvl}"] = current_v if (current_v and str(current_v).strip() != "") else "ĐẠT"
-                        else:
-                            violations[f"Mức {lvl}"] = "ĐẠT"
+                            if latest.get('Drift'):
+                                drift_alerts[f"Mức {lvl}"] = latest['Drift']
         
         # HIỂN THỊ KẾT QUẢ THEO MÀU SẮC
         if violations:
@@ -1846,6 +1515,8 @@ with tabs[1]:
                 # 3. Nếu là Vi phạm quy tắc dừng (1-3s, 2-2s, R-4s...): Hiện nền đỏ (Error)
                 else:
                     st.error(f"**{k}**: {v} (Vi phạm quy tắc dừng - Cần xử lý)")
+            for k, v in drift_alerts.items():
+                st.warning(f"**{k}**: báo trôi {v} (Sai số hệ thống nhỏ kéo dài - Kiểm tra hiệu chuẩn, hóa chất)")
         else:
             # Thông báo khi xét nghiệm mới tạo, chưa có dữ liệu để tính toán
             st.info("ℹ️ Hiện tại chưa có dữ liệu IQC để đánh giá Westgard cho xét nghiệm này.")
@@ -1858,11 +1529,18 @@ with tabs[1]:
             lot = lvl_info["lot"]
             if lot:
                 unique_prefix = f"lot_{lot['id']}_lvl_{lvl}"
-                df_raw = db.get_iqc_data_by_lot(lot['id'])
+                df_analyzed = lot_verdicts.get(lvl)
+                if df_analyzed is None:
+                    df_analyzed = db.get_iqc_verdicts_by_lot(lot['id'], lot['mean'], lot['sd'], rule_set, drift_params)
                 
-                if not df_raw.empty:
-                    df_analyzed = get_westgard_violations(df_raw, lot['mean'], lot['sd'])
-                    df_err = df_analyzed[~df_analyzed['Violation'].isin(["ĐẠT", "", "None", None])].copy()
+                if not df_analyzed.empty:
+                    westgard_err = ~df_analyzed['Violation'].isin(["ĐẠT", "", "None", None])
+                    drift_err = df_analyzed['Drift'].fillna('') != ''
+                    df_err = df_analyzed[westgard_err | drift_err].copy()
+                    # Cột 'Lỗi' gồm vi phạm Westgard (nếu có) và nhãn báo trôi EWMA/CUSUM
+                    df_err['Violation'] = [", ".join(x for x in (v if w else "", d) if x)
+                                           for v, d, w in zip(df_err['Violation'], df_err['Drift'].fillna(''),
+                                                              westgard_err[df_err.index])]
                     
                     if not df_err.empty:
                         st.markdown(f"**📝 Nhật ký xử lý vi phạm Mức {lvl} ({lot['lot_number']})**")
@@ -1894,6 +1572,8 @@ with tabs[1]:
                             "10x": "Vi phạm 10x. Lỗi hệ thống kéo dài. Kiểm tra bảo trì hoặc hiệu chuẩn lại.",
                             "Shift": "Lỗi hệ thống. Kiểm tra hóa chất/hiệu chuẩn.",
                             "Trend": "Lỗi hệ thống. Kiểm tra sự thoái hóa của hóa chất, bóng đèn.",
+                            "CUSUM": "Báo trôi CUSUM. Lệch hệ thống nhỏ tích lũy, kiểm tra hiệu chuẩn và lô hóa chất.",
+                            "EWMA": "Báo trôi EWMA. Kết quả trôi dần khỏi giá trị đích, xem xét hiệu chuẩn lại.",
                             "1-2s": "Cảnh báo 1-2s. Theo dõi sát kết quả tiếp theo."
                         }
 
@@ -2023,6 +1703,9 @@ with tabs[2]:
             
             # Tạo bản sao cuối cùng để đưa vào Editor
             df_edit = df_display[actual_cols].copy()
+            # program_name là category: chuyển về chuỗi để sửa tự do (không bị giới hạn trong danh sách có sẵn)
+            if 'program_name' in df_edit.columns:
+                df_edit['program_name'] = df_edit['program_name'].astype(object)
             
             # Mapping tên cột Tiếng Việt
             column_mapping = {
@@ -2144,40 +1827,45 @@ with tabs[2]:
         y_upper = vertex_y + k * (vertex_x - x_mask)
         y_lower = vertex_y - k * (vertex_x - x_mask)
         
-        # --- VẼ BIỂU ĐỒ ---
-        fig, ax = plt.subplots(figsize=(10, 5))
-        ax.plot(indices, cusum_values, marker='o', linestyle='-', color='blue', label='CUSUM Line')
-        
-        mask_range_mask = x_mask >= 0 
-        ax.plot(x_mask[mask_range_mask], y_upper[mask_range_mask], color='red', linestyle='--', alpha=0.7, label='V-Mask Upper')
-        ax.plot(x_mask[mask_range_mask], y_lower[mask_range_mask], color='red', linestyle='--', alpha=0.7, label='V-Mask Lower')
-        
-        # Vẽ V-Mask 
-        ax.plot(vertex_x, vertex_y, marker='x', color='black', markersize=10, label='Vertex (d=10)')
-        ax.plot([last_x, vertex_x], [last_y, vertex_y], color='gray', linestyle=':', alpha=0.5)
-
-        is_violated = False
-        for i in range(n_points):
-            limit_upper = vertex_y + k * (vertex_x - i)
-            limit_lower = vertex_y - k * (vertex_x - i)
-            
-            if cusum_values[i] > limit_upper or cusum_values[i] < limit_lower:
-                is_violated = True
-                ax.scatter(i, cusum_values[i], color='orange', s=100, zorder=5)
-
-        ax.axhline(0, color='black', linewidth=0.5)
-        ax.set_title(f"Biểu đồ CUSUM (Mẫu cuối: {last_y:.2f})")
-        ax.set_xlabel("Số thứ tự mẫu EQA")
-        ax.set_ylabel("CUSUM (SDI tích lũy)")
-        ax.legend()
-        ax.grid(True, alpha=0.3)
-        
-        if n_points <= 10:
-            ax.set_xticks(indices)
-            ax.set_xticklabels([d.strftime('%d/%m') for d in dates], rotation=45)
-        
-        st.pyplot(fig)
-        st.session_state['fig_vmask_report'] = fig
+        # Điểm cắt V-Mask
+        outside = (cusum_values > vertex_y + k * (vertex_x - indices)) | (cusum_values < vertex_y - k * (vertex_x - indices))
+        is_violated = bool(outside.any())
+
+        # --- VẼ BIỂU ĐỒ (chỉ khi chuỗi CUSUM/ngày thay đổi, còn lại lấy ảnh từ bộ nhớ đệm) ---
+        def draw_eqa_cusum():
+            fig, ax = plt.subplots(figsize=(10, 5))
+            ax.plot(indices, cusum_values, marker='o', linestyle='-', color='blue', label='CUSUM Line')
+
+            mask_range_mask = x_mask >= 0
+            ax.plot(x_mask[mask_range_mask], y_upper[mask_range_mask], color='red', linestyle='--', alpha=0.7, label='V-Mask Upper')
+            ax.plot(x_mask[mask_range_mask], y_lower[mask_range_mask], color='red', linestyle='--', alpha=0.7, label='V-Mask Lower')
+
+            # Vẽ V-Mask
+            ax.plot(vertex_x, vertex_y, marker='x', color='black', markersize=10, label='Vertex (d=10)')
+            ax.plot([last_x, vertex_x], [last_y, vertex_y], color='gray', linestyle=':', alpha=0.5)
+            if is_violated:
+                ax.scatter(indices[outside], cusum_values[outside], color='orange', s=100, zorder=5)
+
+            ax.axhline(0, color='black', linewidth=0.5)
+            ax.set_title(f"Biểu đồ CUSUM (Mẫu cuối: {last_y:.2f})")
+            ax.set_xlabel("Số thứ tự mẫu EQA")
+            ax.set_ylabel("CUSUM (SDI tích lũy)")
+            ax.legend()
+            ax.grid(True, alpha=0.3)
+
+            if n_points <= 10:
+                ax.set_xticks(indices)
+                ax.set_xticklabels([d.strftime('%d/%m') for d in dates], rotation=45)
+            return fig
+
+        cusum_spec = None
+        if chart_mode == "vega":
+            cusum_spec = cusum_vmask_spec(cusum_values, dates, x_mask, y_upper, y_lower, (vertex_x, vertex_y), outside)
+        if cusum_spec:
+            st.vega_lite_chart(cusum_spec, use_container_width=True)
+        else:
+            img_cusum_view, _ = cached_render("eqa_cusum", (cusum_values, pd.Series(dates).to_numpy()), draw_eqa_cusum)
+            st.image(img_cusum_view, use_container_width=True)
 
         if is_violated:
             st.error("⚠️ CẢNH BÁO: Đường CUSUM cắt V-Mask! Có dấu hiệu sai số hệ thống (Shift/Trend).")
@@ -2252,7 +1940,8 @@ with tabs[3]:
                     st.warning(f"Sử dụng TEa cố định làm mục tiêu: {target_mau}%")
 
         # --- XỬ LÝ DỮ LIỆU ---
-        df_iqc_raw = db.get_iqc_data_continuous(current_test['id'])
+        # Chỉ lấy thống kê tổng hợp (n, mean, SD, CV đã lọc 3SD) theo level trong khoảng ngày
+        mu_level_stats = db.get_clean_stats_by_level(current_test['id'], d_start, d_end)
         df_eqa_hist = db.get_eqa_data(current_test['id'])
 
         # Tính Bias trung bình từ 3 kỳ EQA gần nhất
@@ -2289,13 +1978,8 @@ with tabs[3]:
                     # Lọc dữ liệu cho từng level
                     sub_df = df_plot[df_plot['level'] == i]
                 
-                if not df_iqc_raw.empty:
-                    # Lọc theo Level và Ngày
-                    df_temp = df_iqc_raw.copy()
-                    df_temp['date'] = pd.to_datetime(df_temp['date']).dt.date
-                    df_lvl = df_temp[(df_temp['level'] == i) & (df_temp['date'] >= d_start) & (df_temp['date'] <= d_end)]
-                    
-                    stats = get_clean_stats_3sigma(df_lvl)
+                if mu_level_stats:
+                    stats = mu_level_stats.get(i)
                     
                     if stats:
                         u_prec = stats['cv']
@@ -2327,7 +2011,7 @@ with tabs[3]:
                 else:
                     st.info("Chưa có dữ liệu nội kiểm.")
                 # Trong Tab MU, tại vị trí dòng 1669 bạn gặp lỗi:
-                stats = get_clean_stats_3sigma(df_lvl)
+                stats = mu_level_stats.get(i)
                 # --- KIỂM TRA ĐIỀU KIỆN TRƯỚC KHI TRUY CẬP STATS ---
                 # Sử dụng kiểm tra an toàn: stats không None, là dictionary và có n >= 2
                 if stats and isinstance(stats, dict) and stats.get('n', 0) >= 2:
@@ -2421,12 +2105,14 @@ with tabs[4]:
             key="rep_end"
         )
     # 2. LẤY DỮ LIỆU
-    df_full_history = db.get_iqc_data_continuous(current_test['id'])
-    df_raw = db.get_iqc_data_continuous(current_test['id'])
+    # Thống kê tổng hợp theo level: toàn bộ lịch sử (để đếm & gợi ý khoảng ngày) và khoảng ngày đã chọn
+    df_history_stats = db.get_iqc_level_stats(current_test['id'])
+    df_window_stats = db.get_iqc_level_stats(current_test['id'], start_d, end_d)
+    sigma_level_stats = {int(r['level']): stats_from_sums(r) for r in df_window_stats.to_dict('records')}
+    df_filtered = None  # Dữ liệu IQC chi tiết chỉ tải khi xuất báo cáo
     df_eqa = db.get_eqa_data(current_test['id'])
     tea = float(current_test.get('tea', 10.0))
-    if df_full_history is not None:
-        st.write(f"🔍 Tìm thấy tổng {len(df_full_history)} kết quả cho Sigma.")   
+    st.write(f"🔍 Tìm thấy tổng {int(df_history_stats['n'].sum())} kết quả cho Sigma.")   
     # 3. TÍNH BIAS (Sử dụng trung bình 3 kỳ gần nhất để khớp với Tab MU)
     bias_pct = 0.0
     if not df_eqa.empty:
@@ -2440,26 +2126,12 @@ with tabs[4]:
     summary_data = []
     sigma_plot_data = []
 
-    if not df_raw.empty:
-        # --- BƯỚC 1: ĐỒNG BỘ HÓA DỮ LIỆU ---
-        # Chuyển đổi cột date sang datetime (xử lý cả dạng chuỗi từ nhập tay và timestamp từ excel)
-        df_raw['date_dt'] = pd.to_datetime(df_raw['date'], errors='coerce')
-        
-        # Đảm bảo cột giá trị (value) là số thực để không bị lỗi khi tính Mean/SD
-        df_raw['value'] = pd.to_numeric(df_raw['value'], errors='coerce')
-        
-        # Loại bỏ các dòng bị lỗi dữ liệu nghiêm trọng (không có ngày hoặc không có kết quả)
-        df_raw = df_raw.dropna(subset=['date_dt', 'value'])
-        
+    if not df_history_stats.empty:
         # Lấy khoảng ngày thực tế có trong DB để gợi ý cho người dùng nếu không thấy dữ liệu
-        min_date = df_raw['date_dt'].min().date()
-        max_date = df_raw['date_dt'].max().date()
-        
-        # --- BƯỚC 2: BỘ LỌC THEO THỜI GIAN ---
-        df_raw['date_only'] = df_raw['date_dt'].dt.date
-        df_filtered = df_raw[(df_raw['date_only'] >= start_d) & (df_raw['date_only'] <= end_d)].copy()
+        min_date = pd.to_datetime(df_history_stats['first_date'].min()).date()
+        max_date = pd.to_datetime(df_history_stats['last_date'].max()).date()
 
-        if df_filtered.empty:
+        if df_window_stats.empty:
             st.warning(f"⚠️ Không tìm thấy dữ liệu trong khoảng từ {start_d} đến {end_d}.")
             st.info(f"💡 Dữ liệu hiện có sẵn từ ngày **{min_date}** đến **{max_date}**. Vui lòng điều chỉnh lại bộ lọc ngày ở trên.")
         else:
@@ -2468,11 +2140,8 @@ with tabs[4]:
             cols = [c1, c2, c3]
 
             for lvl in [1, 2, 3]:
-                # Lọc theo level (chuyển sang string để so sánh khớp tuyệt đối)
-                df_lvl = df_filtered[df_filtered['level'].astype(str) == str(lvl)]
-                
-                # --- BƯỚC 3: TÍNH TOÁN STATS (Sử dụng hàm get_clean_stats_3sigma đã cải tiến) ---
-                stats = get_clean_stats_3sigma(df_lvl)
+                # --- BƯỚC 3: TÍNH TOÁN STATS (n/sum/sumsq tổng hợp phía server, đã lọc 3SD) ---
+                stats = sigma_level_stats.get(lvl)
                 current_col = cols[lvl-1]
 
                 if stats and stats['n'] >= 2:
@@ -2544,15 +2213,50 @@ with tabs[4]:
                     use_container_width=True, hide_index=True
                 )
 
+                # THIẾT KẾ QC: Ped/Pfr của các bộ quy tắc theo Sigma thấp nhất (mô phỏng Monte Carlo)
+                with st.expander("🎯 Thiết kế QC theo Sigma (Ped / Pfr)"):
+                    st.caption(f"Mô phỏng xác suất phát hiện sai số hệ thống tới hạn (Ped, mục tiêu ≥ {TARGET_PED:.0%}) "
+                               f"và loại bỏ nhầm (Pfr, tối đa {MAX_PFR:.0%}) cho từng bộ quy tắc và số mức control.")
+                    design_runs = st.selectbox("Phát hiện trong số lượt chạy", [1, 2, 4], key="qc_design_runs")
+                    design_key = f"qc_design_{current_test['id']}"
+                    if st.button("▶️ Mô phỏng", key="run_qc_design"):
+                        with st.spinner("Đang mô phỏng..."):
+                            st.session_state[design_key] = recommend_qc_design(sigma_results, n_runs=design_runs)
+                    design = st.session_state.get(design_key)
+                    if design:
+                        st.write(f"Sigma thấp nhất: **{design['sigma']:.2f}** → ΔSEcrit = **{design['critical_shift']:.2f} SD**")
+                        text = (f"{RULE_SET_LABELS.get(design['rule_set'], design['rule_set'])}, "
+                                f"{design['n_levels']} mức / lượt chạy (Ped {design['ped']:.1%}, Pfr {design['pfr']:.1%})")
+                        if design['meets_target']:
+                            st.success(f"Gợi ý: {text}")
+                        else:
+                            st.warning(f"Không tổ hợp nào đạt mục tiêu, gần nhất: {text}")
+                        st.dataframe(
+                            design['candidates'][['label', 'n_levels', 'n_runs', 'ped', 'pfr', 'meets_target']]
+                            .rename(columns={'label': 'Bộ quy tắc', 'n_levels': 'Số mức', 'n_runs': 'Số lượt',
+                                             'ped': 'Ped', 'pfr': 'Pfr', 'meets_target': 'Đạt'})
+                            .style.format({'Ped': "{:.1%}", 'Pfr': "{:.2%}"}),
+                            use_container_width=True, hide_index=True
+                        )
+                        if design['rule_set'] != rule_set and st.button("Áp dụng bộ quy tắc gợi ý", key="apply_qc_design"):
+                            if db.set_rule_set(current_test['id'], design['rule_set']):
+                                st.success("Đã đổi bộ quy tắc, kết quả IQC sẽ được chấm lại.")
+                                st.rerun()
+                            else:
+                                st.error("Lỗi khi lưu bộ quy tắc.")
+
             # 6. BIỂU ĐỒ DECISION CHART
             st.markdown("---")
             st.subheader("📈 Biểu đồ Method Decision Chart")
             # Đảm bảo hàm plot_sigma_chart đã được định nghĩa
-            fig_sigma = plot_sigma_chart(sigma_plot_data, tea)
-            if fig_sigma:
-                st.pyplot(fig_sigma)
-                st.session_state['fig_sigma_report'] = fig_sigma
-                # plt.close(fig_sigma)
+            sigma_spec = sigma_chart_spec(sigma_plot_data, tea) if chart_mode == "vega" else None
+            if sigma_spec:
+                st.vega_lite_chart(sigma_spec, use_container_width=True)
+            else:
+                img_sigma_view, _ = cached_render("sigma_chart", (sigma_plot_data, tea),
+                                                  lambda: plot_sigma_chart(sigma_plot_data, tea))
+                if img_sigma_view:
+                    st.image(img_sigma_view, use_container_width=True)
 
 
 # === TAB: IMPORT DỮ LIỆU ===📂
@@ -2768,24 +2472,15 @@ with tabs[6]:
                     st.dataframe(df_nsx.head(), use_container_width=True)
                     
                     if st.button("🚀 Xác nhận Import giá trị NSX", type="primary"):
-                        success_count = 0
                         with st.spinner("Đang cập nhật Lot..."):
-                            for _, row in df_nsx.iterrows():
-                                # Tìm test_id từ test_name (ánh xạ tên xét nghiệm)
-                                test_info = db.get_test_by_name(row['test_name'])
-                                if test_info:
-                                    db.add_lot(
-                                        test_id=test_info['id'],
-                                        lot_number=str(row['lot_number']),
-                                        level=int(row['level']),
-                                        method="Import NSX",
-                                        expiry_date=str(row['expiry_date']),
-                                        mean=float(row['mean']),
-                                        sd=float(row['sd'])
-                                    )
-                                    success_count += 1
-                        
-                        st.success(f"✅ Đã cập nhật thành công {success_count} thông số Lot vào hệ thống!")
+                            # Upsert theo (xét nghiệm, số lot, mức): chạy lại cùng file không tạo Lot trùng
+                            success_count, nsx_errors = db.import_lots_from_dataframe(df_nsx, method="Import NSX")
+                        counts = getattr(db, 'last_lot_import_counts', {})
+                        st.success(f"✅ Đã cập nhật thành công {success_count} thông số Lot vào hệ thống! "
+                                   f"(Thêm mới: {counts.get('inserted', 0)}, Cập nhật: {counts.get('updated', 0)})")
+                        if nsx_errors:
+                            with st.expander("Xem các dòng lỗi"):
+                                for err in nsx_errors: st.warning(err)
                         time.sleep(1)
                         st.rerun()
                         
@@ -2800,37 +2495,22 @@ with tabs[6]:
             st.write("Khởi tạo báo cáo tổng hợp bao gồm biểu đồ LJ, Sigma Chart và V-Mask dựa trên dữ liệu hiện tại.")
             if st.button("📥 Khởi tạo file Báo Cáo Tổng Hợp (Excel)", key="btn_export_all", type="secondary"):
                 
+                # Chỉ tải dữ liệu IQC chi tiết của khoảng ngày báo cáo khi thực sự xuất file
+                df_filtered = db.get_iqc_data_filtered(current_test['id'], start_d, end_d)
+                if df_filtered is not None and not df_filtered.empty:
+                    df_filtered['date_dt'] = pd.to_datetime(df_filtered['date'], errors='coerce')
+                    df_filtered['value'] = pd.to_numeric(df_filtered['value'], errors='coerce')
+                    df_filtered = df_filtered.dropna(subset=['date_dt', 'value'])
+                    df_filtered['date_only'] = df_filtered['date_dt'].dt.date
                 if df_filtered is None or df_filtered.empty:
                     st.error("❌ Không có dữ liệu IQC (Vui lòng chọn Test và Khoảng ngày ở Sidebar)")
                 else:
                     with st.spinner("🚀 Đang vẽ biểu đồ và khởi tạo file..."):
                         try:
                             import io
-                            import matplotlib.pyplot as plt
 
                             # --- 1. CHUẨN BỊ DỮ LIỆU ---
-                            df_prep = df_filtered.copy()
-
-                            # Lấy Mean/SD từ current_test hoặc từ dữ liệu thực tế để tính Westgard
-                            # Giả sử current_test chứa thông tin cài đặt của Test đó
-                            mean_map = {1: current_test.get('mean_l1', 0), 2: current_test.get('mean_l2', 0), 3: current_test.get('mean_l3', 0)}
-                            sd_map = {1: current_test.get('sd_l1', 0), 2: current_test.get('sd_l2', 0), 3: current_test.get('sd_l3', 0)}
-
-                            # --- 2. QUAN TRỌNG: TÍNH LẠI WESTGARD TRƯỚC KHI XUẤT ---
-                            # Gọi hàm này để đảm bảo cột 'Violation' có dữ liệu
-                            # (Hàm get_westgard_violations tôi đã gửi ở những phản hồi đầu tiên)
-                            df_prep = get_westgard_violations(df_prep, mean_map, sd_map)
-
-                            # --- 3. XỬ LÝ EQA & BIỂU ĐỒ (Giữ nguyên logic của bạn) ---
-                            for lvl in [1, 2]:
-                                mask = df_prep['level'] == lvl
-                                if mask.any():
-                                    # Nếu thiếu target_mean trong DB, lấy trung bình thực tế
-                                    if 'target_mean' not in df_prep.columns or df_prep.loc[mask, 'target_mean'].isnull().all():
-                                        df_prep.loc[mask, 'target_mean'] = mean_map.get(lvl) if mean_map.get(lvl) else df_prep.loc[mask, 'value'].mean()
-                                    if 'target_sd' not in df_prep.columns or df_prep.loc[mask, 'target_sd'].isnull().all():
-                                        df_prep.loc[mask, 'target_sd'] = sd_map.get(lvl) if sd_map.get(lvl) else df_prep.loc[mask, 'value'].std()
-
+                            # Westgard được tính 1 lần trong generate_excel_report_comprehensive
                             # --- LOGIC XỬ LÝ DỮ LIỆU & VẼ BIỂU ĐỒ (Giữ nguyên nội dung của bạn) ---
                             df_prep = df_filtered.copy()
                             for lvl in [1, 2]:
@@ -2852,24 +2532,20 @@ with tabs[6]:
                                     df_eqa_prep = df_eqa_prep.sort_values('date')
                                     df_eqa_prep['CUSUM'] = df_eqa_prep['sdi'].cumsum()
 
-                            def fig_to_bytes_internal(fig_obj):
-                                if fig_obj is None: return None
-                                buf = io.BytesIO()
-                                fig_obj.savefig(buf, format='png', bbox_inches='tight', dpi=100)
-                                plt.close(fig_obj)
-                                return buf.getvalue()
-
-                            img_lj = fig_to_bytes_internal(plot_levey_jennings(df_prep, f"Biểu đồ LJ: {current_test['name']}"))
-                            img_sigma = fig_to_bytes_internal(plot_sigma_chart(sigma_plot_data, tea))
+                            # Ảnh báo cáo (dpi 100) qua bộ nhớ đệm: xuất lại khi dữ liệu không đổi không phải vẽ lại
+                            img_lj = render_levey_jennings(df_prep, f"Biểu đồ LJ: {current_test['name']}", dpi=100,
+                                                           rules=rule_set)
+                            img_sigma, _ = cached_render("sigma_chart", (sigma_plot_data, tea),
+                                                         lambda: plot_sigma_chart(sigma_plot_data, tea), dpi=100)
                             img_vmask = None
                             if not df_eqa_prep.empty:
-                                fig_vmask_raw, _ = plot_cusum_chart(df_eqa_prep)
-                                img_vmask = fig_to_bytes_internal(fig_vmask_raw)
+                                img_vmask, _ = cached_render("eqa_vmask", (df_eqa_prep[['date', 'CUSUM']],),
+                                                             lambda: plot_cusum_chart(df_eqa_prep)[0], dpi=100)
 
         # --- 4. GỌI HÀM TẠO EXCEL ---
                             excel_data = generate_excel_report_comprehensive(
                                 test_info=current_test, 
-                                df_full_iqc=df_prep,  # Lúc này df_prep đã CÓ cột 'Violation'
+                                df_full_iqc=df_prep,  # Cột 'Violation' được tính bên trong hàm
                                 df_eqa=df_eqa_prep,
                                 mu_data=st.session_state.get('mu_results', {}), 
                                 sigma_data=sigma_results,
@@ -2985,17 +2661,96 @@ with tabs[7]:
         
         st.markdown("---")
 
+        # KẾT NỐI SUPABASE (client dùng chung cho cả tiến trình)
+        with st.expander("📡 Thống kê kết nối Supabase"):
+            pool_stats = get_pool_stats()
+            if pool_stats:
+                st.dataframe(pd.DataFrame(pool_stats).T, use_container_width=True)
+                st.caption("tls_handshakes tăng chậm hơn nhiều so với requests nghĩa là kết nối keep-alive đang được dùng lại.")
+            else:
+                st.info("Đang dùng backend SQLite, không có kết nối HTTP.")
+
+        # BỘ NHỚ ĐỆM ẢNH BIỂU ĐỒ (render_cache)
+        with st.expander("🖼️ Bộ nhớ đệm ảnh biểu đồ"):
+            st.dataframe(pd.DataFrame([render_cache_stats()]), use_container_width=True, hide_index=True)
+            st.caption("hits: số lần biểu đồ được lấy lại từ bộ nhớ thay vì vẽ lại bằng matplotlib.")
+
+        # KIỂU BIỂU ĐỒ (LJ, CUSUM EQA, Method Decision Chart); ảnh trong báo cáo Excel/Word luôn là matplotlib
+        with st.expander("📊 Kiểu hiển thị biểu đồ"):
+            backend_keys = list(CHART_BACKENDS)
+            new_chart_mode = st.radio("Vẽ biểu đồ bằng", backend_keys, index=backend_keys.index(chart_mode),
+                                      format_func=CHART_BACKENDS.get, key="chart_backend")
+            st.caption("Tương tác: phóng to, xem giá trị, bật/tắt mức ngay trên trình duyệt. "
+                       "Dữ liệu quá lớn sau khi giảm điểm sẽ tự quay lại ảnh tĩnh.")
+            if st.button("Lưu kiểu biểu đồ", key="save_chart_backend", disabled=new_chart_mode == chart_mode):
+                if db.set_setting(CHART_BACKEND_SETTING, new_chart_mode):
+                    st.success("Đã lưu kiểu biểu đồ.")
+                    st.rerun()
+                else:
+                    st.error("Lỗi khi lưu cài đặt.")
+
+        # TRẠNG THÁI QC TOÀN PHÒNG (bảng qc_status cho màn hình tổng quan / treo tường)
+        with st.expander("📺 Trạng thái QC toàn phòng"):
+            st.caption("Quét lot đang chạy của mọi xét nghiệm và cập nhật bảng qc_status. "
+                       "Có thể chạy định kỳ bằng lệnh `python qc_status.py`.")
+            if st.button("🔄 Quét lại toàn bộ", key="scan_qc_status"):
+                with st.spinner("Đang quét trạng thái QC..."):
+                    n_rows, scan_errors = scan_qc_status(db)
+                st.success(f"Đã cập nhật {n_rows} dòng trạng thái QC.")
+                for err in scan_errors:
+                    st.warning(err)
+
+        # SO SÁNH BỘ QUY TẮC TRÊN DỮ LIỆU CŨ (what-if, không ghi gì vào DB)
+        with st.expander("🔁 So sánh bộ quy tắc trên dữ liệu cũ"):
+            st.caption(f"Chạy lại các bộ quy tắc trên kết quả IQC đã lưu. Sự kiện lỗi = mỗi lần báo trôi EWMA/CUSUM "
+                       f"cùng {EVENT_POINTS - 1} điểm trước đó; loại bỏ nhầm = điểm bị loại ngoài mọi sự kiện.")
+            rs_col1, rs_col2, rs_col3 = st.columns(3)
+            replay_sets = rs_col1.multiselect("Bộ quy tắc", list(RULE_SETS), default=list(RULE_SETS),
+                                              format_func=lambda k: RULE_SET_LABELS.get(k, k), key="replay_sets")
+            replay_months = rs_col2.number_input("Số tháng gần nhất", min_value=1, max_value=120,
+                                                 value=REPLAY_MONTHS, key="replay_months")
+            replay_scope = rs_col3.radio("Phạm vi", [f"Test {current_test['name']}", "Tất cả xét nghiệm"],
+                                         key="replay_scope")
+            if st.button("▶️ Chạy so sánh", key="run_rule_replay", disabled=not replay_sets):
+                with st.spinner("Đang chấm lại lịch sử IQC..."):
+                    replay_summary, replay_by_test, replay_errors = replay_rule_sets(
+                        db, replay_sets, test_ids=None if replay_scope == "Tất cả xét nghiệm" else [current_test['id']],
+                        months=int(replay_months))
+                st.session_state['rule_replay'] = (replay_summary, replay_by_test, replay_errors)
+            if 'rule_replay' in st.session_state:
+                replay_summary, replay_by_test, replay_errors = st.session_state['rule_replay']
+                replay_cols = {
+                    'rule_set': 'Bộ quy tắc', 'tests': 'Số test', 'points': 'Số điểm', 'runs': 'Số lượt chạy',
+                    'rejected_points': 'Điểm bị loại', 'rejected_runs': 'Lượt bị loại', 'warning_points': 'Điểm cảnh báo',
+                    'false_rejections': 'Loại nhầm', 'false_rejection_rate': 'Tỉ lệ loại nhầm',
+                    'events': 'Sự kiện lỗi', 'detected_events': 'Sự kiện phát hiện', 'detection_rate': 'Tỉ lệ phát hiện',
+                }
+                if replay_summary.empty:
+                    st.info("Không có dữ liệu IQC trong khoảng thời gian đã chọn.")
+                else:
+                    st.dataframe(replay_summary[list(replay_cols)].assign(
+                        rule_set=replay_summary['rule_set'].map(lambda k: RULE_SET_LABELS.get(k, k)),
+                        false_rejection_rate=(replay_summary['false_rejection_rate'] * 100).round(2),
+                        detection_rate=(replay_summary['detection_rate'] * 100).round(1),
+                    ).rename(columns=replay_cols), use_container_width=True, hide_index=True)
+                    st.caption("Tỉ lệ tính theo %. Tỉ lệ phát hiện trống khi không có sự kiện lỗi nào.")
+                    if replay_by_test['test_id'].nunique() > 1:
+                        st.dataframe(replay_by_test[['test_name'] + [c for c in replay_cols if c != 'tests']].rename(
+                            columns={'test_name': 'Xét nghiệm', **replay_cols}), use_container_width=True, hide_index=True)
+                for err in replay_errors:
+                    st.warning(err)
+
         # 4. VÙNG NGUY HIỂM (GIỮ NGUYÊN LOGIC)
         with st.expander("⚠️ Vùng nguy hiểm: Reset Dữ liệu"):
             st.warning("Hành động này sẽ xóa dữ liệu! Hãy cẩn thận.")
             if st.button(f"Xóa TOÀN BỘ dữ liệu IQC của Test: {current_test['name']}"):
-                # Logic xóa
-                lots = db.get_lots_for_test(current_test['id'])
-                for _, l in lots.iterrows(): 
-                    # Giả định db.delete_lot đã tồn tại và hoạt động đúng
-                    db.delete_lot(l['id']) 
-                st.success("Đã xóa sạch dữ liệu IQC!")
-                st.rerun()
+                # Xóa mọi Lot của Test cùng kết quả IQC trong 1 lần gọi (1 transaction)
+                deleted = db.delete_lots_for_test(current_test['id'])
+                if deleted is None:
+                    st.error("Không thể xóa dữ liệu IQC. Dữ liệu chưa bị thay đổi.")
+                else:
+                    st.success(f"Đã xóa sạch dữ liệu IQC! ({deleted['lots']} Lot, {deleted['iqc_results']} kết quả)")
+                    st.rerun()
                 
         # 5. BACKUP DATABASE (GIỮ NGUYÊN LOGIC)
         with st.expander("📋 Backup Database"):
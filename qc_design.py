@@ -0,0 +1,232 @@
+# File: qc_design.py
+"""
+Thiết kế QC theo Sigma: ước lượng xác suất phát hiện lỗi (Ped) và loại bỏ nhầm (Pfr) của các bộ
+quy tắc Westgard bằng mô phỏng Monte Carlo, rồi gợi ý bộ quy tắc / số mức control cho từng test.
+
+Mô hình (như power function của Westgard): mỗi lần mô phỏng gồm `n_runs` lượt chạy, mỗi lượt đo
+`n_levels` mức (mức 1..n_levels); z = shift + random_error * N(0, 1). Quy tắc chỉ xét các điểm trong
+các lượt này. Lần mô phỏng bị loại khi có ít nhất 1 quy tắc dừng (severity='reject').
+  Pfr = P(loại) khi shift = 0;  Ped = P(loại) khi shift = ΔSEcrit = Sigma - 1.65.
+Quy tắc được chấm theo đúng RuleSpec của westgard.py, vector hóa trên cả khối mô phỏng.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from westgard import RULE_SETS, RULE_SET_LABELS, _beyond, resolve_rules
+
+DEFAULT_SIMS = 100_000
+# Số lần mô phỏng mỗi khối (mỗi tác vụ của process pool); khối 1e5 x 4 lượt x 3 mức ~ 10 MB
+CHUNK_SIZE = 100_000
+# Tổng số lần mô phỏng dưới ngưỡng này thì chạy tuần tự (~1 giây / 1e6 lần, khởi động tiến trình con tốn hơn)
+MIN_SIMS_FOR_POOL = 5_000_000
+DEFAULT_SHIFTS = (0.0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 5.0)
+TARGET_PED = 0.90
+MAX_PFR = 0.05
+CANDIDATE_LEVELS = (1, 2, 3)
+
+
+def critical_shift(sigma):
+    """Sai số hệ thống tới hạn (đơn vị SD): ΔSEcrit = (TEa - |Bias|) / CV - 1.65 = Sigma - 1.65."""
+    return max(float(sigma) - 1.65, 0.0)
+
+
+def _rolling_sum(a, n):
+    """
+    Tổng n phần tử gần nhất theo trục 0 (thời gian; đầu chuỗi lấy những phần tử đang có), như _window_sum.
+    Chuỗi mô phỏng ngắn (vài lượt chạy) nên cộng các lát dịch chuyển, mỗi lát là 1 khối liền bộ nhớ.
+    """
+    out = a.astype(np.int16)
+    for i in range(1, min(n, len(a))):
+        out[i:] += a[:-i]
+    return out
+
+
+def _series_hits(z, spec):
+    """Điểm vi phạm 1 quy tắc beyond/trend trên các chuỗi z (thời gian x chuỗi)."""
+    if spec.kind == "trend":
+        if spec.n < 2:
+            return np.ones(z.shape, dtype=bool)
+        up = np.zeros(z.shape, dtype=bool)
+        down = np.zeros(z.shape, dtype=bool)
+        up[1:], down[1:] = z[1:] > z[:-1], z[1:] < z[:-1]
+        return (_rolling_sum(up, spec.n - 1) >= spec.n - 1) | (_rolling_sum(down, spec.n - 1) >= spec.n - 1)
+    hi, lo = _beyond(z, spec)
+    k = spec.k or spec.n
+    return (_rolling_sum(hi, spec.n) >= k) | (_rolling_sum(lo, spec.n) >= k)
+
+
+def _across_hits(z, spec):
+    """Điểm vi phạm 1 quy tắc across; z có dạng (lượt x mức x mô phỏng), mọi lượt có đủ n_levels mức."""
+    n_runs, n_levels, _ = z.shape
+    flags = np.zeros(z.shape, dtype=bool)
+    cols = [lvl - 1 for lvl in (spec.levels or (1, 2, 3)) if lvl <= n_levels]
+    if spec.kind == "range":
+        for a, b in combinations(cols, 2):
+            (a_hi, a_lo), (b_hi, b_lo) = _beyond(z[:, a], spec), _beyond(z[:, b], spec)
+            hit = (a_hi & b_lo) | (a_lo & b_hi)
+            flags[:, a] |= hit
+            flags[:, b] |= hit
+        return flags
+    if spec.levels and len(cols) < len(spec.levels) or not spec.levels and len(cols) < spec.min_levels:
+        return flags
+    w = spec.runs
+    if w > n_runs:
+        return flags
+    rows = list(range(n_levels)) if spec.all_rows else cols
+    points = len(rows) * w
+    if points < spec.min_points:
+        return flags
+    need = points if spec.k is None else spec.k
+    hi, lo = _beyond(z[:, rows], spec)
+    hit = (_rolling_sum(hi.sum(axis=1), w) >= need) | (_rolling_sum(lo.sum(axis=1), w) >= need)
+    hit[:w - 1] = False
+    # Gắn cờ mọi điểm của cửa sổ w lượt kết thúc tại lượt vi phạm
+    covered = _rolling_sum(hit[::-1], w)[::-1] > 0
+    flags[:, rows] = covered[:, None]
+    return flags
+
+
+def _rejected(z, rules=None):
+    """rejected_runs trên khối z (lượt x mức x mô phỏng), bố cục liền bộ nhớ theo thời gian."""
+    compiled = resolve_rules(rules)
+    n_runs, n_levels, n_sims = z.shape
+    flagged = np.zeros(z.shape, dtype=bool) if compiled.clean else None
+    rejected = np.zeros(z.shape, dtype=bool)
+
+    def add(hits, spec):
+        if flagged is not None:
+            flagged[...] |= hits
+        if spec.severity == "reject":
+            rejected[...] |= hits
+
+    for spec in compiled.across:
+        add(_across_hits(z, spec), spec)
+    for spec in compiled.series:
+        # Mọi mức gộp theo thời gian: lượt chạy trước, trong lượt theo thứ tự mức
+        add(_series_hits(z.reshape(n_runs * n_levels, n_sims), spec).reshape(z.shape), spec)
+    by_level = z.reshape(n_runs, n_levels * n_sims)
+    for spec in compiled.within:
+        add(_series_hits(by_level, spec).reshape(z.shape), spec)
+    for spec in compiled.clean:
+        add(_series_hits(by_level, spec).reshape(z.shape) & ~flagged, spec)
+    return rejected.any(axis=(0, 1))
+
+
+def rejected_runs(z, rules=None):
+    """
+    Mảng bool (mô phỏng,): khối z (mô phỏng x lượt x mức) có bị loại theo bộ quy tắc không.
+    Chấm như westgard_bitmask: quy tắc only_if_clean chỉ gắn cho điểm chưa có vi phạm nào khác.
+    """
+    return _rejected(np.ascontiguousarray(np.asarray(z, dtype=float).transpose(1, 2, 0)), rules)
+
+
+def _count_rejections(task):
+    """Tác vụ 1 khối (chạy trong tiến trình con hoặc tuần tự): số lần mô phỏng bị loại."""
+    rules, n_levels, n_runs, shift, random_error, size, seed = task
+    rng = np.random.default_rng(seed)
+    z = rng.standard_normal((n_runs, n_levels, size))
+    if random_error != 1.0:
+        z *= random_error
+    z += shift
+    return int(_rejected(z, rules).sum())
+
+
+def _run_tasks(tasks, workers=None):
+    """Chạy các khối trên process pool (spawn) khi đủ lớn; lỗi pool thì chạy tuần tự."""
+    total = sum(task[5] for task in tasks)
+    if workers is None:
+        workers = 1 if total < MIN_SIMS_FOR_POOL else min(os.cpu_count() or 1, len(tasks))
+    if workers > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+                return list(pool.map(_count_rejections, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+        except Exception as e:
+            print(f"Không chạy được process pool ({e}), mô phỏng tuần tự.")
+    return [_count_rejections(task) for task in tasks]
+
+
+def _chunks(n_sims, seed):
+    """(cỡ khối, seed khối). Cùng seed thì mọi ứng viên dùng chung số ngẫu nhiên (so sánh công bằng hơn)."""
+    sizes = [CHUNK_SIZE] * (n_sims // CHUNK_SIZE) + ([n_sims % CHUNK_SIZE] if n_sims % CHUNK_SIZE else [])
+    return list(zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes))))
+
+
+def _simulate(cases, n_sims, seed, workers):
+    """cases: [(rules, n_levels, n_runs, shift, random_error)] -> xác suất loại của từng case."""
+    chunks = _chunks(n_sims, seed)
+    tasks = [case + (size, chunk_seed) for case in cases for size, chunk_seed in chunks]
+    counts = np.asarray(_run_tasks(tasks, workers)).reshape(len(cases), len(chunks))
+    return counts.sum(axis=1) / n_sims
+
+
+def rejection_probability(rules=None, n_levels=2, n_runs=1, shift=0.0, random_error=1.0,
+                          n_sims=DEFAULT_SIMS, seed=0, workers=None):
+    """Xác suất 1 lần mô phỏng bị loại với sai số hệ thống `shift` (SD) và sai số ngẫu nhiên x random_error."""
+    return float(_simulate([(rules, n_levels, n_runs, float(shift), float(random_error))], n_sims, seed, workers)[0])
+
+
+def power_curve(rules=None, n_levels=2, n_runs=1, shifts=DEFAULT_SHIFTS, n_sims=DEFAULT_SIMS, seed=0, workers=None):
+    """Power function: DataFrame (shift, p_reject) theo các mức sai số hệ thống."""
+    p = _simulate([(rules, n_levels, n_runs, float(s), 1.0) for s in shifts], n_sims, seed, workers)
+    return pd.DataFrame({"shift": list(shifts), "p_reject": p})
+
+
+def evaluate_candidates(sigma, rule_sets=None, levels=CANDIDATE_LEVELS, n_runs=1,
+                        n_sims=DEFAULT_SIMS, seed=0, workers=None):
+    """
+    Pfr và Ped (tại ΔSEcrit) của mọi tổ hợp bộ quy tắc x số mức control, mô phỏng trong 1 lần gọi pool.
+    Kết quả sắp theo chi phí: ít mức trước, rồi bộ quy tắc ít quy tắc dừng trước.
+    """
+    rule_sets = list(rule_sets or RULE_SETS)
+    d_se = critical_shift(sigma)
+    combos = [(name, n) for n in levels for name in rule_sets]
+    cases = [(name, n, n_runs, shift, 1.0) for name, n in combos for shift in (0.0, d_se)]
+    p = _simulate(cases, n_sims, seed, workers).reshape(len(combos), 2)
+    n_reject = {name: sum(s.severity == "reject" for s in RULE_SETS[name]) for name in rule_sets}
+    df = pd.DataFrame({
+        "rule_set": [name for name, _ in combos],
+        "label": [RULE_SET_LABELS.get(name, name) for name, _ in combos],
+        "n_levels": [n for _, n in combos],
+        "n_runs": n_runs,
+        "pfr": p[:, 0],
+        "ped": p[:, 1],
+        "reject_rules": [n_reject[name] for name, _ in combos],
+    })
+    return df.sort_values(["n_levels", "reject_rules"], kind="stable").reset_index(drop=True)
+
+
+def recommend_qc_design(sigma_results, target_ped=TARGET_PED, max_pfr=MAX_PFR, n_runs=1,
+                        n_sims=DEFAULT_SIMS, seed=0, workers=None):
+    """
+    Gợi ý thiết kế QC cho 1 test từ sigma_results ({level: {'sigma': ...}} của tab Six Sigma).
+    Dùng Sigma thấp nhất trong các mức; chọn tổ hợp rẻ nhất có Ped >= target_ped và Pfr <= max_pfr,
+    nếu không có thì tổ hợp Ped cao nhất trong các tổ hợp có Pfr <= max_pfr.
+    Trả về dict (rule_set, n_levels, ped, pfr, meets_target, sigma, critical_shift, candidates) hoặc None.
+    """
+    sigmas = [float(r['sigma']) for r in (sigma_results or {}).values() if r.get('sigma') is not None]
+    if not sigmas:
+        return None
+    sigma = min(sigmas)
+    candidates = evaluate_candidates(sigma, n_runs=n_runs, n_sims=n_sims, seed=seed, workers=workers)
+    candidates["meets_target"] = (candidates["ped"] >= target_ped) & (candidates["pfr"] <= max_pfr)
+    if candidates["meets_target"].any():
+        best = candidates[candidates["meets_target"]].iloc[0]
+    else:
+        allowed = candidates[candidates["pfr"] <= max_pfr]
+        best = (allowed if not allowed.empty else candidates).sort_values("ped", ascending=False, kind="stable").iloc[0]
+    return {
+        "rule_set": best["rule_set"],
+        "n_levels": int(best["n_levels"]),
+        "n_runs": n_runs,
+        "ped": float(best["ped"]),
+        "pfr": float(best["pfr"]),
+        "meets_target": bool(best["meets_target"]),
+        "sigma": sigma,
+        "critical_shift": critical_shift(sigma),
+        "candidates": candidates,
+    }
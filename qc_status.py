@@ -0,0 +1,124 @@
+# File: qc_status.py
+"""
+Quét trạng thái QC toàn phòng xét nghiệm và ghi vào bảng qc_status (1 dòng / test / mức):
+lot đang chạy, lần chạy cuối, kết quả Westgard cuối và số vi phạm dừng chưa xử lý.
+Màn hình tổng quan / treo tường chỉ đọc bảng này nên tải ngay cả khi có hàng trăm xét nghiệm.
+
+Chạy định kỳ (cron / Task Scheduler):  python qc_status.py [số tiến trình]
+"""
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+from westgard import PASS_LABEL, verdict_severity
+
+# Dấu mà Nhật ký xử lý vi phạm (tab Biểu đồ LJ) thêm vào ghi chú khi đã xử lý
+HANDLED_MARK = "[Xử lý lúc:"
+# Ít test thì quét tuần tự: khởi động tiến trình con tốn hơn chính việc quét
+MIN_TESTS_FOR_POOL = 20
+
+_WORKER_DB = None
+
+
+def test_status_rows(db, test, stamp):
+    """Các dòng qc_status của 1 test (dict có id, name, device); mỗi mức lấy lot có kết quả mới nhất."""
+    test_id = int(test['id'])
+    lots = db.get_lots_for_test(test_id)
+    current = db.get_current_lots(test_id)
+    if lots.empty or not current:
+        return []
+    lots = lots.set_index('id')
+    rules = db.get_rule_set(test_id)
+    drift_params = db.get_drift_params(test_id)
+    rows = []
+    for level, lot_id in sorted(current.items()):
+        lot = lots.loc[lot_id]
+        df = db.get_iqc_verdicts_by_lot(int(lot_id), lot['mean'], lot['sd'], rules, drift_params)
+        if df.empty:
+            continue
+        df = df[df['date'].notna()].sort_values(['date', 'id'])
+        if df.empty:
+            continue
+        severity = df['Violation'].map(lambda v: verdict_severity(v, rules))
+        handled = df['note'].fillna('').astype(str).str.contains(HANDLED_MARK, regex=False) \
+            if 'note' in df.columns else False
+        last = df.iloc[-1]
+        rows.append({
+            "test_id": test_id,
+            "level": int(level),
+            "test_name": test.get('name'),
+            "device": test.get('device'),
+            "lot_id": int(lot_id),
+            "lot_number": str(lot['lot_number']),
+            "last_run": last['date'].strftime('%Y-%m-%d %H:%M:%S'),
+            "last_value": None if pd.isna(last['value']) else float(last['value']),
+            "last_verdict": last['Violation'] or PASS_LABEL,
+            "status": severity.iloc[-1],
+            "open_rejections": int(((severity == "reject") & ~handled).sum()),
+            "updated_at": stamp,
+        })
+    return rows
+
+
+def _init_worker(db_factory):
+    global _WORKER_DB
+    _WORKER_DB = db_factory()
+
+
+def _scan_one(args):
+    """Chạy trong tiến trình con (hoặc tuần tự); lỗi của 1 test không làm dừng cả lần quét."""
+    test, stamp, db = args
+    try:
+        return test['id'], test_status_rows(db or _WORKER_DB, test, stamp), None
+    except Exception as e:
+        return test['id'], [], f"{test.get('name', test['id'])}: {e}"
+
+
+def scan_qc_status(db, test_ids=None, workers=None):
+    """
+    Quét các test (mặc định: tất cả) song song trên process pool rồi ghi bảng qc_status.
+    workers: số tiến trình (mặc định theo số CPU; 1 = tuần tự trong tiến trình hiện tại).
+    Trả về (success_count, errors): số dòng trạng thái đã ghi và danh sách lỗi theo test.
+    """
+    tests = db.get_all_tests()
+    if tests.empty:
+        return 0, []
+    wanted = None if test_ids is None else {int(t) for t in test_ids}
+    tests = [t for t in tests.to_dict('records') if wanted is None or int(t['id']) in wanted]
+    stamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+    if workers is None:
+        workers = 1 if len(tests) < MIN_TESTS_FOR_POOL else min(os.cpu_count() or 1, len(tests))
+
+    results = None
+    if workers > 1:
+        try:
+            # spawn: tiến trình con không thừa hưởng kết nối/luồng của Streamlit
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker, initargs=(db.worker_factory(),)) as pool:
+                results = list(pool.map(_scan_one, [(t, stamp, None) for t in tests]))
+        except Exception as e:
+            print(f"Không chạy được process pool ({e}), quét tuần tự.")
+    if results is None:
+        results = [_scan_one((t, stamp, db)) for t in tests]
+
+    rows = [row for _, test_rows, _ in results for row in test_rows]
+    errors = [err for _, _, err in results if err]
+    # Test lỗi giữ nguyên trạng thái cũ thay vì bị xóa
+    scanned = [test_id for test_id, _, err in results if not err]
+    if not db.save_qc_status(rows, scanned):
+        return 0, errors + ["Không ghi được bảng qc_status."]
+    return len(rows), errors
+
+
+if __name__ == "__main__":
+    from db_module import get_db_manager
+
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    count, errs = scan_qc_status(get_db_manager(), workers=n_workers)
+    print(f"Đã cập nhật {count} dòng trạng thái QC.")
+    for err in errs:
+        print(f"Lỗi: {err}")
@@ -0,0 +1,140 @@
+# File: render_cache.py
+"""
+Bộ nhớ đệm ảnh biểu đồ (PNG / SVG, hoặc spec JSON của biểu đồ tương tác) dùng chung giữa các lần rerun của Streamlit.
+Khóa = hash của dữ liệu đầu vào (DataFrame, mảng, số, chuỗi...) cùng tên biểu đồ, tùy chọn và định dạng ảnh;
+biểu đồ không đổi được trả lại ngay từ bộ nhớ mà không gọi matplotlib.
+Giới hạn theo tổng dung lượng ảnh (RENDER_CACHE_MAX_BYTES), bỏ ảnh dùng lâu nhất trước (LRU).
+"""
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+RENDER_CACHE_MAX_BYTES = 64 * 2 ** 20
+# Kích thước ước tính của phần không phải ảnh trong 1 mục (khóa, meta)
+ENTRY_OVERHEAD = 512
+
+_RENDER_CACHE = OrderedDict()
+_RENDER_CACHE_LOCK = threading.Lock()
+_RENDER_STATS = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+
+def _update_digest(digest, part):
+    """Đưa 1 thành phần khóa vào hash; DataFrame/Series/mảng hash theo nội dung, không theo id đối tượng."""
+    if isinstance(part, pd.DataFrame):
+        digest.update(f"df{part.shape}{list(part.columns)}{list(map(str, part.dtypes))}".encode("utf-8"))
+        if len(part):
+            digest.update(pd.util.hash_pandas_object(part, index=False).to_numpy().tobytes())
+    elif isinstance(part, (pd.Series, pd.Index)):
+        digest.update(f"s{len(part)}{part.dtype}".encode("utf-8"))
+        if len(part):
+            digest.update(pd.util.hash_array(np.asarray(part)).tobytes())
+    elif isinstance(part, np.ndarray):
+        digest.update(f"a{part.shape}{part.dtype}".encode("utf-8"))
+        digest.update(pd.util.hash_array(part.ravel()).tobytes() if part.dtype == object
+                      else np.ascontiguousarray(part).tobytes())
+    elif isinstance(part, dict):
+        digest.update(b"{")
+        for k in sorted(part, key=str):
+            _update_digest(digest, k)
+            _update_digest(digest, part[k])
+        digest.update(b"}")
+    elif isinstance(part, (list, tuple)):
+        digest.update(f"({len(part)}".encode("utf-8"))
+        for item in part:
+            _update_digest(digest, item)
+        digest.update(b")")
+    else:
+        digest.update(f"{type(part).__name__}:{part!r};".encode("utf-8"))
+
+
+def render_key(*parts):
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        _update_digest(digest, part)
+    return digest.hexdigest()
+
+
+def _get(key):
+    with _RENDER_CACHE_LOCK:
+        entry = _RENDER_CACHE.get(key)
+        if entry is None:
+            _RENDER_STATS["misses"] += 1
+            return None
+        _RENDER_CACHE.move_to_end(key)
+        _RENDER_STATS["hits"] += 1
+        return entry
+
+
+def _put(key, image, meta):
+    size = len(image) + ENTRY_OVERHEAD
+    if size > RENDER_CACHE_MAX_BYTES:
+        return
+    with _RENDER_CACHE_LOCK:
+        old = _RENDER_CACHE.pop(key, None)
+        if old is not None:
+            _RENDER_STATS["bytes"] -= old[2]
+        _RENDER_CACHE[key] = (image, meta, size)
+        _RENDER_STATS["bytes"] += size
+        while _RENDER_STATS["bytes"] > RENDER_CACHE_MAX_BYTES:
+            _, (_, _, dropped) = _RENDER_CACHE.popitem(last=False)
+            _RENDER_STATS["bytes"] -= dropped
+            _RENDER_STATS["evictions"] += 1
+
+
+def cached_bytes(name, key_parts, build):
+    """
+    Dữ liệu (bytes) của biểu đồ `name`: lấy từ bộ nhớ đệm nếu key_parts không đổi, nếu không thì gọi build().
+    build() trả về (bytes hoặc None, meta); None không được lưu. Trả về (bytes hoặc None, meta).
+    """
+    key = render_key(name, key_parts)
+    entry = _get(key)
+    if entry is not None:
+        return entry[0], entry[1]
+    data, meta = build()
+    if data is not None:
+        _put(key, data, meta)
+    return data, meta
+
+
+def cached_render(name, key_parts, build, fmt="png", dpi=200, **savefig_kwargs):
+    """
+    Ảnh (bytes) của biểu đồ `name`: lấy từ bộ nhớ đệm nếu key_parts không đổi, nếu không thì gọi build().
+    build() trả về Figure, hoặc (Figure, meta) để lưu kèm dữ liệu phụ (vd danh sách cảnh báo);
+    Figure được đóng ngay sau khi lưu ảnh. Trả về (bytes hoặc None nếu build() không vẽ gì, meta).
+    Mặc định lưu giống st.pyplot (dpi 200, bbox_inches='tight').
+    """
+    savefig_kwargs.setdefault("bbox_inches", "tight")
+
+    def build_image():
+        built = build()
+        fig, meta = built if isinstance(built, tuple) else (built, None)
+        if fig is None:
+            return None, meta
+        buf = io.BytesIO()
+        try:
+            fig.savefig(buf, format=fmt, dpi=dpi, **savefig_kwargs)
+        finally:
+            plt.close(fig)
+        return buf.getvalue(), meta
+
+    return cached_bytes(name, (fmt, dpi, savefig_kwargs, key_parts), build_image)
+
+
+def render_cache_stats():
+    """Số lần trúng/trượt, số ảnh bị bỏ, số ảnh và dung lượng đang giữ (MB)."""
+    with _RENDER_CACHE_LOCK:
+        stats = dict(_RENDER_STATS, entries=len(_RENDER_CACHE))
+    stats["megabytes"] = round(stats.pop("bytes") / 2 ** 20, 3)
+    stats["limit_megabytes"] = round(RENDER_CACHE_MAX_BYTES / 2 ** 20, 3)
+    return stats
+
+
+def clear_render_cache():
+    with _RENDER_CACHE_LOCK:
+        _RENDER_CACHE.clear()
+        _RENDER_STATS["bytes"] = 0
@@ -0,0 +1,162 @@
+# File: rule_replay.py
+"""
+Chạy lại (what-if) nhiều bộ quy tắc Westgard trên lịch sử IQC đã lưu để so sánh trước khi đổi bộ quy tắc.
+Mỗi xét nghiệm được đọc 1 lần; mọi bộ quy tắc được chấm trong 1 lượt bằng westgard_bitmasks
+(cùng ngữ nghĩa với get_westgard_violations, z-score của mỗi điểm tính theo Mean/SD của lot của nó).
+
+Dữ liệu thật không có nhãn "lỗi thật", nên sự kiện lỗi được lấy từ bộ báo trôi EWMA/CUSUM (drift.py):
+mỗi lần báo trôi của 1 (lot, mức) là 1 sự kiện gồm điểm báo và EVENT_POINTS - 1 điểm trước đó của chuỗi.
+  - phát hiện: sự kiện có ít nhất 1 điểm bị loại (quy tắc dừng) trong các điểm của nó
+  - loại bỏ nhầm: điểm bị loại không thuộc sự kiện nào
+
+    python rule_replay.py [số tháng]      # so sánh mọi bộ trong RULE_SETS trên mọi xét nghiệm
+"""
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from drift import add_drift_columns
+from westgard import RULE_BITS, RULE_SETS, resolve_rules, westgard_bitmasks
+
+REPLAY_MONTHS = 12
+# Số điểm (tính cả điểm báo) của 1 sự kiện lỗi trong chuỗi (lot, mức)
+EVENT_POINTS = 10
+SUMMARY_COLUMNS = [
+    "rule_set", "tests", "points", "in_control_points", "runs", "rejected_points", "rejected_runs", "warning_points",
+    "false_rejections", "false_rejection_rate", "events", "detected_events", "detection_rate",
+]
+
+
+def reject_bits(rules):
+    """Bitmask các nhãn là quy tắc dừng của 1 bộ quy tắc."""
+    severity = resolve_rules(rules).severity
+    return sum(RULE_BITS[label] for label, level in severity.items() if level == "reject")
+
+
+def load_test_history(db, test_id, date_from=None):
+    """
+    Kết quả IQC của 1 xét nghiệm (mọi lot) kèm mean/sd của lot và z-score từng điểm, sắp xếp theo (date, id).
+    Cùng quy ước z với LevelStream: z = 0 khi sd <= 0, thiếu thông số hoặc giá trị lỗi.
+    """
+    df = db.read_iqc_stream(test_id, date_from=date_from, columns=["id", "lot_id", "date", "level", "value"])
+    lots = db.get_lots_for_test(test_id)
+    if df.empty or lots.empty:
+        return pd.DataFrame()
+    lots = lots.set_index('id')
+    df = df[df['date'].notna() & df['level'].notna()].sort_values(['date', 'id'], kind='stable')
+    df = df.reset_index(drop=True)
+    df['mean'] = df['lot_id'].map(lots['mean']).astype(float)
+    df['sd'] = df['lot_id'].map(lots['sd']).astype(float)
+    values = pd.to_numeric(df['value'], errors='coerce').to_numpy(dtype=float)
+    sd = df['sd'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(sd > 0, (values - df['mean'].to_numpy()) / sd, 0.0)
+    df['z'] = np.where(np.isfinite(z), z, 0.0)
+    return df
+
+
+def error_events(df, drift_params=None, event_points=EVENT_POINTS):
+    """
+    (mảng id sự kiện của từng điểm, -1 nếu không thuộc sự kiện nào; số sự kiện).
+    Sự kiện = mỗi lần báo trôi EWMA/CUSUM của 1 (lot, mức) cùng event_points - 1 điểm trước nó.
+    Điểm thuộc nhiều sự kiện chồng nhau được gán cho sự kiện sau.
+    """
+    event_of = np.full(len(df), -1)
+    n_events = 0
+    for _, lot in df.groupby('lot_id', sort=False):
+        scored = add_drift_columns(lot, lot['mean'].iloc[0], lot['sd'].iloc[0], drift_params)[0]
+        for _, g in scored.groupby('level', sort=False):
+            pos = g.index.to_numpy()
+            for end in np.flatnonzero(g['drift'].to_numpy() != ""):
+                event_of[pos[max(0, end - event_points + 1):end + 1]] = n_events
+                n_events += 1
+    return event_of, n_events
+
+
+def replay_history(df, rule_sets, drift_params=None, event_points=EVENT_POINTS):
+    """
+    Chấm lịch sử của 1 xét nghiệm (kết quả load_test_history) bằng mọi bộ quy tắc trong 1 lượt.
+    rule_sets: dict tên -> tên bộ trong RULE_SETS hoặc danh sách RuleSpec.
+    Trả về DataFrame 1 dòng / bộ quy tắc với các cột của SUMMARY_COLUMNS (trừ 'tests').
+    """
+    if df.empty:
+        return pd.DataFrame(columns=[c for c in SUMMARY_COLUMNS if c != "tests"])
+    masks = westgard_bitmasks(df, rule_sets, z=df['z'].to_numpy())
+    event_of, n_events = error_events(df, drift_params, event_points)
+    in_event = event_of >= 0
+    run_codes = pd.factorize(df['date'])[0]
+    rows = []
+    for name, rules in rule_sets.items():
+        mask = masks[name].to_numpy()
+        rejected = (mask & reject_bits(rules)) != 0
+        detected = len(np.unique(event_of[rejected & in_event]))
+        false_rejections = int((rejected & ~in_event).sum())
+        rows.append({
+            "rule_set": name,
+            "points": len(df),
+            "in_control_points": int((~in_event).sum()),
+            "runs": int(run_codes.max()) + 1,
+            "rejected_points": int(rejected.sum()),
+            "rejected_runs": len(np.unique(run_codes[rejected])),
+            "warning_points": int(((mask != 0) & ~rejected).sum()),
+            "false_rejections": false_rejections,
+            "false_rejection_rate": false_rejections / max(int((~in_event).sum()), 1),
+            "events": n_events,
+            "detected_events": detected,
+            "detection_rate": detected / n_events if n_events else np.nan,
+        })
+    return pd.DataFrame(rows)
+
+
+def replay_rule_sets(db, rule_sets=None, test_ids=None, months=REPLAY_MONTHS, event_points=EVENT_POINTS):
+    """
+    Chạy lại các bộ quy tắc (mặc định: mọi bộ trong RULE_SETS) trên lịch sử IQC `months` tháng gần nhất
+    của các xét nghiệm (mặc định: tất cả). Sự kiện lỗi dùng thông số EWMA/CUSUM của từng xét nghiệm.
+    Trả về (bảng tổng hợp theo bộ quy tắc, bảng chi tiết theo xét nghiệm x bộ quy tắc, danh sách lỗi).
+    """
+    if rule_sets is None:
+        rule_sets = {name: name for name in RULE_SETS}
+    elif not isinstance(rule_sets, dict):
+        rule_sets = {name: name for name in rule_sets}
+    date_from = (datetime.now() - timedelta(days=months * 30)).strftime('%Y-%m-%d') if months else None
+
+    tests = db.get_all_tests()
+    if tests.empty:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS), pd.DataFrame(), []
+    wanted = None if test_ids is None else {int(t) for t in test_ids}
+    parts, errors = [], []
+    for test in tests.to_dict('records'):
+        if wanted is not None and int(test['id']) not in wanted:
+            continue
+        try:
+            history = load_test_history(db, int(test['id']), date_from)
+            result = replay_history(history, rule_sets, db.get_drift_params(int(test['id'])), event_points)
+        except Exception as e:
+            errors.append(f"{test.get('name', test['id'])}: {e}")
+            continue
+        if not result.empty:
+            parts.append(result.assign(test_id=int(test['id']), test_name=test.get('name')))
+    if not parts:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS), pd.DataFrame(), errors
+
+    by_test = pd.concat(parts, ignore_index=True)
+    counts = ["points", "in_control_points", "runs", "rejected_points", "rejected_runs", "warning_points",
+              "false_rejections", "events", "detected_events"]
+    summary = by_test.groupby('rule_set', sort=False)[counts].sum()
+    summary['tests'] = by_test.groupby('rule_set', sort=False)['test_id'].nunique()
+    # Tỉ lệ tính lại trên tổng số điểm / sự kiện của mọi xét nghiệm
+    summary['false_rejection_rate'] = summary['false_rejections'] / summary['in_control_points'].clip(lower=1)
+    summary['detection_rate'] = summary['detected_events'] / summary['events'].where(summary['events'] > 0)
+    return summary.reset_index()[SUMMARY_COLUMNS], by_test, errors
+
+
+if __name__ == "__main__":
+    from db_module import get_db_manager
+
+    n_months = int(sys.argv[1]) if len(sys.argv) > 1 else REPLAY_MONTHS
+    table, _, errs = replay_rule_sets(get_db_manager(), months=n_months)
+    print(table.to_string(index=False))
+    for err in errs:
+        print(f"Lỗi: {err}")
@@ -0,0 +1,593 @@
+# File: sqlite_backend.py
+import os
+import sqlite3
+import threading
+from functools import partial
+import streamlit as st
+import pandas as pd
+from datetime import datetime, date
+
+from db_module import DBManager, _date_window, _aggregate_iqc_frame, _scored_fields_changed, coerce_frame
+
+
+def _marks(values):
+    """Chuỗi '?, ?, ?' cho mệnh đề IN / VALUES."""
+    return ', '.join('?' * len(values))
+
+
+class SQLiteDBManager(DBManager):
+    """
+    Backend lưu trữ cục bộ trên file SQLite (mặc định lab_data.db).
+    Cài đặt lại toàn bộ API của DBManager bằng SQL thuần:
+    - WAL mode để đọc không bị chặn khi đang ghi.
+    - Mỗi luồng (thread) của Streamlit có 1 kết nối riêng.
+    - Các thao tác nhiều câu lệnh chạy trong 1 transaction thật.
+    """
+
+    def __init__(self, db_path="lab_data.db"):
+        self.db_path = db_path
+        self.url = f"sqlite:///{db_path}"
+        self._local = threading.local()
+        self.create_tables()
+
+    # --- KẾT NỐI ---
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _query(self, sql, params=()):
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def _rows(self, sql, params=()):
+        return [dict(r) for r in self.conn.execute(sql, params).fetchall()]
+
+    def _write(self, sql, params=()):
+        """Chạy 1 câu lệnh ghi trong transaction, trả về số dòng bị ảnh hưởng."""
+        with self.conn:
+            return self.conn.execute(sql, params).rowcount
+
+    def create_tables(self):
+        """Tạo các bảng/index nếu chưa tồn tại (cùng cấu trúc với lab_data.db)."""
+        with self.conn:
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS tests (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT UNIQUE NOT NULL,
+                    unit TEXT,
+                    tea REAL,
+                    device TEXT,
+                    cvi REAL DEFAULT 0,
+                    cvg REAL DEFAULT 0,
+                    last_mu_review TEXT);
+                CREATE TABLE IF NOT EXISTS lots (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    test_id INTEGER,
+                    lot_number TEXT NOT NULL,
+                    level INTEGER NOT NULL,
+                    method TEXT,
+                    expiry_date TEXT,
+                    mean REAL,
+                    sd REAL,
+                    data_version INTEGER DEFAULT 0,
+                    FOREIGN KEY (test_id) REFERENCES tests (id));
+                CREATE TABLE IF NOT EXISTS iqc_results (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    lot_id INTEGER,
+                    date TEXT,
+                    level INTEGER,
+                    value REAL,
+                    note TEXT, is_approved INTEGER DEFAULT 0, approved_by TEXT, approved_at TEXT, action TEXT DEFAULT '',
+                    violation TEXT,
+                    drift TEXT,
+                    FOREIGN KEY (lot_id) REFERENCES lots (id));
+                CREATE TABLE IF NOT EXISTS eqa_results (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    test_id INTEGER,
+                    date TEXT,
+                    lab_value REAL,
+                    ref_value REAL,
+                    sd_group REAL,
+                    sdi REAL,
+                    program_name TEXT,
+                    FOREIGN KEY (test_id) REFERENCES tests (id));
+                CREATE TABLE IF NOT EXISTS test_mapping (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    test_id INTEGER,
+                    external_name TEXT UNIQUE,
+                    FOREIGN KEY (test_id) REFERENCES tests (id));
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT);
+                CREATE TABLE IF NOT EXISTS qc_status (
+                    test_id INTEGER NOT NULL,
+                    level INTEGER NOT NULL,
+                    test_name TEXT,
+                    device TEXT,
+                    lot_id INTEGER,
+                    lot_number TEXT,
+                    last_run TEXT,
+                    last_value REAL,
+                    last_verdict TEXT,
+                    status TEXT,
+                    open_rejections INTEGER DEFAULT 0,
+                    updated_at TEXT,
+                    PRIMARY KEY (test_id, level));
+                CREATE TABLE IF NOT EXISTS drift_state (
+                    lot_id INTEGER NOT NULL,
+                    level INTEGER NOT NULL,
+                    n INTEGER,
+                    ewma REAL,
+                    cusum_hi REAL,
+                    cusum_lo REAL,
+                    last_date TEXT,
+                    last_value REAL,
+                    mean REAL,
+                    sd REAL,
+                    params TEXT,
+                    PRIMARY KEY (lot_id, level));
+                CREATE INDEX IF NOT EXISTS idx_lots_test ON lots (test_id);
+                CREATE INDEX IF NOT EXISTS idx_iqc_lot_date ON iqc_results (lot_id, date);
+                CREATE INDEX IF NOT EXISTS idx_eqa_res_test ON eqa_results (test_id);
+            ''')
+            # File DB cũ: thêm cột lưu kết quả Westgard (NULL = chưa chấm)
+            iqc_cols = {r['name'] for r in self.conn.execute("PRAGMA table_info(iqc_results)")}
+            if 'violation' not in iqc_cols:
+                self.conn.execute("ALTER TABLE iqc_results ADD COLUMN violation TEXT")
+            # ... và nhãn báo trôi EWMA/CUSUM (NULL = chưa chấm)
+            if 'drift' not in iqc_cols:
+                self.conn.execute("ALTER TABLE iqc_results ADD COLUMN drift TEXT")
+            # Phiên bản dữ liệu của lot: trigger tăng mỗi khi iqc_results của lot thay đổi
+            # (không tính cột violation/drift, vốn chỉ là kết quả chấm lưu sẵn)
+            if 'data_version' not in {r['name'] for r in self.conn.execute("PRAGMA table_info(lots)")}:
+                self.conn.execute("ALTER TABLE lots ADD COLUMN data_version INTEGER DEFAULT 0")
+            self.conn.executescript('''
+                CREATE TRIGGER IF NOT EXISTS trg_iqc_version_insert AFTER INSERT ON iqc_results
+                BEGIN UPDATE lots SET data_version = data_version + 1 WHERE id = NEW.lot_id; END;
+                CREATE TRIGGER IF NOT EXISTS trg_iqc_version_delete AFTER DELETE ON iqc_results
+                BEGIN UPDATE lots SET data_version = data_version + 1 WHERE id = OLD.lot_id; END;
+                CREATE TRIGGER IF NOT EXISTS trg_iqc_version_update
+                AFTER UPDATE OF lot_id, date, level, value, note, action ON iqc_results
+                BEGIN UPDATE lots SET data_version = data_version + 1 WHERE id IN (OLD.lot_id, NEW.lot_id); END;
+            ''')
+
+    def upgrade_tables(self):
+        self.create_tables()
+
+    def upgrade_db(self):
+        self.create_tables()
+
+    def execute_raw(self, sql):
+        try:
+            with self.conn:
+                self.conn.executescript(sql)
+            return True
+        except Exception as e:
+            print(f"Lỗi SQL: {e}")
+            return False
+
+    # --- CÀI ĐẶT ---
+    def get_setting(self, key, default=None):
+        try:
+            rows = self._rows("SELECT value FROM settings WHERE key = ?", (key,))
+            return rows[0]['value'] if rows else default
+        except:
+            return default
+
+    def set_setting(self, key, value):
+        try:
+            self._write("INSERT INTO settings (key, value) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+            return True
+        except Exception as e:
+            print(f"LỖI DB: Không thể lưu cài đặt {key}: {e}")
+            return False
+
+    # --- QUẢN LÝ THIẾT BỊ & TESTS ---
+    def get_all_devices(self):
+        try:
+            rows = self._rows("SELECT DISTINCT device FROM tests WHERE device IS NOT NULL AND device != '' ORDER BY device")
+            return [r['device'] for r in rows]
+        except: return []
+
+    def add_test(self, name, unit, tea, device, cvi=0, cvg=0):
+        try:
+            self._write("INSERT INTO tests (name, unit, tea, device, cvi, cvg) VALUES (?, ?, ?, ?, ?, ?)",
+                        (name, unit, tea, device, cvi, cvg))
+            return True
+        except: return False
+
+    def get_all_tests(self):
+        try:
+            return self._query("SELECT * FROM tests ORDER BY id")
+        except Exception as e:
+            st.error(f"Lỗi truy vấn danh sách xét nghiệm: {e}")
+            return pd.DataFrame()
+
+    def update_test(self, test_id, name, unit, device, tea, cvi, cvg):
+        """Cập nhật thông tin xét nghiệm bao gồm cả TEa, CVi, CVg"""
+        try:
+            self._write("UPDATE tests SET name = ?, unit = ?, device = ?, tea = ?, cvi = ?, cvg = ? WHERE id = ?",
+                        (name, unit, device, tea, cvi, cvg, int(test_id)))
+            return True
+        except Exception as e:
+            print(f"Lỗi cập nhật Database: {e}")
+            return False
+
+    def update_test_info(self, test_id, name, unit, tea, device, cvi, cvg):
+        return self.update_test(test_id, name, unit, device, tea, cvi, cvg)
+
+    def delete_test(self, test_id):
+        """Xóa Test VÀ TẤT CẢ dữ liệu liên quan (trong 1 transaction), trả về số dòng đã xóa theo bảng."""
+        try:
+            test_id = int(test_id)
+            with self.conn:
+                counts = self._delete_lots_where("test_id = ?", (test_id,))
+                counts["eqa_results"] = self.conn.execute("DELETE FROM eqa_results WHERE test_id = ?", (test_id,)).rowcount
+                counts["test_mapping"] = self.conn.execute("DELETE FROM test_mapping WHERE test_id = ?", (test_id,)).rowcount
+                counts["tests"] = self.conn.execute("DELETE FROM tests WHERE id = ?", (test_id,)).rowcount
+                self.conn.execute("DELETE FROM qc_status WHERE test_id = ?", (test_id,))
+            return counts
+        except Exception as e:
+            print(f"LỖI DB: Không thể xóa Test ID {test_id}: {e}")
+            return None
+
+    def _delete_lots_where(self, condition, params):
+        """Xóa lots thỏa điều kiện cùng iqc_results của chúng; gọi bên trong 1 transaction đang mở."""
+        iqc = self.conn.execute(f"DELETE FROM iqc_results WHERE lot_id IN (SELECT id FROM lots WHERE {condition})", params).rowcount
+        self.conn.execute(f"DELETE FROM drift_state WHERE lot_id IN (SELECT id FROM lots WHERE {condition})", params)
+        lots = self.conn.execute(f"DELETE FROM lots WHERE {condition}", params).rowcount
+        return {"lots": lots, "iqc_results": iqc}
+
+    def update_mu_review(self, test_id, review_date):
+        try:
+            self._write("UPDATE tests SET last_mu_review = ? WHERE id = ?", (review_date, int(test_id)))
+            return True
+        except Exception as e:
+            print(f"Error updating MU review: {e}")
+            return False
+
+    # --- QUẢN LÝ LOTS ---
+    def add_lot(self, test_id, lot_number, level, method, expiry_date, mean, sd):
+        try:
+            exp_str = expiry_date.strftime('%Y-%m-%d') if isinstance(expiry_date, (datetime, pd.Timestamp, date)) else str(expiry_date)
+            self._write("INSERT INTO lots (test_id, lot_number, level, method, expiry_date, mean, sd) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (int(test_id), lot_number, int(level), method, exp_str, mean, sd))
+            return True
+        except: return False
+
+    def get_lots_for_test(self, test_id):
+        try:
+            return coerce_frame(self._query("SELECT * FROM lots WHERE test_id = ? ORDER BY id", (int(test_id),)), "lots")
+        except Exception as e:
+            print(f"Lỗi truy vấn Lot của Test ID {test_id}: {e}")
+            return pd.DataFrame()
+
+    def update_lot_params(self, lot_id, lot_number, method, expiry_date, mean, sd):
+        try:
+            exp_str = expiry_date.strftime('%Y-%m-%d') if isinstance(expiry_date, (datetime, pd.Timestamp, date)) else str(expiry_date)
+            self._write("UPDATE lots SET lot_number = ?, method = ?, expiry_date = ?, mean = ?, sd = ? WHERE id = ?",
+                        (lot_number, method, exp_str, mean, sd, int(lot_id)))
+            self.refresh_lot_verdicts(lot_id)
+            return True
+        except: return False
+
+    def delete_lot(self, lot_id):
+        try:
+            with self.conn:
+                return self._delete_lots_where("id = ?", (int(lot_id),))
+        except Exception as e:
+            print(f"Lỗi khi xóa Lot: {e}")
+            return None
+
+    def delete_lots_for_test(self, test_id):
+        try:
+            with self.conn:
+                return self._delete_lots_where("test_id = ?", (int(test_id),))
+        except Exception as e:
+            print(f"Lỗi khi xóa Lot của Test ID {test_id}: {e}")
+            return None
+
+    def update_lot(self, lot_id, lot_number, mean, sd, expiration_date):
+        try:
+            self._write("UPDATE lots SET lot_number = ?, mean = ?, sd = ?, expiry_date = ? WHERE id = ?",
+                        (lot_number, mean, sd, expiration_date, int(lot_id)))
+            self.refresh_lot_verdicts(lot_id)
+            return True
+        except Exception as e:
+            print(f"Lỗi khi cập nhật Lot: {e}")
+            return False
+
+    # --- QUẢN LÝ IQC DATA ---
+    def update_iqc_action(self, result_id, action_text):
+        self._write("UPDATE iqc_results SET action = ? WHERE id = ?", (action_text, int(result_id)))
+
+    def iter_iqc_stream(self, test_id=None, date_from=None, columns=None, page_size=None, date_before=None):
+        """Cùng thứ tự (date, id) như bản Supabase; SQLite đọc dần từ 1 cursor theo chunksize."""
+        columns = list(columns or self.IQC_COLUMNS)
+        select = ', '.join(f"r.{c}" for c in columns) + ", l.lot_number"
+        sql = "FROM iqc_results r LEFT JOIN lots l ON l.id = r.lot_id"
+        where, params = [], []
+        if test_id is None:
+            select += ", t.name AS test_name"
+            sql += " LEFT JOIN tests t ON t.id = l.test_id"
+        else:
+            where.append("l.test_id = ?")
+            params.append(int(test_id))
+        if date_from:
+            where.append("r.date >= ?")
+            params.append(date_from)
+        if date_before:
+            where.append("r.date < ?")
+            params.append(date_before)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql = f"SELECT {select} {sql} ORDER BY r.date IS NULL, r.date, r.id"
+        for chunk in pd.read_sql_query(sql, self.conn, params=params, chunksize=page_size or self.STREAM_PAGE_SIZE):
+            yield coerce_frame(chunk, "iqc_results")
+
+    def get_iqc_data_filtered(self, test_id, d_start, d_end):
+        date_from, date_before = _date_window(d_start, d_end)
+        return self.read_iqc_stream(test_id, date_from=date_from, date_before=date_before)
+
+    def get_iqc_level_stats(self, test_id, d_start=None, d_end=None, by_lot=False):
+        """GROUP BY trực tiếp trong SQLite; lọc 3SD so sánh bình phương độ lệch với 9*phương sai (không cần sqrt)."""
+        date_from, date_before = _date_window(d_start, d_end)
+        lot_key = "r.lot_id" if by_lot else "0"
+        lot_name = "l.lot_number" if by_lot else "NULL"
+        sql = f"""
+            WITH r AS (
+                SELECT r.level AS level, {lot_key} AS lot_id, {lot_name} AS lot_number, r.value AS v, r.date AS d
+                FROM iqc_results r JOIN lots l ON l.id = r.lot_id
+                WHERE l.test_id = ? AND r.value IS NOT NULL AND r.date IS NOT NULL
+                  AND (? IS NULL OR r.date >= ?) AND (? IS NULL OR r.date < ?)),
+            g AS (
+                SELECT level, lot_id, AVG(v) AS m, COUNT(*) AS cnt FROM r GROUP BY level, lot_id),
+            s AS (
+                SELECT g.level, g.lot_id, g.m,
+                       CASE WHEN g.cnt > 1 THEN SUM((r.v - g.m) * (r.v - g.m)) / (g.cnt - 1) END AS var
+                FROM g JOIN r ON r.level = g.level AND r.lot_id = g.lot_id
+                GROUP BY g.level, g.lot_id)
+            SELECT r.level, r.lot_id, MAX(r.lot_number) AS lot_number,
+                   COUNT(*) AS n, SUM(r.v) AS sum, SUM(r.v * r.v) AS sumsq,
+                   MIN(r.v) AS min_value, MAX(r.v) AS max_value,
+                   SUM(CASE WHEN (r.v - s.m) * (r.v - s.m) <= 9 * s.var THEN 1 ELSE 0 END) AS n_clean,
+                   TOTAL(CASE WHEN (r.v - s.m) * (r.v - s.m) <= 9 * s.var THEN r.v END) AS sum_clean,
+                   TOTAL(CASE WHEN (r.v - s.m) * (r.v - s.m) <= 9 * s.var THEN r.v * r.v END) AS sumsq_clean,
+                   MIN(r.d) AS first_date, MAX(r.d) AS last_date
+            FROM r JOIN s ON s.level = r.level AND s.lot_id = r.lot_id
+            GROUP BY r.level, r.lot_id
+            ORDER BY r.level, r.lot_id"""
+        df = self._query(sql, (int(test_id), date_from, date_from, date_before, date_before))
+        if not by_lot:
+            df['lot_id'] = None
+        return df[_aggregate_iqc_frame(None).columns]
+
+    def get_iqc_data_by_lot(self, lot_id, with_verdicts=False):
+        try:
+            cols = "id, date, value, level, note" + (", violation, drift" if with_verdicts else "")
+            return coerce_frame(self._query(f"SELECT {cols} FROM iqc_results WHERE lot_id = ? ORDER BY date DESC",
+                                            (int(lot_id),)), "iqc_results")
+        except Exception as e:
+            print(f"Lỗi truy vấn: {e}")
+            return pd.DataFrame()
+
+    def get_iqc_data_by_lot_full(self, lot_id):
+        return coerce_frame(self._query("SELECT id, date, value, note FROM iqc_results WHERE lot_id = ? ORDER BY date DESC",
+                                        (int(lot_id),)), "iqc_results")
+
+    def update_iqc_data(self, iqc_id, note, dt, level, value, refresh=True):
+        try:
+            d_str = dt.strftime('%Y-%m-%d %H:%M:%S') if isinstance(dt, (pd.Timestamp, datetime)) else str(dt)
+            before = self._rows("SELECT lot_id, date, level, value FROM iqc_results WHERE id = ?", (int(iqc_id),))
+            self._write("UPDATE iqc_results SET date = ?, level = ?, value = ?, note = ? WHERE id = ?",
+                        (d_str, int(level), value, note, int(iqc_id)))
+            if refresh:
+                for lot_id in {r['lot_id'] for r in before if _scored_fields_changed(r, d_str, level, value)}:
+                    self.refresh_lot_verdicts(lot_id)
+            return True
+        except Exception as e:
+            print(f"Lỗi SQL: {e}")
+            return False
+
+    def delete_iqc_result(self, row_id, refresh=True):
+        try:
+            lots = self._rows("SELECT lot_id FROM iqc_results WHERE id = ?", (int(row_id),)) if refresh else []
+            self._write("DELETE FROM iqc_results WHERE id = ?", (int(row_id),))
+            for r in lots:
+                self.refresh_lot_verdicts(r['lot_id'])
+            return True
+        except Exception as e:
+            print(f"Lỗi xóa IQC: {e}")
+            return False
+
+    # --- CÁC TRUY VẤN THEO LÔ DÙNG CHO IMPORT ---
+    def _fetch_mappings(self, external_names):
+        if not external_names:
+            return {}
+        rows = self._rows(f"SELECT external_name, test_id FROM test_mapping WHERE external_name IN ({_marks(external_names)})",
+                          list(external_names))
+        return {r['external_name']: r['test_id'] for r in rows}
+
+    def _fetch_lots_for_tests(self, test_ids):
+        if not test_ids:
+            return pd.DataFrame()
+        return self._query(f"SELECT id, test_id, lot_number, level FROM lots WHERE test_id IN ({_marks(test_ids)})",
+                           [int(t) for t in test_ids])
+
+    def _fetch_iqc_keys(self, lot_ids, d_min, d_max):
+        return self._query(
+            f"SELECT id, lot_id, date, value FROM iqc_results WHERE lot_id IN ({_marks(lot_ids)}) AND date >= ? AND date <= ?",
+            [int(l) for l in lot_ids] + [d_min, d_max])
+
+    # --- KẾT QUẢ WESTGARD LƯU SẴN ---
+    def _verdicts_supported(self):
+        return True
+
+    def _drift_supported(self):
+        return True
+
+    def _fetch_lot_params(self, lot_ids):
+        if not lot_ids:
+            return {}
+        rows = self._rows(f"SELECT id, test_id, mean, sd FROM lots WHERE id IN ({_marks(lot_ids)})", [int(l) for l in lot_ids])
+        return {r['id']: r for r in rows}
+
+    def _fetch_level_tail(self, lot_id, level, limit):
+        return self._rows("SELECT id, date, value FROM iqc_results WHERE lot_id = ? AND level = ? "
+                          "ORDER BY date DESC, id DESC LIMIT ?", (int(lot_id), int(level), int(limit)))
+
+    def _fetch_lot_series(self, lot_id):
+        return self._query("SELECT id, date, level, value, violation, drift FROM iqc_results WHERE lot_id = ?",
+                           (int(lot_id),))
+
+    def _write_verdicts(self, verdicts, column="violation"):
+        if verdicts:
+            with self.conn:
+                self.conn.executemany(f"UPDATE iqc_results SET {column} = ? WHERE id = ?",
+                                      [(label, int(row_id)) for row_id, label in verdicts.items()])
+
+    def _lot_versions(self, lot_ids):
+        if not lot_ids:
+            return {}
+        ids = [int(l) for l in lot_ids]
+        return {r['id']: r['data_version'] for r in
+                self._rows(f"SELECT id, data_version FROM lots WHERE id IN ({_marks(ids)})", ids)}
+
+    def _reset_verdicts(self, lot_ids):
+        if lot_ids:
+            self._write(f"UPDATE iqc_results SET violation = NULL WHERE lot_id IN ({_marks(lot_ids)})",
+                        [int(l) for l in lot_ids])
+
+    def _load_drift_states(self, lot_ids):
+        if not lot_ids:
+            return {}
+        rows = self._rows(f"SELECT * FROM drift_state WHERE lot_id IN ({_marks(lot_ids)})", [int(l) for l in lot_ids])
+        return {(r['lot_id'], r['level']): r for r in rows}
+
+    def _save_drift_states(self, rows):
+        if not rows:
+            return
+        cols = list(rows[0].keys())
+        with self.conn:
+            self.conn.executemany(f"INSERT OR REPLACE INTO drift_state ({', '.join(cols)}) VALUES ({_marks(cols)})",
+                                  [[r[c] for c in cols] for r in rows])
+
+    def _reset_drift(self, lot_ids):
+        if lot_ids:
+            ids = [int(l) for l in lot_ids]
+            with self.conn:
+                self.conn.execute(f"UPDATE iqc_results SET drift = NULL WHERE lot_id IN ({_marks(ids)})", ids)
+                self.conn.execute(f"DELETE FROM drift_state WHERE lot_id IN ({_marks(ids)})", ids)
+
+    def _insert_rows(self, table, rows):
+        if not rows:
+            return
+        cols = list(rows[0].keys())
+        with self.conn:
+            self.conn.executemany(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({_marks(cols)})",
+                                  [[r[c] for c in cols] for r in rows])
+
+    def _update_rows_by_id(self, table, rows):
+        if not rows:
+            return
+        cols = [c for c in rows[0].keys() if c != 'id']
+        with self.conn:
+            self.conn.executemany(f"UPDATE {table} SET {', '.join(f'{c} = ?' for c in cols)} WHERE id = ?",
+                                  [[r[c] for c in cols] + [r['id']] for r in rows])
+
+    # --- TRẠNG THÁI QC TOÀN PHÒNG ---
+    def get_qc_status(self):
+        try:
+            return coerce_frame(self._query("SELECT * FROM qc_status ORDER BY test_id, level"), "qc_status")
+        except Exception as e:
+            print(f"Lỗi đọc bảng qc_status: {e}")
+            return pd.DataFrame()
+
+    def save_qc_status(self, rows, test_ids):
+        """Thay toàn bộ dòng qc_status của các test vừa quét trong 1 transaction."""
+        cols = ["test_id", "level", "test_name", "device", "lot_id", "lot_number", "last_run",
+                "last_value", "last_verdict", "status", "open_rejections", "updated_at"]
+        try:
+            with self.conn:
+                ids = [int(t) for t in test_ids]
+                if ids:
+                    self.conn.execute(f"DELETE FROM qc_status WHERE test_id IN ({_marks(ids)})", ids)
+                self.conn.executemany(f"INSERT OR REPLACE INTO qc_status ({', '.join(cols)}) VALUES ({_marks(cols)})",
+                                      [[r.get(c) for c in cols] for r in rows])
+            return True
+        except Exception as e:
+            print(f"Lỗi ghi bảng qc_status: {e}")
+            return False
+
+    def get_current_lots(self, test_id):
+        rows = self._rows('''
+            SELECT level, lot_id FROM (
+                SELECT l.level, r.lot_id,
+                       ROW_NUMBER() OVER (PARTITION BY l.level ORDER BY r.date DESC, r.id DESC) AS rn
+                FROM iqc_results r JOIN lots l ON l.id = r.lot_id
+                WHERE l.test_id = ?)
+            WHERE rn = 1''', (int(test_id),))
+        return {int(r['level']): r['lot_id'] for r in rows}
+
+    def worker_factory(self):
+        return partial(SQLiteDBManager, os.path.abspath(self.db_path))
+
+    # --- MAPPING ---
+    def add_mapping(self, test_id, external_name):
+        self._write("INSERT INTO test_mapping (test_id, external_name) VALUES (?, ?) "
+                    "ON CONFLICT(external_name) DO UPDATE SET test_id = excluded.test_id", (int(test_id), external_name))
+
+    def get_all_mappings(self):
+        return self._query(
+            "SELECT m.id, m.test_id, m.external_name, t.name AS internal_name "
+            "FROM test_mapping m JOIN tests t ON t.id = m.test_id ORDER BY m.id")
+
+    def update_mapping(self, mapping_id, new_external_name):
+        self._write("UPDATE test_mapping SET external_name = ? WHERE id = ?", (new_external_name, int(mapping_id)))
+
+    def delete_mapping(self, mapping_id):
+        self._write("DELETE FROM test_mapping WHERE id = ?", (int(mapping_id),))
+
+    def get_unmapped_tests(self, excel_test_names):
+        mapped_names = {r['external_name'] for r in self._rows("SELECT external_name FROM test_mapping")}
+        return list(set(name for name in excel_test_names if name not in mapped_names))
+
+    # --- QUẢN LÝ EQA DATA ---
+    def add_eqa(self, data):
+        try:
+            cols = list(data.keys())
+            self._write(f"INSERT INTO eqa_results ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                        [data[c] for c in cols])
+            return True
+        except Exception as e:
+            print(f"Error adding EQA: {e}")
+            return False
+
+    def get_eqa_data(self, test_id):
+        return coerce_frame(self._query("SELECT * FROM eqa_results WHERE test_id = ? ORDER BY date ASC", (int(test_id),)), "eqa_results")
+
+    def delete_eqa(self, eqa_id):
+        try:
+            self._write("DELETE FROM eqa_results WHERE id = ?", (int(eqa_id),))
+            return True
+        except Exception as e:
+            print(f"Lỗi SQL: {e}")
+            return False
+
+    def update_eqa(self, eqa_id, data):
+        if not data: return False
+        try:
+            cols = list(data.keys())
+            self._write(f"UPDATE eqa_results SET {', '.join(f'{c} = ?' for c in cols)} WHERE id = ?",
+                        [data[c] for c in cols] + [int(eqa_id)])
+            return True
+        except Exception as e:
+            print(f"Lỗi cập nhật DB: {e}")
+            return False
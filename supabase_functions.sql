@@ -0,0 +1,242 @@
+-- File: supabase_functions.sql
+-- Các hàm SQL (và cột bổ sung) chạy phía Postgres cho backend Supabase.
+-- Cài đặt: mở Supabase Dashboard > SQL Editor, dán toàn bộ file này và bấm Run.
+-- Nếu chưa cài, app vẫn chạy (DBManager tự tính phía client) nhưng phải tải toàn bộ dữ liệu IQC.
+
+-- =====================================================================
+-- iqc_level_stats: thống kê tổng hợp IQC theo level (tùy chọn theo lot)
+-- Trả về n, sum, sumsq + bản đã loại ngoại lai 3SD (giống get_clean_stats_3sigma)
+-- p_from / p_before: lọc date >= p_from và date < p_before (chuỗi 'YYYY-MM-DD', NULL = không lọc)
+-- =====================================================================
+create or replace function iqc_level_stats(
+    p_test_id bigint,
+    p_from text default null,
+    p_before text default null,
+    p_by_lot boolean default false
+)
+returns table (
+    level integer,
+    lot_id bigint,
+    lot_number text,
+    n bigint,
+    sum double precision,
+    sumsq double precision,
+    min_value double precision,
+    max_value double precision,
+    n_clean bigint,
+    sum_clean double precision,
+    sumsq_clean double precision,
+    first_date text,
+    last_date text
+)
+language sql stable
+as $$
+    with r as (
+        select r.level::integer as level,
+               case when p_by_lot then r.lot_id::bigint end as lot_id,
+               case when p_by_lot then l.lot_number::text end as lot_number,
+               r.value::double precision as v,
+               r.date::text as d
+        from iqc_results r
+        join lots l on l.id = r.lot_id
+        where l.test_id = p_test_id
+          and r.value is not null
+          and r.date is not null
+          and (p_from is null or r.date::text >= p_from)
+          and (p_before is null or r.date::text < p_before)
+    ),
+    w as (
+        select r.*,
+               avg(v) over g as m,
+               stddev_samp(v) over g as sd
+        from r
+        window g as (partition by level, lot_id)
+    )
+    select level,
+           lot_id,
+           max(lot_number),
+           count(*),
+           sum(v),
+           sum(v * v),
+           min(v),
+           max(v),
+           count(*) filter (where v >= m - 3 * sd and v <= m + 3 * sd),
+           coalesce(sum(v) filter (where v >= m - 3 * sd and v <= m + 3 * sd), 0),
+           coalesce(sum(v * v) filter (where v >= m - 3 * sd and v <= m + 3 * sd), 0),
+           min(d),
+           max(d)
+    from w
+    group by level, lot_id
+    order by level, lot_id;
+$$;
+
+-- =====================================================================
+-- Xóa dây chuyền trong 1 transaction (1 lời gọi RPC = 1 transaction)
+-- Trả về JSON số dòng đã xóa theo từng bảng; lỗi ở bất kỳ bước nào sẽ rollback toàn bộ.
+-- Bảng cũ iqc_data / eqa_data (nếu còn) cũng được dọn theo.
+-- =====================================================================
+create or replace function delete_lots_cascade(
+    p_test_id bigint default null,
+    p_lot_id bigint default null
+)
+returns json
+language plpgsql
+as $$
+declare
+    v_lot_ids bigint[];
+    c_iqc bigint := 0;
+    c_lots bigint := 0;
+begin
+    if p_test_id is null and p_lot_id is null then
+        raise exception 'delete_lots_cascade: cần p_test_id hoặc p_lot_id';
+    end if;
+
+    select coalesce(array_agg(id), '{}') into v_lot_ids
+    from lots
+    where (p_lot_id is null or id = p_lot_id)
+      and (p_test_id is null or test_id = p_test_id);
+
+    delete from iqc_results where lot_id = any(v_lot_ids);
+    get diagnostics c_iqc = row_count;
+
+    if to_regclass('public.iqc_data') is not null then
+        execute 'delete from iqc_data where lot_id = any($1)' using v_lot_ids;
+    end if;
+
+    delete from lots where id = any(v_lot_ids);
+    get diagnostics c_lots = row_count;
+
+    return json_build_object('lots', c_lots, 'iqc_results', c_iqc);
+end;
+$$;
+
+create or replace function delete_test_cascade(p_test_id bigint)
+returns json
+language plpgsql
+as $$
+declare
+    v_lots json;
+    c_eqa bigint := 0;
+    c_map bigint := 0;
+    c_tests bigint := 0;
+begin
+    v_lots := delete_lots_cascade(p_test_id => p_test_id);
+
+    delete from eqa_results where test_id = p_test_id;
+    get diagnostics c_eqa = row_count;
+
+    if to_regclass('public.eqa_data') is not null then
+        execute 'delete from eqa_data where test_id = $1' using p_test_id;
+    end if;
+
+    delete from test_mapping where test_id = p_test_id;
+    get diagnostics c_map = row_count;
+
+    delete from tests where id = p_test_id;
+    get diagnostics c_tests = row_count;
+
+    return json_build_object(
+        'tests', c_tests,
+        'lots', (v_lots->>'lots')::bigint,
+        'iqc_results', (v_lots->>'iqc_results')::bigint,
+        'eqa_results', c_eqa,
+        'test_mapping', c_map
+    );
+end;
+$$;
+
+-- =====================================================================
+-- iqc_results.violation: kết quả Westgard của từng điểm, app chấm và ghi ngay khi nhập/import
+-- (vd '1-3s, 4-1s' hoặc 'ĐẠT'). NULL = chưa chấm, app tự chấm lại khi đọc.
+-- =====================================================================
+alter table iqc_results add column if not exists violation text;
+create index if not exists idx_iqc_lot_level_date on iqc_results (lot_id, level, date desc, id desc);
+
+-- =====================================================================
+-- qc_status: trạng thái QC mới nhất của mỗi test / mức cho màn hình tổng quan toàn phòng.
+-- Ghi bởi qc_status.py (quét định kỳ hoặc nút "Quét lại" ở tab Quản trị); màn hình chỉ đọc bảng này.
+-- =====================================================================
+create table if not exists qc_status (
+    test_id bigint not null references tests (id) on delete cascade,
+    level integer not null,
+    test_name text,
+    device text,
+    lot_id bigint,
+    lot_number text,
+    last_run text,
+    last_value double precision,
+    last_verdict text,
+    status text,
+    open_rejections integer default 0,
+    updated_at text,
+    primary key (test_id, level)
+);
+
+-- =====================================================================
+-- lots.data_version: tăng mỗi khi iqc_results của lot bị thêm/sửa/xóa (mọi nguồn ghi).
+-- App dùng làm khóa bộ nhớ đệm kết quả Westgard theo lot. Trigger theo câu lệnh (statement-level)
+-- nên import 500 dòng chỉ cập nhật mỗi lot 1 lần; chỉ ghi cột violation thì không tăng.
+-- =====================================================================
+alter table lots add column if not exists data_version bigint not null default 0;
+
+create or replace function bump_lot_data_version()
+returns trigger
+language plpgsql
+as $$
+begin
+    if tg_op = 'INSERT' then
+        update lots set data_version = data_version + 1
+        where id in (select distinct lot_id from new_rows);
+    elsif tg_op = 'DELETE' then
+        update lots set data_version = data_version + 1
+        where id in (select distinct lot_id from old_rows);
+    else
+        update lots set data_version = data_version + 1
+        where id in (
+            select unnest(array[o.lot_id, n.lot_id])
+            from new_rows n join old_rows o on o.id = n.id
+            where (n.lot_id, n.date, n.level, n.value, n.note, n.action)
+                  is distinct from (o.lot_id, o.date, o.level, o.value, o.note, o.action)
+        );
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists trg_iqc_version_insert on iqc_results;
+create trigger trg_iqc_version_insert after insert on iqc_results
+    referencing new table as new_rows
+    for each statement execute function bump_lot_data_version();
+
+drop trigger if exists trg_iqc_version_delete on iqc_results;
+create trigger trg_iqc_version_delete after delete on iqc_results
+    referencing old table as old_rows
+    for each statement execute function bump_lot_data_version();
+
+drop trigger if exists trg_iqc_version_update on iqc_results;
+create trigger trg_iqc_version_update after update on iqc_results
+    referencing old table as old_rows new table as new_rows
+    for each statement execute function bump_lot_data_version();
+
+-- =====================================================================
+-- Báo trôi EWMA / CUSUM trên z-score IQC (drift.py), chạy song song với Westgard.
+-- iqc_results.drift: nhãn báo của từng điểm ('' = không báo, NULL = chưa chấm).
+-- drift_state: trạng thái EWMA/CUSUM sau điểm cuối của mỗi lot / mức, để chấm điểm mới O(1);
+-- last_date/last_value/mean/sd/params dùng để kiểm tra trạng thái còn khớp dữ liệu trước khi dùng.
+-- =====================================================================
+alter table iqc_results add column if not exists drift text;
+
+create table if not exists drift_state (
+    lot_id bigint not null references lots (id) on delete cascade,
+    level integer not null,
+    n integer,
+    ewma double precision,
+    cusum_hi double precision,
+    cusum_lo double precision,
+    last_date text,
+    last_value double precision,
+    mean double precision,
+    sd double precision,
+    params text,
+    primary key (lot_id, level)
+);
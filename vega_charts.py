@@ -0,0 +1,266 @@
+# File: vega_charts.py
+"""
+Biểu đồ tương tác vẽ trên trình duyệt (Vega-Lite, hiển thị bằng st.vega_lite_chart) cho Levey-Jennings,
+CUSUM/V-Mask và Method Decision Chart: máy chủ chỉ gửi spec JSON gọn, phóng to / xem giá trị / bật tắt mức
+do trình duyệt xử lý. Chọn bằng cài đặt CHART_BACKEND_SETTING; ảnh matplotlib (charts.py) vẫn dùng cho báo cáo.
+Mỗi spec bị giới hạn VEGA_MAX_BYTES: LJ được giảm điểm (decimate_lj) đến khi vừa, không vừa thì trả về None
+để giao diện quay lại ảnh matplotlib. Spec được lưu trong render_cache như ảnh.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+from charts import (LJ_COLUMNS, LJ_LEVEL_COLORS, decimate_lj, lj_frame, lj_z_scores, lot_changes,
+                    show_multi_level_warnings)
+from render_cache import cached_bytes
+from westgard import check_westgard_multi_level
+
+CHART_BACKEND_SETTING = "chart_backend"
+CHART_BACKENDS = {
+    "matplotlib": "Ảnh tĩnh (matplotlib, vẽ trên máy chủ)",
+    "vega": "Tương tác (Vega-Lite, vẽ trên trình duyệt)",
+}
+DEFAULT_CHART_BACKEND = "matplotlib"
+# Dung lượng tối đa của 1 spec gửi xuống trình duyệt
+VEGA_MAX_BYTES = 512 * 2 ** 10
+# Chiều rộng (pixel) dùng để giảm điểm LJ lần đầu; mỗi lần spec quá lớn thì giảm một nửa
+VEGA_WIDTH_PX = 1200
+VEGA_MIN_WIDTH_PX = 150
+
+SD_LINES = {1: 'gold', 2: 'red', 3: 'black'}
+SIGMA_LINES = [(6, 'green'), (5, 'blue'), (4, 'purple'), (3, 'orange'), (2, 'red')]
+QC_COLORS = ['#0000ff', '#ff7f0e', '#ff0000']
+
+
+def chart_backend(db):
+    """Kiểu biểu đồ đang chọn trong settings ('matplotlib' hoặc 'vega')."""
+    value = db.get_setting(CHART_BACKEND_SETTING, DEFAULT_CHART_BACKEND)
+    return value if value in CHART_BACKENDS else DEFAULT_CHART_BACKEND
+
+
+def _payload(spec, max_bytes=VEGA_MAX_BYTES):
+    """Spec -> JSON bytes gọn; None nếu vượt max_bytes."""
+    data = json.dumps(spec, separators=(',', ':'), ensure_ascii=False, allow_nan=False).encode('utf-8')
+    return data if len(data) <= max_bytes else None
+
+
+def _number(x, digits=3):
+    return None if x is None or not np.isfinite(x) else round(float(x), digits)
+
+
+def _numbers(series, digits=3):
+    return [_number(x, digits) for x in pd.to_numeric(series, errors='coerce').to_numpy(dtype=float)]
+
+
+def _lj_columns(df):
+    """
+    Dữ liệu LJ dạng cột, gửi 1 bản ghi chứa các mảng và trình duyệt tách thành từng dòng (transform flatten):
+    m số phút tính từ điểm đầu, l mức, z, v giá trị, k mã lot, e EWMA, d nhãn báo trôi (null nếu thiếu).
+    Trả về (dict cột, các transform dựng lại t ngày và lot từ m, k).
+    """
+    start = df['date'].min()
+    cols = {
+        'm': ((df['date'] - start) // pd.Timedelta(minutes=1)).astype(int).tolist(),
+        'l': df['level'].astype(int).tolist(),
+        'z': [_number(x) for x in lj_z_scores(df)],
+        'v': _numbers(df['value'], 4),
+    }
+    # Ngày không có múi giờ: trình duyệt đọc theo giờ địa phương như matplotlib
+    calculate = [{'calculate': f"time(toDate('{start:%Y-%m-%dT%H:%M}')) + datum.m * 60000", 'as': 't'}]
+    if 'lot_number' in df.columns:
+        codes, lots = pd.factorize(df['lot_number'].astype(object))
+        cols['k'] = codes.tolist()
+        lots = json.dumps([str(v) for v in lots], ensure_ascii=False)
+        calculate.append({'calculate': f"datum.k < 0 ? null : {lots}[datum.k]", 'as': 'lot'})
+    if 'ewma' in df.columns:
+        cols['e'] = _numbers(df['ewma'])
+    if 'drift' in df.columns:
+        cols['d'] = [v or None for v in df['drift'].fillna('').astype(str).to_numpy()]
+    return cols, [{'flatten': list(cols)}] + calculate
+
+
+def _lot_changes(df):
+    """[{t, lot}] các ngày đổi lot trong từng mức (trừ ngày đầu tiên), như đường đổi lot của matplotlib."""
+    if 'lot_number' not in df.columns:
+        return []
+    first = df[lot_changes(df) & (df['date'] != df['date'].min()).to_numpy()]
+    first = first.drop_duplicates(subset=['date', 'lot_number'])
+    return [{'t': t.strftime('%Y-%m-%dT%H:%M'), 'lot': str(lot)} for t, lot in zip(first['date'], first['lot_number'])]
+
+
+def levey_jennings_spec(df, title):
+    """Spec Vega-Lite của biểu đồ LJ (df đã qua lj_frame, có thể đã giảm điểm)."""
+    x = {'field': 't', 'type': 'temporal', 'title': 'Thời gian thực hiện', 'axis': {'format': '%d/%m'}}
+    y = {'field': 'z', 'type': 'quantitative', 'title': 'Z-Score (Độ lệch chuẩn)',
+         'scale': {'domain': [-4.5, 4.5], 'nice': False}}
+    level = {'field': 'l', 'type': 'nominal', 'title': 'Mức',
+             'scale': {'domain': list(LJ_LEVEL_COLORS), 'range': list(LJ_LEVEL_COLORS.values())}}
+    shown = {'param': 'levels', 'empty': True}
+    sd_rules = [{'y': s * sign, 'c': color} for s, color in SD_LINES.items() for sign in (1, -1)]
+    layers = [
+        {'mark': {'type': 'line', 'strokeWidth': 1.5, 'clip': True},
+         'encoding': {'x': x, 'y': y, 'color': level,
+                      'opacity': {'condition': dict(shown, value=0.4), 'value': 0.05}}},
+        {'params': [{'name': 'levels', 'select': {'type': 'point', 'fields': ['l']}, 'bind': 'legend'},
+                    {'name': 'zoom', 'select': {'type': 'interval', 'encodings': ['x']}, 'bind': 'scales'}],
+         'mark': {'type': 'circle', 'size': 40, 'stroke': 'white', 'clip': True},
+         'encoding': {'x': x, 'y': y, 'color': level,
+                      'opacity': {'condition': dict(shown, value=1), 'value': 0.1},
+                      'tooltip': [{'field': 't', 'type': 'temporal', 'title': 'Ngày', 'format': '%d/%m/%Y %H:%M'},
+                                  {'field': 'l', 'title': 'Mức'}, {'field': 'v', 'title': 'Giá trị'},
+                                  {'field': 'z', 'title': 'Z'}, {'field': 'lot', 'title': 'Lot'},
+                                  {'field': 'd', 'title': 'Báo trôi'}]}},
+    ]
+    if 'ewma' in df.columns and df['ewma'].notna().any():
+        layers.append({'transform': [{'filter': 'isValid(datum.e)'}],
+                       'mark': {'type': 'line', 'strokeDash': [6, 3], 'strokeWidth': 1.2, 'clip': True},
+                       'encoding': {'x': x, 'y': dict(y, field='e'), 'color': level,
+                                    'opacity': {'condition': dict(shown, value=0.8), 'value': 0.05}}})
+    if 'drift' in df.columns and (df['drift'].fillna('') != '').any():
+        layers.append({'transform': [{'filter': 'isValid(datum.d)'}],
+                       'mark': {'type': 'point', 'shape': 'diamond', 'size': 110, 'color': 'purple',
+                                'strokeWidth': 1.5, 'clip': True},
+                       'encoding': {'x': x, 'y': y}})
+    columns, transform = _lj_columns(df)
+    layers = [
+        {'data': {'values': sd_rules},
+         'mark': {'type': 'rule', 'strokeDash': [4, 3], 'opacity': 0.6},
+         'encoding': {'y': {'field': 'y', 'type': 'quantitative'},
+                      'color': {'field': 'c', 'type': 'nominal', 'scale': None}}},
+        {'data': {'values': [{'y': 0}]},
+         'mark': {'type': 'rule', 'color': 'green', 'strokeWidth': 2},
+         'encoding': {'y': {'field': 'y', 'type': 'quantitative'}}},
+        {'data': {'values': [columns]}, 'transform': transform, 'layer': layers},
+    ]
+    changes = _lot_changes(df)
+    if changes:
+        layers.append({'data': {'values': changes}, 'layer': [
+            {'mark': {'type': 'rule', 'color': 'gray', 'strokeDash': [2, 2], 'opacity': 0.4},
+             'encoding': {'x': x}},
+            {'mark': {'type': 'text', 'angle': 270, 'align': 'right', 'dx': -4, 'fontSize': 9, 'color': 'gray'},
+             'encoding': {'x': x, 'y': {'datum': 3.8, 'type': 'quantitative'},
+                          'text': {'field': 'lot', 'type': 'nominal'}}},
+        ]})
+    return {'title': title, 'height': 420, 'layer': layers}
+
+
+def _build_levey_jennings(df, title, rules, max_bytes):
+    """(JSON bytes hoặc b'' nếu không vừa max_bytes, cảnh báo 6x/9x/12x tính trên toàn bộ dữ liệu)."""
+    frame = lj_frame(df)
+    if frame.empty:
+        return b'', []
+    violations = check_westgard_multi_level(frame)
+    # Như bản matplotlib: chỉ vẽ mức 1-3
+    frame = frame[frame['level'].isin(list(LJ_LEVEL_COLORS))]
+    width = VEGA_WIDTH_PX
+    while width >= VEGA_MIN_WIDTH_PX:
+        payload = _payload(levey_jennings_spec(decimate_lj(frame, width, rules), title), max_bytes)
+        if payload is not None:
+            return payload, violations
+        width //= 2
+    return b'', violations
+
+
+def render_levey_jennings_vega(df, title, rules=None, max_bytes=VEGA_MAX_BYTES):
+    """
+    Spec Vega-Lite (dict) của biểu đồ LJ, qua render_cache; cảnh báo 6x/9x/12x hiển thị như bản matplotlib.
+    None nếu df rỗng hoặc không giảm điểm được xuống dưới max_bytes (khi đó dùng charts.render_levey_jennings).
+    """
+    if df.empty:
+        return None
+    used = df[[c for c in LJ_COLUMNS if c in df.columns]]
+    rules_key = rules if rules is None or isinstance(rules, str) else tuple(rules)
+    payload, violations = cached_bytes("levey_jennings_vega", (used, title, rules_key, max_bytes),
+                                       lambda: _build_levey_jennings(used, title, rules, max_bytes))
+    if not payload:
+        return None
+    show_multi_level_warnings(violations or [])
+    return json.loads(payload)
+
+
+def cusum_vmask_spec(cusum_values, dates, x_mask, y_upper, y_lower, vertex, outside, max_bytes=VEGA_MAX_BYTES):
+    """
+    Spec Vega-Lite của biểu đồ CUSUM EQA với V-Mask (cùng số liệu bản matplotlib ở tab EQA);
+    vertex = (x, y) của đỉnh mặt nạ, outside = mảng bool các điểm nằm ngoài V-Mask. None nếu vượt max_bytes.
+    """
+    indices = np.arange(len(cusum_values))
+    last_x, last_y = int(indices[-1]), float(cusum_values[-1])
+    rows = [{'i': int(i), 'c': _number(c, 4), 't': d.strftime('%d/%m/%Y'), 'o': bool(o)}
+            for i, c, d, o in zip(indices, cusum_values, dates, outside)]
+    x = {'field': 'i', 'type': 'quantitative', 'title': 'Số thứ tự mẫu EQA'}
+    y = {'field': 'c', 'type': 'quantitative', 'title': 'CUSUM (SDI tích lũy)'}
+    # Hai nhánh V-Mask là đường thẳng: chỉ cần 2 đầu mút
+    keep = np.asarray(x_mask) >= 0
+    ends = [0, int(keep.sum()) - 1]
+    mask_x, upper, lower = np.asarray(x_mask)[keep], np.asarray(y_upper)[keep], np.asarray(y_lower)[keep]
+    mask_rows = [{'i': _number(mask_x[j], 4), 'c': _number(branch[j], 4), 'b': name}
+                 for name, branch in (('Trên', upper), ('Dưới', lower)) for j in ends]
+    spec = {
+        'title': f"Biểu đồ CUSUM (Mẫu cuối: {last_y:.2f})", 'height': 360,
+        'data': {'values': rows},
+        'layer': [
+            {'data': {'values': [{'c': 0}]}, 'mark': {'type': 'rule', 'color': 'black', 'strokeWidth': 0.5},
+             'encoding': {'y': {'field': 'c', 'type': 'quantitative'}}},
+            {'params': [{'name': 'zoom', 'select': 'interval', 'bind': 'scales'}],
+             'mark': {'type': 'line', 'point': True, 'color': 'blue'},
+             'encoding': {'x': x, 'y': y,
+                          'tooltip': [{'field': 't', 'title': 'Ngày'}, {'field': 'i', 'title': 'Mẫu'},
+                                      {'field': 'c', 'title': 'CUSUM'}]}},
+            {'transform': [{'filter': 'datum.o'}], 'mark': {'type': 'circle', 'size': 100, 'color': 'orange'},
+             'encoding': {'x': x, 'y': y}},
+            {'data': {'values': mask_rows},
+             'mark': {'type': 'line', 'color': 'red', 'strokeDash': [5, 4], 'opacity': 0.7},
+             'encoding': {'x': x, 'y': y, 'detail': {'field': 'b'}}},
+            {'data': {'values': [{'i': last_x, 'c': last_y}, {'i': _number(vertex[0], 4), 'c': _number(vertex[1], 4)}]},
+             'mark': {'type': 'line', 'color': 'gray', 'strokeDash': [2, 2], 'opacity': 0.5},
+             'encoding': {'x': x, 'y': y}},
+            {'data': {'values': [{'i': _number(vertex[0], 4), 'c': _number(vertex[1], 4)}]},
+             'mark': {'type': 'point', 'shape': 'cross', 'size': 120, 'color': 'black', 'filled': True},
+             'encoding': {'x': x, 'y': y, 'tooltip': {'value': 'Vertex (d=10)'}}},
+        ],
+    }
+    payload = _payload(spec, max_bytes)
+    return None if payload is None else json.loads(payload)
+
+
+def sigma_chart_spec(sigma_plot_data, tea, max_bytes=VEGA_MAX_BYTES):
+    """Spec Vega-Lite của Method Decision Chart (cùng trục và các đường 2σ..6σ như plot_sigma_chart)."""
+    max_cv, max_bias = tea / 2, tea
+    lines, labels = [], []
+    for s, color in SIGMA_LINES:
+        # bias = TEa - s * CV, cắt tại bias = 0 hoặc mép phải của trục
+        end_cv = min(max_cv, tea / s)
+        lines += [{'cv': 0, 'bias': tea, 's': f"{s}σ", 'c': color},
+                  {'cv': _number(end_cv, 4), 'bias': _number(max(tea - s * end_cv, 0), 4), 's': f"{s}σ", 'c': color}]
+        labels.append({'cv': _number(max_cv * 0.2, 4), 'bias': _number(tea - s * max_cv * 0.2, 4),
+                       's': f"{s}σ", 'c': color})
+    points = [{'cv': _number(pt['cv'], 3), 'bias': _number(pt['bias'], 3),
+               'label': pt.get('label', f"L{i + 1}"), 'c': QC_COLORS[i] if i < len(QC_COLORS) else '#7f7f7f'}
+              for i, pt in enumerate(sigma_plot_data)]
+    x = {'field': 'cv', 'type': 'quantitative', 'title': 'Precision (CV %)', 'scale': {'domain': [0, max_cv]}}
+    y = {'field': 'bias', 'type': 'quantitative', 'title': 'Inaccuracy (Bias %)', 'scale': {'domain': [0, max_bias]}}
+    color = {'field': 'c', 'type': 'nominal', 'scale': None}
+    spec = {
+        'title': f"Method Decision Chart (TEa = {tea}%)", 'height': 380,
+        'layer': [
+            {'data': {'values': lines}, 'mark': {'type': 'line', 'strokeDash': [5, 4], 'opacity': 0.7, 'clip': True},
+             'encoding': {'x': x, 'y': y, 'color': color, 'detail': {'field': 's'}}},
+            {'data': {'values': [r for r in labels if r['bias'] > 0]},
+             'mark': {'type': 'text', 'fontWeight': 'bold', 'dy': -6, 'align': 'left'},
+             'encoding': {'x': x, 'y': y, 'color': color, 'text': {'field': 's'}}},
+            {'data': {'values': points},
+             'mark': {'type': 'rule', 'strokeDash': [2, 2], 'opacity': 0.4},
+             'encoding': {'x': x, 'y': y, 'y2': {'datum': 0}, 'color': color}},
+            {'data': {'values': points},
+             'params': [{'name': 'zoom', 'select': 'interval', 'bind': 'scales'}],
+             'mark': {'type': 'circle', 'size': 90, 'stroke': 'white', 'opacity': 1},
+             'encoding': {'x': x, 'y': y, 'color': color,
+                          'tooltip': [{'field': 'label', 'title': 'Mức'}, {'field': 'cv', 'title': 'CV %'},
+                                      {'field': 'bias', 'title': 'Bias %'}]}},
+            {'data': {'values': points}, 'mark': {'type': 'text', 'align': 'left', 'dx': 8, 'fontSize': 10},
+             'encoding': {'x': x, 'y': y, 'color': color, 'text': {'field': 'label'}}},
+        ],
+    }
+    payload = _payload(spec, max_bytes)
+    return None if payload is None else json.loads(payload)
@@ -0,0 +1,74 @@
+# File: verification.py
+# Xác nhận giá trị sử dụng theo CLSI EP15-A3 (độ chụm, độ đúng) và xử lý ngoại lệ Grubbs.
+import numpy as np
+
+
+def handle_outliers_grubbs(matrix):
+    """
+    Tự động phát hiện và xử lý giá trị ngoại lệ theo chuẩn EP15-A3.
+    Hệ số G tới hạn cho n=25 là 3.135.
+    """
+    flat_data = [item for sublist in matrix for item in sublist]
+    n = len(flat_data)
+    mean = np.mean(flat_data)
+    sd = np.std(flat_data, ddof=1)
+    
+    g_critical = 3.135 # Giá trị tới hạn cho n=25, alpha=0.05
+    
+    outliers = []
+    cleaned_matrix = []
+    
+    # Duyệt từng điểm dữ liệu
+    for i, day in enumerate(matrix):
+        new_day = []
+        for val in day:
+            g_score = abs(val - mean) / sd
+            if g_score > g_critical:
+                outliers.append({"day": i+1, "value": val, "g_score": g_score})
+                # Thay thế giá trị ngoại lệ bằng trung bình của ngày đó (để không làm hỏng ANOVA)
+                # Hoặc có thể dùng np.nan nếu hàm ANOVA của bạn xử lý được
+                new_day.append(np.mean(day)) 
+            else:
+                new_day.append(val)
+        cleaned_matrix.append(new_day)
+        
+    return cleaned_matrix, outliers
+
+
+def calculate_clsi_ep15_a3_final(matrix, claim_sr, claim_sl, target_mean):
+    # 1. Xử lý ngoại lệ trước khi tính toán
+    cleaned_matrix, found_outliers = handle_outliers_grubbs(matrix)
+    
+    n_run = 5
+    n_rep = 5
+    
+    # 2. ANOVA trên dữ liệu đã làm sạch
+    flat_data = [item for sublist in cleaned_matrix for item in sublist]
+    grand_mean = np.mean(flat_data)
+    
+    day_means = [np.mean(day) for day in cleaned_matrix]
+    day_vars = [np.var(day, ddof=1) for day in cleaned_matrix]
+    
+    ms_within = np.mean(day_vars) 
+    ms_between = np.var(day_means, ddof=1) * n_rep
+    
+    s_r = np.sqrt(ms_within)
+    v_b = max(0, (ms_between - ms_within) / n_rep)
+    s_l = np.sqrt(v_b + ms_within)
+    
+    # 3. Tính UVL và VI (giữ nguyên logic trước)
+    uvl_l = claim_sl * 1.32 
+    se_x_bar = np.sqrt((1/n_run) * (s_l**2 - (1 - 1/n_rep) * s_r**2))
+    t_val = 2.776 
+    vi_half = t_val * se_x_bar
+    vi_range = (target_mean - vi_half, target_mean + vi_half)
+    
+    return {
+        "grand_mean": grand_mean,
+        "s_r": s_r, "s_l": s_l,
+        "uvl_l": uvl_l,
+        "vi_range": vi_range,
+        "is_precision_pass": s_l <= uvl_l,
+        "is_trueness_pass": vi_range[0] <= grand_mean <= vi_range[1],
+        "outliers": found_outliers # Trả về danh sách ngoại lệ để hiển thị
+    }
@@ -0,0 +1,541 @@
+# File: westgard.py
+import hashlib
+import threading
+from collections import OrderedDict, deque, namedtuple
+from functools import lru_cache
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+# --- BỘ MÁY KIỂM TRA WESTGARD KHAI BÁO (NUMPY) ---
+# Mỗi quy tắc được mô tả bằng 1 RuleSpec; bộ quy tắc được biên dịch 1 lần rồi chạy 1 lượt
+# trên ma trận z-score (lượt chạy x mức) và chuỗi thời gian của từng mức.
+#   name:       nhãn lưu/hiển thị; với kind='trend' nhãn là '<name> (+)' / '<name> (-)'
+#   kind:       'beyond' (ít nhất k trong n điểm cùng phía vượt ±limit), 'range' (trong cùng lượt chạy
+#               1 mức >= +limit và mức khác <= -limit), 'trend' (n điểm tăng/giảm liên tục)
+#   scope:      'within' (chuỗi thời gian từng mức), 'across' (các mức trong `runs` lượt chạy liên tiếp),
+#               'series' (mọi mức gộp chung theo thời gian)
+#   limit:      ngưỡng SD, so sánh chặt (>) trừ khi inclusive=True; upper: cận trên (chặt, <= nếu upper_inclusive)
+#   levels:     các mức xét cho 'across' (phải có mặt); None = các mức 1-3 có mặt, cần >= min_levels mức
+#   all_rows:   'across' tính mọi dòng của các lượt chạy thay vì dòng đầu tiên của mỗi mức
+#   min_points: số điểm tối thiểu trong cửa sổ 'across'
+#   severity:   'reject' (quy tắc dừng) hoặc 'warning'
+#   only_if_clean: (within) chỉ gắn khi điểm chưa có vi phạm nào khác, vd 1-2s
+RuleSpec = namedtuple("RuleSpec", [
+    "name", "kind", "scope", "n", "k", "limit", "upper", "upper_inclusive", "inclusive",
+    "levels", "min_levels", "runs", "all_rows", "min_points", "severity", "only_if_clean",
+], defaults=["beyond", "within", 1, None, 2.0, None, False, False, None, 2, 1, False, 0, "reject", False])
+
+RULE_SETS = {
+    # Bộ mặc định: giữ đúng kết quả của get_westgard_violations trước đây
+    "westgard": (
+        RuleSpec("R-4s", kind="range", scope="across", limit=2, inclusive=True),
+        RuleSpec("2-2s", scope="across", limit=2),
+        RuleSpec("2-2s", scope="across", levels=(1, 2), limit=2, upper=3),
+        RuleSpec("4-1s", scope="across", levels=(1, 2), runs=2, limit=1),
+        RuleSpec("10x", scope="across", levels=(1, 2), runs=5, all_rows=True, min_points=10, limit=0),
+        RuleSpec("1-3s", limit=3),
+        RuleSpec("2-2s", n=2, limit=2, upper=3),
+        RuleSpec("4-1s", n=4, limit=1),
+        RuleSpec("Shift", n=6, limit=1),
+        RuleSpec("Trend", kind="trend", n=6),
+        RuleSpec("10x", n=10, limit=0),
+        RuleSpec("1-2s", limit=2, upper=3, upper_inclusive=True, severity="warning", only_if_clean=True),
+    ),
+    # Bộ tối thiểu cho xét nghiệm có Sigma cao
+    "westgard_basic": (
+        RuleSpec("R-4s", kind="range", scope="across", limit=2, inclusive=True),
+        RuleSpec("1-3s", limit=3),
+        RuleSpec("2-2s", n=2, limit=2),
+        RuleSpec("1-2s", limit=2, upper=3, upper_inclusive=True, severity="warning", only_if_clean=True),
+    ),
+}
+RULE_SETS["westgard_extended"] = RULE_SETS["westgard"][:-1] + (
+    RuleSpec("2of3-2s", n=3, k=2, limit=2),
+    RuleSpec("3-1s", n=3, limit=1),
+    RuleSpec("7T", kind="trend", n=7),
+    RuleSpec("8x", n=8, limit=0),
+    RuleSpec("12x", n=12, limit=0),
+    RULE_SETS["westgard"][-1],
+)
+DEFAULT_RULE_SET = "westgard"
+RULE_SET_LABELS = {
+    "westgard": "Westgard đa quy tắc (mặc định)",
+    "westgard_basic": "Cơ bản: 1-3s / 2-2s / R-4s",
+    "westgard_extended": "Mở rộng: thêm 2of3-2s, 3-1s, 7T, 8x, 12x",
+}
+
+# Quy tắc nx trên biểu đồ Levey-Jennings: n kết quả liên tiếp (gộp cả 3 mức) cùng phía Mean
+MULTI_LEVEL_RULES = (
+    RuleSpec("6x", scope="series", n=6, limit=0),
+    RuleSpec("9x", scope="series", n=9, limit=0),
+    RuleSpec("12x", scope="series", n=12, limit=0),
+)
+
+# Mỗi nhãn là 1 bit; mỗi dòng IQC có 1 số nguyên (bitmask) gom các vi phạm của nó.
+RULE_BITS = {name: 1 << i for i, name in enumerate([
+    "1-2s", "1-3s", "2-2s", "R-4s", "4-1s", "10x", "Shift", "Trend (+)", "Trend (-)",
+    "2of3-2s", "3-1s", "7T (+)", "7T (-)", "8x", "12x", "6x", "9x",
+])}
+PASS_LABEL = "ĐẠT"
+
+
+def decode_violations(mask):
+    """Đổi bitmask thành chuỗi vi phạm, tên quy tắc sắp xếp theo alphabet và nối bằng ', '. 0 -> ''."""
+    return ", ".join(sorted(name for name, bit in RULE_BITS.items() if int(mask) & bit))
+
+
+def verdict_label(mask):
+    """Chuỗi kết quả lưu/hiển thị cho 1 điểm: danh sách vi phạm hoặc 'ĐẠT'."""
+    return decode_violations(mask) or PASS_LABEL
+
+
+def verdict_severity(label, rules=None):
+    """'reject' nếu kết quả có quy tắc dừng, 'warning' nếu chỉ có cảnh báo, 'pass' nếu ĐẠT/chưa chấm."""
+    if not isinstance(label, str):
+        return "pass"
+    names = [name for name in label.split(", ") if name and name != PASS_LABEL]
+    if not names:
+        return "pass"
+    severity = resolve_rules(rules).severity
+    # Nhãn không thuộc bộ quy tắc hiện tại (lưu từ bộ cũ) coi như quy tắc dừng
+    return "reject" if any(severity.get(name, "reject") == "reject" for name in names) else "warning"
+
+
+def rule_labels(spec):
+    return (f"{spec.name} (+)", f"{spec.name} (-)") if spec.kind == "trend" else (spec.name,)
+
+
+class CompiledRules:
+    """Bộ quy tắc đã tách theo phạm vi để mỗi phạm vi chỉ duyệt dữ liệu 1 lần."""
+
+    def __init__(self, specs):
+        for spec in specs:
+            missing = [label for label in rule_labels(spec) if label not in RULE_BITS]
+            if missing:
+                raise ValueError(f"Chưa khai báo bit cho quy tắc: {missing}")
+        self.specs = specs
+        self.across = [s for s in specs if s.scope == "across"]
+        self.series = [s for s in specs if s.scope == "series"]
+        self.within = [s for s in specs if s.scope == "within" and not s.only_if_clean]
+        self.clean = [s for s in specs if s.scope == "within" and s.only_if_clean]
+        # Số điểm gần nhất cần giữ để chấm 1 điểm mới của chuỗi within
+        self.window = max([s.n for s in self.within + self.clean] + [1])
+        self.severity = {label: s.severity for s in specs for label in rule_labels(s)}
+
+
+@lru_cache(maxsize=None)
+def compile_rules(specs):
+    return CompiledRules(specs)
+
+
+def resolve_rules(rules=None):
+    """None -> bộ mặc định; tên bộ trong RULE_SETS; hoặc danh sách RuleSpec tự khai báo."""
+    if rules is None:
+        rules = DEFAULT_RULE_SET
+    if isinstance(rules, str):
+        rules = RULE_SETS.get(rules, RULE_SETS[DEFAULT_RULE_SET])
+    return compile_rules(tuple(rules))
+
+
+def _run_length(cond):
+    """Độ dài chuỗi True liên tiếp kết thúc tại mỗi vị trí (0 nếu vị trí đó là False)."""
+    idx = np.arange(len(cond))
+    last_false = np.maximum.accumulate(np.where(cond, -1, idx))
+    return np.where(cond, idx - last_false, 0)
+
+
+def _window_sum(values, n):
+    """Tổng n phần tử gần nhất (kể cả phần tử hiện tại; đầu chuỗi thì lấy những phần tử đang có)."""
+    cs = np.concatenate([[0], np.cumsum(values)])
+    idx = np.arange(1, len(values) + 1)
+    return cs[idx] - cs[np.maximum(0, idx - n)]
+
+
+def _beyond(z, spec):
+    """(vượt phía trên, vượt phía dưới) theo limit/upper của spec."""
+    hi = z >= spec.limit if spec.inclusive else z > spec.limit
+    lo = z <= -spec.limit if spec.inclusive else z < -spec.limit
+    if spec.upper is not None:
+        hi = hi & (z <= spec.upper if spec.upper_inclusive else z < spec.upper)
+        lo = lo & (z >= -spec.upper if spec.upper_inclusive else z > -spec.upper)
+    return hi, lo
+
+
+def _series_mask(z, specs):
+    """Bitmask từng điểm của 1 chuỗi thời gian (within/series) cho các quy tắc beyond/trend."""
+    mask = np.zeros(len(z), dtype=np.int64)
+    for spec in specs:
+        if spec.kind == "trend":
+            up = np.zeros(len(z), dtype=bool)
+            down = np.zeros(len(z), dtype=bool)
+            up[1:], down[1:] = z[1:] > z[:-1], z[1:] < z[:-1]
+            label_up, label_down = rule_labels(spec)
+            hit_up = _run_length(up) >= spec.n - 1
+            mask[hit_up] |= RULE_BITS[label_up]
+            mask[~hit_up & (_run_length(down) >= spec.n - 1)] |= RULE_BITS[label_down]
+        else:
+            hi, lo = _beyond(z, spec)
+            k = spec.k or spec.n
+            mask[(_window_sum(hi, spec.n) >= k) | (_window_sum(lo, spec.n) >= k)] |= RULE_BITS[spec.name]
+    return mask
+
+
+def score_z_series(z, compiled):
+    """Bitmask các quy tắc within cho 1 chuỗi z-score của 1 mức; quy tắc only_if_clean xét sau cùng."""
+    mask = _series_mask(z, compiled.within)
+    for spec in compiled.clean:
+        mask |= np.where(mask == 0, _series_mask(z, [spec]), 0)
+    return mask
+
+
+def _values_as_float(values):
+    """
+    Trả về (mảng float, mảng lỗi). Lỗi = giá trị mà float(x) không chuyển được (None, chuỗi sai, pd.NA);
+    các dòng này có z = 0. NaN thật vẫn giữ là NaN.
+    """
+    if values.dtype == object:
+        out = np.empty(len(values))
+        failed = np.zeros(len(values), dtype=bool)
+        for i, x in enumerate(values.tolist()):
+            try:
+                out[i] = float(x)
+            except Exception:
+                out[i], failed[i] = 0.0, True
+        return out, failed
+    if pd.api.types.is_extension_array_dtype(values.dtype):
+        failed = values.isna().to_numpy()
+        return values.to_numpy(dtype=float, na_value=0.0), failed
+    return values.to_numpy(dtype=float), np.zeros(len(values), dtype=bool)
+
+
+def compute_z_scores(df, mean_map, sd_map):
+    """
+    z = (value - mean) / sd theo từng level, tính 1 lần cho cả mảng.
+    mean_map/sd_map: dict {level: giá trị} hoặc 1 giá trị dùng chung.
+    z = 0 khi sd <= 0, thiếu thông số hoặc giá trị không phải số.
+    """
+    values, failed = _values_as_float(df['value'])
+    z = np.zeros(len(df))
+    codes, uniques = pd.factorize(df['level'], use_na_sentinel=False)
+    for code, lvl in enumerate(uniques):
+        m = mean_map.get(lvl, 0) if isinstance(mean_map, dict) else mean_map
+        s = sd_map.get(lvl, 0) if isinstance(sd_map, dict) else sd_map
+        rows = codes == code
+        try:
+            if s > 0:
+                z[rows] = (values[rows] - m) / s
+        except Exception:
+            z[rows] = 0
+    z[failed] = 0
+    return z
+
+
+class RunMatrix:
+    """
+    Dữ liệu IQC xoay thành ma trận (lượt chạy x mức 1/2/3); 1 lượt chạy = các dòng cùng thời điểm.
+    Chỉ chứa cấu trúc (vị trí dòng), không chứa giá trị, nên dùng lại được cho mọi mean/sd và bộ quy tắc.
+      run_ids:  thời điểm của từng lượt chạy (tăng dần)
+      run:      chỉ số lượt chạy của từng dòng (theo thứ tự date, level)
+      run_size: số dòng của từng lượt chạy
+      pos:      (lượt x mức) vị trí dòng đầu tiên của mức trong lượt, -1 nếu lượt thiếu mức đó
+    """
+    LEVELS = (1, 2, 3)
+
+    def __init__(self, dates, levels):
+        n = len(dates)
+        new_run = np.ones(n, dtype=bool)
+        new_run[1:] = dates[1:] != dates[:-1]
+        self.run = np.cumsum(new_run) - 1
+        self.run_ids = dates[new_run]
+        self.n_runs = len(self.run_ids)
+        self.run_size = np.bincount(self.run, minlength=self.n_runs)
+        self.pos = np.full((self.n_runs, len(self.LEVELS)), -1)
+        for col, lvl in enumerate(self.LEVELS):
+            rows = np.flatnonzero(levels == lvl)
+            if len(rows):
+                r, keep = np.unique(self.run[rows], return_index=True)
+                self.pos[r, col] = rows[keep]
+        self.present = self.pos >= 0
+
+    def column(self, level):
+        return self.LEVELS.index(level)
+
+    def z_matrix(self, z):
+        """Ma trận z-score (lượt x mức), NaN ở ô thiếu mức."""
+        return np.where(self.present, z[np.maximum(self.pos, 0)], np.nan)
+
+
+# Ma trận lượt chạy dùng lại giữa các lần rerun khi dữ liệu (date, level) không đổi
+_RUN_MATRIX_CACHE = OrderedDict()
+_RUN_MATRIX_CACHE_LOCK = threading.Lock()
+RUN_MATRIX_CACHE_SIZE = 32
+
+
+def build_run_matrix(df_calc):
+    """RunMatrix cho df đã sắp xếp theo (date, level); dựng 1 lần cho mỗi bộ dữ liệu rồi lấy từ bộ nhớ đệm."""
+    dates = df_calc['date'].to_numpy()
+    levels = df_calc['level'].to_numpy()
+    digest = hashlib.blake2b(pd.util.hash_array(dates).tobytes(), digest_size=16)
+    digest.update(pd.util.hash_array(levels).tobytes())
+    key = (len(df_calc), digest.hexdigest())
+    with _RUN_MATRIX_CACHE_LOCK:
+        matrix = _RUN_MATRIX_CACHE.get(key)
+        if matrix is not None:
+            _RUN_MATRIX_CACHE.move_to_end(key)
+            return matrix
+    matrix = RunMatrix(dates, levels)
+    with _RUN_MATRIX_CACHE_LOCK:
+        _RUN_MATRIX_CACHE[key] = matrix
+        while len(_RUN_MATRIX_CACHE) > RUN_MATRIX_CACHE_SIZE:
+            _RUN_MATRIX_CACHE.popitem(last=False)
+    return matrix
+
+
+def _across_mask(runs, z, specs):
+    """Quy tắc across-level: phép toán theo cột/cửa sổ lượt chạy trên RunMatrix, tuyến tính theo số lượt."""
+    mask = np.zeros(len(z), dtype=np.int64)
+    n_runs = runs.n_runs
+    zm = runs.z_matrix(z)
+
+    def flag_runs(bit, hit, cols):
+        for col in cols:
+            mask[runs.pos[hit & runs.present[:, col], col]] |= bit
+
+    for spec in specs:
+        bit = RULE_BITS[spec.name]
+        cols = [runs.column(lvl) for lvl in (spec.levels or runs.LEVELS)]
+        if spec.kind == "range":
+            for a, b in combinations(cols, 2):
+                (a_hi, a_lo), (b_hi, b_lo) = _beyond(zm[:, a], spec), _beyond(zm[:, b], spec)
+                flag_runs(bit, runs.present[:, a] & runs.present[:, b] & ((a_hi & b_lo) | (a_lo & b_hi)), (a, b))
+            continue
+
+        # Lượt chạy được xét: đủ các mức yêu cầu (hoặc >= min_levels mức khi levels=None)
+        present = runs.present[:, cols]
+        if spec.levels:
+            anchor = present.all(axis=1)
+        else:
+            anchor = present.sum(axis=1) >= spec.min_levels
+        if spec.all_rows:
+            # Mọi dòng của lượt chạy; chỉ lượt hiện tại cần đủ mức
+            hi, lo = _beyond(z, spec)
+            points = runs.run_size
+            hi_count = np.bincount(runs.run, weights=hi, minlength=n_runs)
+            lo_count = np.bincount(runs.run, weights=lo, minlength=n_runs)
+            complete = np.ones(n_runs)
+        else:
+            # Dòng đầu của mỗi mức; mọi lượt trong cửa sổ cần đủ mức
+            hi, lo = _beyond(zm[:, cols], spec)
+            points = present.sum(axis=1)
+            hi_count, lo_count = (hi & present).sum(axis=1), (lo & present).sum(axis=1)
+            complete = anchor.astype(float)
+
+        # Cộng dồn trên cửa sổ `runs` lượt chạy kết thúc tại lượt hiện tại
+        w = spec.runs
+        full = np.arange(n_runs) >= w - 1
+        w_points = _window_sum(points, w)
+        need = w_points if spec.k is None else spec.k
+        hit = (anchor & full & (_window_sum(complete, w) == w) & (w_points >= spec.min_points)
+               & ((_window_sum(hi_count, w) >= need) | (_window_sum(lo_count, w) >= need)))
+
+        # Gắn cờ cho mọi điểm của cửa sổ
+        covered = _window_sum(hit[::-1], w)[::-1] > 0
+        if spec.all_rows:
+            mask[covered[runs.run]] |= bit
+        else:
+            flag_runs(bit, covered, cols)
+    return mask
+
+
+def westgard_bitmask(df, mean_map, sd_map, rules=None, z=None):
+    """
+    Tính bitmask vi phạm Westgard cho từng dòng của df (cột date dạng datetime, level, value).
+    rules: tên bộ quy tắc hoặc danh sách RuleSpec (mặc định DEFAULT_RULE_SET).
+    z: z-score tính sẵn theo thứ tự dòng của df (khi đó bỏ qua mean_map/sd_map).
+    Trả về Series số nguyên cùng index với df; dòng không có ngày luôn = 0.
+    """
+    return westgard_bitmasks(df, {None: rules}, mean_map, sd_map, z)[None]
+
+
+def westgard_bitmasks(df, rule_sets, mean_map=None, sd_map=None, z=None):
+    """
+    Bitmask Westgard của cùng 1 bộ dữ liệu cho nhiều bộ quy tắc (dict tên -> rules) trong 1 lượt.
+    Sắp xếp, z-score và RunMatrix chỉ tính 1 lần; RuleSpec có mặt trong nhiều bộ chỉ chạy 1 lần,
+    bitmask của mỗi bộ là OR các quy tắc của nó (quy tắc only_if_clean xét sau cùng).
+    Trả về dict tên -> Series số nguyên cùng index với df.
+    """
+    if not df.index.is_unique:
+        # Vd pd.concat nhiều lot không ignore_index: tính theo vị trí dòng rồi gắn lại index gốc
+        masks = westgard_bitmasks(df.reset_index(drop=True), rule_sets, mean_map, sd_map,
+                                  z=None if z is None else np.asarray(z, dtype=float))
+        return {name: pd.Series(mask.to_numpy(), index=df.index) for name, mask in masks.items()}
+    compiled = {name: resolve_rules(rules) for name, rules in rule_sets.items()}
+    dated = df['date'].notna().to_numpy()
+    df_calc = df[dated].sort_values(by=['date', 'level'])
+    n = len(df_calc)
+    if n == 0:
+        return {name: pd.Series(0, index=df.index, dtype=np.int64) for name in compiled}
+
+    if z is None:
+        z = compute_z_scores(df_calc, mean_map, sd_map)
+    else:
+        z = pd.Series(np.asarray(z, dtype=float), index=df.index)[df_calc.index].to_numpy()
+    pos_of = pd.Series(np.arange(n), index=df_calc.index)
+    specs = {spec for rules in compiled.values() for spec in rules.specs}
+    spec_masks = {}
+
+    across = [spec for spec in specs if spec.scope == "across"]
+    if across:
+        runs = build_run_matrix(df_calc)
+        for spec in across:
+            spec_masks[spec] = _across_mask(runs, z, [spec])
+
+    # Mọi mức gộp theo thời gian
+    series = [spec for spec in specs if spec.scope == "series"]
+    if series:
+        by_date = df.sort_values('date')
+        order = pos_of[by_date.index[by_date['date'].notna().to_numpy()]].to_numpy()
+        for spec in series:
+            spec_masks[spec] = np.zeros(n, dtype=np.int64)
+            spec_masks[spec][order] = _series_mask(z[order], [spec])
+
+    # Chuỗi thời gian của từng mức (giữ đúng thứ tự sắp xếp theo ngày như bản cũ, kể cả khi trùng thời điểm)
+    within = [spec for spec in specs if spec.scope == "within"]
+    if within:
+        orders = [pos_of[df_level.sort_values(by='date').index].to_numpy()
+                  for _, df_level in df_calc.groupby('level')]
+        for spec in within:
+            spec_masks[spec] = np.zeros(n, dtype=np.int64)
+            for order in orders:
+                spec_masks[spec][order] = _series_mask(z[order], [spec])
+
+    result = {}
+    for name, rules in compiled.items():
+        mask = np.zeros(n, dtype=np.int64)
+        for spec in rules.across + rules.series + rules.within:
+            mask |= spec_masks[spec]
+        for spec in rules.clean:
+            mask |= np.where(mask == 0, spec_masks[spec], 0)
+        result[name] = pd.Series(0, index=df.index, dtype=np.int64)
+        result[name][df_calc.index] = mask
+    return result
+
+
+def get_westgard_violations(df, mean_map, sd_map, rules=None):
+    """
+    Thêm cột 'Violation' (chuỗi các quy tắc vi phạm, 'ĐẠT' nếu không có) cho dữ liệu IQC.
+    mean_map/sd_map: dict {level: mean/sd} hoặc 1 giá trị dùng chung cho mọi dòng.
+    rules: tên bộ quy tắc hoặc danh sách RuleSpec (mặc định DEFAULT_RULE_SET).
+    Kết quả được gán theo id (id trong DB là duy nhất).
+    """
+    if df is None or df.empty:
+        return df
+
+    df = df.copy()
+    if 'id' not in df.columns: df['id'] = range(len(df))
+    if not pd.api.types.is_datetime64_any_dtype(df['date']):
+        from db_module import _parse_dates
+        df['date'] = _parse_dates(df['date'].values).values
+
+    mask = westgard_bitmask(df, mean_map, sd_map, rules)
+    has_date = df['date'].notna().to_numpy()
+    # Gộp (OR) bitmask theo id, phòng khi 1 id xuất hiện nhiều dòng
+    codes, ids = pd.factorize(df['id'][has_date])
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+    id_mask = np.bitwise_or.reduceat(mask.to_numpy()[has_date][order], starts) if len(order) else np.array([], dtype=np.int64)
+    labels = {m: decode_violations(m) for m in np.unique(id_mask)}
+    by_id = pd.Series([labels[m] for m in id_mask], index=ids, dtype=object)
+    df['Violation'] = df['id'].map(by_id).replace("", PASS_LABEL).fillna(PASS_LABEL)
+    return df
+
+
+def check_westgard_multi_level(df):
+    """
+    Kiểm tra lỗi 6x, 9x, 12x cho 3 mức nồng độ cùng 1 bên so với đường trung tâm.
+    Quy tắc: n kết quả liên tiếp (gộp cả 3 levels) nằm cùng phía so với Mean (cột target_mean).
+    Mỗi điểm chỉ báo lỗi nặng nhất (12x > 9x > 6x).
+    """
+    if len(df) < 6:
+        return []
+    df = df.reset_index(drop=True)
+    # Chỉ xét phía so với Mean nên dùng độ lệch value - target_mean thay cho z-score
+    mask = westgard_bitmask(df, None, None, MULTI_LEVEL_RULES, z=df['value'] - df['target_mean'])
+    messages = (
+        ("12x", "❌ Lỗi 12x: 4 lượt chạy (12 điểm) cùng bên tại {}"),
+        ("9x", "⚠️ Lỗi 9x: 3 lượt chạy (9 điểm) cùng bên tại {}"),
+        ("6x", "ℹ️ Lỗi 6x: 2 lượt chạy (6 điểm) cùng bên tại {}"),
+    )
+    violation_logs = []
+    df_sorted = df.sort_values('date')
+    for d, m in zip(df_sorted['date'], mask[df_sorted.index]):
+        for name, text in messages:
+            if m & RULE_BITS[name]:
+                violation_logs.append(text.format(d.strftime('%d/%m %H:%M')))
+                break
+    return violation_logs
+
+
+def check_westgard_rules(df_all, rules=None):
+    """
+    Kiểm tra toàn bộ quy tắc Westgard (Within & Across) và tách theo mức độ.
+    Input: DataFrame IQC có cột id, date, level, z_score.
+    Output: Tuple (final_rejections, final_warnings), mỗi phần tử là (iqc_id, "Tên lỗi", "REJECTION"/"WARNING").
+    """
+    if df_all.empty or 'z_score' not in df_all.columns:
+        return ([], [])
+    compiled = resolve_rules(rules)
+    df_all = df_all.sort_values(by=['date', 'level'])
+    mask = westgard_bitmask(df_all, None, None, rules, z=df_all['z_score'])
+    final_rejections, final_warnings = [], []
+    for iqc_id, m in zip(df_all['id'], mask):
+        names = decode_violations(m).split(", ") if m else []
+        rejects = [name for name in names if compiled.severity.get(name) == "reject"]
+        if rejects:
+            final_rejections.append((iqc_id, ", ".join(rejects), "REJECTION"))
+        elif names:
+            final_warnings.append((iqc_id, ", ".join(names), "WARNING"))
+    return final_rejections, final_warnings
+
+
+class LevelStream:
+    """
+    Bộ chấm Westgard tăng dần cho 1 chuỗi (lot, level) theo thứ tự (date, id).
+    Chỉ giữ `window` z-score gần nhất (quy tắc within dài nhất của bộ quy tắc) nên mỗi điểm mới
+    được chấm trong O(1), bằng đúng các hàm mà westgard_bitmask dùng cho cả chuỗi.
+    """
+
+    def __init__(self, mean, sd, rules=None):
+        self.mean, self.sd = mean, sd
+        self.rules = resolve_rules(rules)
+        self.window = self.rules.window
+        self.recent_z = deque(maxlen=self.window)
+
+    def z_score(self, value):
+        # Cùng quy ước với compute_z_scores: z = 0 khi sd <= 0, thiếu thông số hoặc giá trị lỗi
+        try:
+            v = float(value)
+            return (v - self.mean) / self.sd if self.sd > 0 else 0
+        except Exception:
+            return 0
+
+    def extend(self, values):
+        """Nạp các giá trị đã lưu trước đó (cũ -> mới) mà không chấm."""
+        self.recent_z.extend(self.z_score(v) for v in values)
+
+    def push(self, value):
+        """Thêm 1 điểm mới, trả về bitmask vi phạm của điểm đó."""
+        self.recent_z.append(self.z_score(value))
+        z = np.fromiter(self.recent_z, dtype=float, count=len(self.recent_z))
+        return int(score_z_series(z, self.rules)[-1])
+
+    def push_label(self, value):
+        return verdict_label(self.push(value))
+
+    def score(self, values):
+        """Chấm cả chuỗi giá trị (cũ -> mới) trong 1 lượt, trả về danh sách nhãn kết quả."""
+        z = np.array([self.z_score(v) for v in values], dtype=float)
+        self.recent_z.extend(z[-self.window:])
+        return [verdict_label(m) for m in score_z_series(z, self.rules)]